@@ -0,0 +1,382 @@
+import argparse, os, sys, time, json, random, subprocess, platform, gc, tracemalloc
+import urllib.request
+
+try:
+    import redis
+except ImportError:
+    print("Please install: pip install redis", file=sys.stderr)
+    sys.exit(1)
+
+
+LOCATIONS = [
+    ("Sydney, New South Wales, Australia", -33.87, 151.21),
+    ("Tokyo, Japan", 35.69, 139.69),
+    ("Frankfurt am Main, Hesse, Germany", 50.11, 8.68),
+    ("Ashburn, Virginia, United States", 39.04, -77.49),
+    ("Sao Paulo, Sao Paulo, Brazil", -23.55, -46.63),
+    ("Singapore", 1.29, 103.85),
+]
+APPS = ["HTTP", "DNS", "TCP_CONN", "UDP_PACKET", "SMTP", "FTP"]
+
+
+def public_ip(n):
+    # 把 n 映射到 11.0.0.0 開始的公網地址，保證不同的 n 得到不同的 IP
+    n += 11 << 24
+    return f"{(n >> 24) & 255}.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+def make_five_tuple(n, jitter=True):
+    loc, lat, lon = LOCATIONS[n % len(LOCATIONS)]
+    if jitter:
+        lat += random.uniform(-2, 2)
+        lon += random.uniform(-2, 2)
+    return json.dumps({
+        "protocol": "TCP" if n % 3 else "UDP",
+        "app": APPS[n % len(APPS)],
+        "src_ip": "192.168.1.10",
+        "src_port": 40000 + n % 20000,
+        "src_location": "Private Address",
+        "src_lat": 0.0,
+        "src_lon": 0.0,
+        "dst_ip": public_ip(n),
+        "dst_port": 443,
+        "dst_location": loc,
+        "dst_lat": lat,
+        "dst_lon": lon,
+        "ts": time.time(),
+    }, separators=(",", ":")).encode()
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+    return {
+        "count": len(values),
+        "p50": pick(50),
+        "p95": pick(95),
+        "p99": pick(99),
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+
+class DirectTarget:
+    # 直接在本進程裡調用 gui.ingest_batch，HTTP 走 Flask test client
+    def __init__(self, args):
+        import gui
+        self.gui = gui
+        self.client = gui.app.test_client()
+
+    def reset(self, size):
+        gui = self.gui
+        gui.ip_store = gui.IPStore(cache_max_entries=max(size * 2, gui.CACHE_MAX_ENTRIES))
+        gui.traffic_stats = gui.TrafficStats()
+        gui.ingest_stats = gui.IngestStats()
+
+    def ingest(self, payloads):
+        self.gui.ingest_batch(payloads)
+
+    def get(self, path):
+        resp = self.client.get(path)
+        return resp.status_code, len(resp.get_data())
+
+    def get_json(self, path):
+        return self.client.get(path).get_json()
+
+    def ingest_stats(self):
+        return self.gui.ingest_stats.snapshot()
+
+
+class RedisTarget:
+    # 發布到 five_tuple_channel，由正在運行的 gui.py 消費，HTTP 走真實端口
+    def __init__(self, args):
+        self.r = redis.Redis(host=args.redis_host, port=args.redis_port)
+        self.channel = args.channel
+        self.base_url = args.gui_url.rstrip("/")
+
+    def reset(self, size):
+        pass
+
+    def ingest(self, payloads):
+        pipe = self.r.pipeline(transaction=False)
+        for p in payloads:
+            pipe.publish(self.channel, p)
+        pipe.execute()
+
+    def get(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=120) as resp:
+            return resp.status, len(resp.read())
+
+    def get_json(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=120) as resp:
+            return json.loads(resp.read())
+
+    def ingest_stats(self):
+        return self.get_json("/ingest_stats")
+
+
+def fill(target, size, batch):
+    # 不限速灌滿 size 個不同的 IP，測最大吞吐；只計 ingest 本身的時間，不計生成 JSON
+    elapsed = 0.0
+    for start in range(0, size, batch):
+        payloads = [make_five_tuple(n) for n in range(start, min(start + batch, size))]
+        t0 = time.perf_counter()
+        target.ingest(payloads)
+        elapsed += time.perf_counter() - t0
+    return {"records": size, "seconds": elapsed, "records_per_sec": size / elapsed if elapsed else 0.0}
+
+
+def sustained(target, size, rate, duration, batch):
+    # 開環：按預定時間表餵入，lag = 批次處理完成時間 - 預定時間
+    interval = batch / rate
+    lags_ms = []
+    sent = 0
+    start = time.perf_counter()
+    seq = 0
+    while True:
+        intended = start + seq * interval
+        if intended - start >= duration:
+            break
+        payloads = [make_five_tuple(random.randrange(size)) for _ in range(batch)]
+        now = time.perf_counter()
+        if intended > now:
+            time.sleep(intended - now)
+        target.ingest(payloads)
+        lags_ms.append((time.perf_counter() - intended) * 1000.0)
+        sent += batch
+        seq += 1
+    elapsed = time.perf_counter() - start
+    return {"target_rate": rate, "sent": sent, "achieved_rate": sent / elapsed if elapsed else 0.0,
+            "lag_ms": percentiles(lags_ms)}
+
+
+def measure_memory(size, batch):
+    # 只測 IPStore 本身：tracemalloc 記錄填滿 size 個IP之後多出來的內存。
+    # 地點 / app 每條都是新的字符串對象，和 JSON 解碼出來的一樣
+    import gui
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    store = gui.IPStore(cache_max_entries=max(size * 2, gui.CACHE_MAX_ENTRIES))
+    now = time.time()
+    for start in range(0, size, batch):
+        items = []
+        for n in range(start, min(start + batch, size)):
+            loc, lat, lon = LOCATIONS[n % len(LOCATIONS)]
+            items.append((public_ip(n), (loc.encode().decode(), lat + random.uniform(-2, 2),
+                                         lon + random.uniform(-2, 2), APPS[n % len(APPS)].encode().decode())))
+        store.upsert_many(items, now)
+        del items
+    gc.collect()
+    live_bytes = tracemalloc.get_traced_memory()[0] - base
+    store.expire(now + store.live_ttl + 1)  # 全部過期，只剩長期緩存
+    gc.collect()
+    cached_bytes = tracemalloc.get_traced_memory()[0] - base
+    # 丟掉二級索引（/all_cache 搜索用）再量一次，差值就是索引的份額
+    store.index = None
+    gc.collect()
+    index_bytes = cached_bytes - (tracemalloc.get_traced_memory()[0] - base)
+    tracemalloc.stop()
+    return {
+        "ips": size,
+        "live_bytes": live_bytes,
+        "cached_bytes": cached_bytes,
+        "index_bytes": index_bytes,
+        "bytes_per_ip_live": live_bytes / size,
+        "bytes_per_ip_cached": cached_bytes / size,
+        "bytes_per_ip_index": index_bytes / size,
+    }
+
+
+def endpoint_paths(size):
+    probe = public_ip(random.randrange(size))
+    prefix = ".".join(probe.split(".")[:2]) + "."
+    return {
+        "get_ip_data": "/get_ip_data",
+        "get_ip_data_bbox_z2": "/get_ip_data?bbox=-60,-180,75,180&zoom=2",
+        "get_ip_data_bbox_z10": "/get_ip_data?bbox=35,139,36,140&zoom=10",
+        "all_cache_page": "/all_cache?page=1&page_size=100",
+        "all_cache_ip_prefix": f"/all_cache?q={prefix}&page=1&page_size=100",
+        "all_cache_location": "/all_cache?q=tokyo&page=1&page_size=100",
+        "all_cache_full": "/all_cache",
+        "stats": "/stats?window=300&top=10",
+    }
+
+
+def measure_endpoints(target, size, requests_per_endpoint, full_requests, delta_batch, delta_wait):
+    results = {}
+    for name, path in endpoint_paths(size).items():
+        n = full_requests if name in ("get_ip_data", "all_cache_full") else requests_per_endpoint
+        latencies = []
+        size_bytes = 0
+        for _ in range(n):
+            t0 = time.perf_counter()
+            status, size_bytes = target.get(path)
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            if status != 200:
+                print(f"  {path} -> HTTP {status}", file=sys.stderr)
+        results[name] = {"path": path, "bytes": size_bytes, "latency_ms": percentiles(latencies)}
+
+    # 增量接口：先拿 cursor，再灌一批更新，測 since 查詢
+    latencies = []
+    size_bytes = 0
+    for _ in range(requests_per_endpoint):
+        cursor = target.get_json("/get_ip_data?bbox=0,0,0,0&zoom=0")["cursor"]
+        target.ingest([make_five_tuple(random.randrange(size)) for _ in range(delta_batch)])
+        if delta_wait:
+            time.sleep(delta_wait)
+        t0 = time.perf_counter()
+        status, size_bytes = target.get(f"/get_ip_data?since={cursor}")
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+    results["get_ip_data_since"] = {"path": "/get_ip_data?since=<cursor>", "bytes": size_bytes,
+                                    "delta_batch": delta_batch, "latency_ms": percentiles(latencies)}
+    return results
+
+
+def measure_probes(ips, rounds):
+    # 直接調 gui.probe_hosts（需要 root / CAP_NET_RAW）；目標可以是 127.0.0.1 或 netns 裡的 veth 地址：
+    #   ip netns add probe0 && ip link add veth0 type veth peer name veth1 netns probe0
+    #   ip addr add 10.200.0.1/24 dev veth0 && ip link set veth0 up
+    #   ip -n probe0 addr add 10.200.0.2/24 dev veth1 && ip -n probe0 link set veth1 up && ip -n probe0 link set lo up
+    import gui
+    elapsed = []
+    result = {}
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        result = gui.probe_hosts(ips)
+        elapsed.append((time.perf_counter() - t0) * 1000.0)
+    return {
+        "targets": len(ips),
+        "icmp_answered": sum(1 for r in result.values() if "ttl" in r["os_detect"]),
+        "tcp_answered": sum(1 for r in result.values() if "ttl" in r["tcp_fingerprint"]),
+        "batch_ms": percentiles(elapsed),
+        "results": result,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'metric':<48} {'old':>12} {'new':>12} {'ratio':>8}")
+    for size, new_run in new["runs"].items():
+        old_run = old["runs"].get(size)
+        if not old_run:
+            continue
+        rows = [(f"{size} fill records/s", old_run["fill"]["records_per_sec"], new_run["fill"]["records_per_sec"])]
+        if "memory" in old_run and "memory" in new_run:
+            for key in ("bytes_per_ip_live", "bytes_per_ip_cached", "bytes_per_ip_index"):
+                if key in old_run["memory"] and key in new_run["memory"]:
+                    rows.append((f"{size} {key}", old_run["memory"][key], new_run["memory"][key]))
+        for name, ep in new_run["endpoints"].items():
+            if name in old_run["endpoints"]:
+                rows.append((f"{size} {name} p50 ms", old_run["endpoints"][name]["latency_ms"].get("p50", 0),
+                             ep["latency_ms"].get("p50", 0)))
+                rows.append((f"{size} {name} p99 ms", old_run["endpoints"][name]["latency_ms"].get("p99", 0),
+                             ep["latency_ms"].get("p99", 0)))
+        for label, a, b in rows:
+            ratio = b / a if a else float("inf")
+            print(f"{label:<48} {a:>12.3f} {b:>12.3f} {ratio:>8.2f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="gui.py consumer benchmark (ingest rate / lag / endpoint latency)")
+    ap.add_argument("--target", choices=["direct", "redis"], default="direct",
+                    help="direct: call gui.ingest_batch in-process; redis: publish to a running gui.py")
+    ap.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated table sizes (distinct IPs)")
+    ap.add_argument("--batch", type=int, default=500, help="Messages per ingest batch / pipeline")
+    ap.add_argument("--rate", type=float, default=20000.0, help="Sustained phase messages per second")
+    ap.add_argument("--duration", type=float, default=10.0, help="Sustained phase duration (seconds)")
+    ap.add_argument("--requests", type=int, default=50, help="Requests per endpoint")
+    ap.add_argument("--full-requests", type=int, default=5, help="Requests for full-dump endpoints")
+    ap.add_argument("--delta-wait", type=float, default=0.2,
+                    help="redis target: seconds to let gui.py consume a batch before the since= query")
+    ap.add_argument("--skip-memory", action="store_true", help="direct target: skip the bytes-per-IP measurement")
+    ap.add_argument("--probe", default="",
+                    help="Comma-separated IPs: time one batched gui.probe_hosts pass against them and exit")
+    ap.add_argument("--probe-rounds", type=int, default=5, help="Batches for --probe")
+    ap.add_argument("--channel", default="five_tuple_channel")
+    ap.add_argument("--redis-host", default=os.getenv("REDIS_HOST", "127.0.0.1"))
+    ap.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", "6379")))
+    ap.add_argument("--gui-url", default="http://127.0.0.1:5000")
+    ap.add_argument("--out", default="", help="JSON results path")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.probe:
+        ips = [ip for ip in args.probe.split(",") if ip]
+        probe = measure_probes(ips, args.probe_rounds)
+        for ip, r in probe["results"].items():
+            print(f"  {ip:<16} os_detect={json.dumps(r['os_detect'])}")
+            print(f"  {'':<16} tcp_fingerprint={json.dumps(r['tcp_fingerprint'])}")
+        l = probe["batch_ms"]
+        print(f"probe: {probe['targets']} targets icmp={probe['icmp_answered']} tcp={probe['tcp_answered']} "
+              f"batch p50={l['p50']:.2f}ms max={l['max']:.2f}ms")
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(probe, f, indent=2)
+        return
+
+    random.seed(42)
+    target = DirectTarget(args) if args.target == "direct" else RedisTarget(args)
+    report = {
+        "revision": git_revision(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "runs": {},
+    }
+
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        print(f"\n=== {size} IPs ===")
+        memory = None
+        if args.target == "direct" and not args.skip_memory:
+            memory = measure_memory(size, args.batch)
+            print(f"memory: {memory['bytes_per_ip_live']:.0f} B/IP live, "
+                  f"{memory['bytes_per_ip_cached']:.0f} B/IP cache-only "
+                  f"(index {memory['bytes_per_ip_index']:.0f} B/IP)")
+        target.reset(size)
+        fill_result = fill(target, size, args.batch)
+        print(f"fill: {fill_result['records_per_sec']:.0f} records/s ({fill_result['seconds']:.2f}s)")
+        sustained_result = sustained(target, size, args.rate, args.duration, args.batch)
+        lag = sustained_result["lag_ms"]
+        print(f"sustained: target={args.rate:.0f}/s achieved={sustained_result['achieved_rate']:.0f}/s "
+              f"lag_ms p50={lag.get('p50', 0):.2f} p99={lag.get('p99', 0):.2f} max={lag.get('max', 0):.2f}")
+        endpoints = measure_endpoints(target, size, args.requests, args.full_requests,
+                                      args.batch, 0.0 if args.target == "direct" else args.delta_wait)
+        for name, ep in endpoints.items():
+            l = ep["latency_ms"]
+            print(f"  {name:<24} p50={l['p50']:.2f}ms p95={l['p95']:.2f}ms p99={l['p99']:.2f}ms "
+                  f"max={l['max']:.2f}ms bytes={ep['bytes']}")
+        report["runs"][str(size)] = {
+            "fill": fill_result,
+            "sustained": sustained_result,
+            "endpoints": endpoints,
+            "ingest_stats": target.ingest_stats(),
+        }
+        if memory is not None:
+            report["runs"][str(size)]["memory"] = memory
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nresults written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
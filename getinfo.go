@@ -7,8 +7,12 @@ import (
 	"encoding/json"
 	"fmt"
 	"log"
+	"math"
 	"net"
+	"os"
+	"strconv"
 	"strings"
+	"time"
 	"unicode/utf8"
 
 	"github.com/oschwald/geoip2-golang"
@@ -28,116 +32,319 @@ type FiveTuple struct {
 	DstLocation  string  `json:"dst_location"`
 	DstLat       float64 `json:"dst_lat"`
 	DstLon       float64 `json:"dst_lon"`
+	Ts           float64 `json:"ts"`
+
+	// 二进制格式直接写原始字节，不走 SrcIP/DstIP 字符串
+	srcAddr, dstAddr net.IP
+	proto            byte
 }
 
-func main() {
-	ctx := context.Background()
+// 二进制批量五元组格式，和 gui.py 的 decode_five_tuple_batch 对应，小端：
+//   头部   magic "FT"、版本(1B)、flags(1B，保留)、字符串表条数(2B)、记录条数(4B)
+//   字符串 每条 2B 长度 + UTF-8，位置和应用名在一批里只存一次
+//   记录   每条 44B：src_ip(4) dst_ip(4) src_port(2) dst_port(2)
+//          src_lat src_lon dst_lat dst_lon（int32 微度）src_loc dst_loc app(各 2B 字符串下标)
+//          ip 协议号(1) 填充(1) ts(float64)
+const (
+	tupleVersion    = 1
+	tupleHeaderSize = 10
+	tupleRecordSize = 44
+	tupleMaxStrings = 65000 // 下标是 uint16，留点余量
+)
 
-	rdb := redis.NewClient(&redis.Options{
-		Addr: "127.0.0.1:6379",
-	})
-	sub := rdb.Subscribe(ctx, "raw_packet_channel")
+type tupleBatch struct {
+	strings []string
+	ids     map[string]uint16
+	records []byte
+	count   int
+}
 
-	_, err := sub.Receive(ctx)
-	if err != nil {
-		log.Fatalf("Subscription failed: %v", err)
+func newTupleBatch() *tupleBatch {
+	return &tupleBatch{ids: make(map[string]uint16)}
+}
+
+func (b *tupleBatch) intern(s string) uint16 {
+	if id, ok := b.ids[s]; ok {
+		return id
 	}
-	ch := sub.Channel()
+	id := uint16(len(b.strings))
+	b.strings = append(b.strings, s)
+	b.ids[s] = id
+	return id
+}
 
-	db, err := geoip2.Open("/FinalProject/tmp/info/GeoLite2-City.mmdb")
-	if err != nil {
-		log.Fatalf("Error opening GeoLite2 database: %v", err)
+func microdegrees(v float64) uint32 {
+	return uint32(int32(math.Round(v * 1e6)))
+}
+
+func (b *tupleBatch) add(t *FiveTuple) {
+	var rec [tupleRecordSize]byte
+	copy(rec[0:4], t.srcAddr.To4())
+	copy(rec[4:8], t.dstAddr.To4())
+	binary.LittleEndian.PutUint16(rec[8:10], t.SrcPort)
+	binary.LittleEndian.PutUint16(rec[10:12], t.DstPort)
+	binary.LittleEndian.PutUint32(rec[12:16], microdegrees(t.SrcLat))
+	binary.LittleEndian.PutUint32(rec[16:20], microdegrees(t.SrcLon))
+	binary.LittleEndian.PutUint32(rec[20:24], microdegrees(t.DstLat))
+	binary.LittleEndian.PutUint32(rec[24:28], microdegrees(t.DstLon))
+	binary.LittleEndian.PutUint16(rec[28:30], b.intern(t.SrcLocation))
+	binary.LittleEndian.PutUint16(rec[30:32], b.intern(t.DstLocation))
+	binary.LittleEndian.PutUint16(rec[32:34], b.intern(t.App))
+	rec[34] = t.proto
+	binary.LittleEndian.PutUint64(rec[36:44], math.Float64bits(t.Ts))
+	b.records = append(b.records, rec[:]...)
+	b.count++
+}
+
+func (b *tupleBatch) full(maxRecords int) bool {
+	return b.count >= maxRecords || len(b.strings) >= tupleMaxStrings
+}
+
+func (b *tupleBatch) encode() []byte {
+	size := tupleHeaderSize + len(b.records)
+	for _, s := range b.strings {
+		size += 2 + len(s)
 	}
-	defer db.Close()
+	out := make([]byte, tupleHeaderSize, size)
+	copy(out[0:2], "FT")
+	out[2] = tupleVersion
+	binary.LittleEndian.PutUint16(out[4:6], uint16(len(b.strings)))
+	binary.LittleEndian.PutUint32(out[6:10], uint32(b.count))
+	for _, s := range b.strings {
+		out = binary.LittleEndian.AppendUint16(out, uint16(len(s)))
+		out = append(out, s...)
+	}
+	return append(out, b.records...)
+}
 
-	fmt.Println("Subscribed... waiting for packets")
+func (b *tupleBatch) reset() {
+	b.strings = b.strings[:0]
+	for k := range b.ids {
+		delete(b.ids, k)
+	}
+	b.records = b.records[:0]
+	b.count = 0
+}
 
-	for msg := range ch {
-		data, err := base64.StdEncoding.DecodeString(msg.Payload)
+// FIVE_TUPLE_TRANSPORT: pubsub（默认）、stream 或 both，和 gui.py 共用同一个环境变量
+func streamConfig() (publish bool, stream bool, key string, maxLen int64) {
+	transport := os.Getenv("FIVE_TUPLE_TRANSPORT")
+	publish = transport != "stream"
+	stream = transport == "stream" || transport == "both"
+	key = os.Getenv("FIVE_TUPLE_STREAM")
+	if key == "" {
+		key = "five_tuple_stream"
+	}
+	maxLen = 1000000
+	if v, err := strconv.ParseInt(os.Getenv("FIVE_TUPLE_STREAM_MAXLEN"), 10, 64); err == nil && v > 0 {
+		maxLen = v
+	}
+	return
+}
+
+// FIVE_TUPLE_FORMAT: json（默认，一条消息一个五元组）或 binary（批量二进制）；
+// binary 时攒够 FIVE_TUPLE_BATCH_MAX 条或每隔 flushInterval 发一次
+func formatConfig() (binaryFormat bool, batchMax int) {
+	binaryFormat = os.Getenv("FIVE_TUPLE_FORMAT") == "binary"
+	batchMax = 256
+	if v, err := strconv.Atoi(os.Getenv("FIVE_TUPLE_BATCH_MAX")); err == nil && v > 0 {
+		batchMax = v
+	}
+	return
+}
+
+const flushInterval = 20 * time.Millisecond
+
+type sink struct {
+	rdb          *redis.Client
+	publish      bool
+	stream       bool
+	streamKey    string
+	streamMaxLen int64
+}
+
+func (s *sink) send(ctx context.Context, data []byte) error {
+	if s.publish {
+		if err := s.rdb.Publish(ctx, "five_tuple_channel", data).Err(); err != nil {
+			return fmt.Errorf("publish: %w", err)
+		}
+	}
+	if s.stream {
+		// 近似裁剪（MAXLEN ~）让 Redis 按整个宏节点删除，开销远小于精确裁剪
+		err := s.rdb.XAdd(ctx, &redis.XAddArgs{
+			Stream: s.streamKey,
+			MaxLen: s.streamMaxLen,
+			Approx: true,
+			Values: map[string]interface{}{"data": data},
+		}).Err()
 		if err != nil {
-			log.Printf("base64 decode failed: %v", err)
-			continue
+			return fmt.Errorf("XADD: %w", err)
 		}
+	}
+	return nil
+}
 
-		if len(data) < 34 {
-			continue
-		}
+// RAW_PACKET_ENCODING: base64（默认）或 binary（captrue 直接发原始帧，省掉约 33% 的膨胀）
+func decodeRawPacket(binaryEncoding bool, payload string) ([]byte, error) {
+	if binaryEncoding {
+		return []byte(payload), nil
+	}
+	return base64.StdEncoding.DecodeString(payload)
+}
 
-		ethType := binary.BigEndian.Uint16(data[12:14])
-		if ethType != 0x0800 {
-			continue
-		}
+// 解析以太网帧，只保留至少一端是公网地址的 IPv4 TCP/UDP 包
+func parsePacket(db *geoip2.Reader, data []byte) (FiveTuple, bool) {
+	if len(data) < 34 {
+		return FiveTuple{}, false
+	}
 
-		ipHeader := data[14:]
-		ipVersion := ipHeader[0] >> 4
-		if ipVersion != 4 {
-			continue
-		}
+	ethType := binary.BigEndian.Uint16(data[12:14])
+	if ethType != 0x0800 {
+		return FiveTuple{}, false
+	}
 
-		ihl := int(ipHeader[0]&0x0F) * 4
-		if len(ipHeader) < ihl+4 {
-			continue
-		}
+	ipHeader := data[14:]
+	ipVersion := ipHeader[0] >> 4
+	if ipVersion != 4 {
+		return FiveTuple{}, false
+	}
 
-		proto := ipHeader[9]
-		srcIP := net.IP(ipHeader[12:16])
-		dstIP := net.IP(ipHeader[16:20])
+	ihl := int(ipHeader[0]&0x0F) * 4
+	if len(ipHeader) < ihl+4 {
+		return FiveTuple{}, false
+	}
 
-		if srcIP.Equal(net.IPv4bcast) || dstIP.Equal(net.IPv4bcast) {
-			continue
-		}
-		if isPrivateIP(srcIP) && isPrivateIP(dstIP) {
-			continue
-		}
-		if proto != 6 && proto != 17 {
-			continue
-		}
+	proto := ipHeader[9]
+	srcIP := net.IP(ipHeader[12:16])
+	dstIP := net.IP(ipHeader[16:20])
 
-		srcLoc, srcLat, srcLon := getGeoLocation(db, srcIP)
-		dstLoc, dstLat, dstLon := getGeoLocation(db, dstIP)
+	if srcIP.Equal(net.IPv4bcast) || dstIP.Equal(net.IPv4bcast) {
+		return FiveTuple{}, false
+	}
+	if isPrivateIP(srcIP) && isPrivateIP(dstIP) {
+		return FiveTuple{}, false
+	}
+	if proto != 6 && proto != 17 {
+		return FiveTuple{}, false
+	}
 
-		transHeader := ipHeader[ihl:]
-		if len(transHeader) < 4 {
-			continue
-		}
+	transHeader := ipHeader[ihl:]
+	if len(transHeader) < 4 {
+		return FiveTuple{}, false
+	}
 
-		srcPort := binary.BigEndian.Uint16(transHeader[0:2])
-		dstPort := binary.BigEndian.Uint16(transHeader[2:4])
-		payload := transHeader[4:]
+	srcLoc, srcLat, srcLon := getGeoLocation(db, srcIP)
+	dstLoc, dstLat, dstLon := getGeoLocation(db, dstIP)
 
-		payloadStr := ""
-		if utf8.Valid(payload) {
-			payloadStr = string(payload)
-		}
+	srcPort := binary.BigEndian.Uint16(transHeader[0:2])
+	dstPort := binary.BigEndian.Uint16(transHeader[2:4])
+	payload := transHeader[4:]
 
-		appProto := DetectApplicationProtocol(proto, srcPort, dstPort, payloadStr)
-
-		tuple := FiveTuple{
-			Protocol:     protocolName(proto),
-			App:          appProto,
-			SrcIP:        srcIP.String(),
-			SrcPort:      srcPort,
-			SrcLocation:  srcLoc,
-			SrcLat:       srcLat,
-			SrcLon:       srcLon,
-			DstIP:        dstIP.String(),
-			DstPort:      dstPort,
-			DstLocation:  dstLoc,
-			DstLat:       dstLat,
-			DstLon:       dstLon,
-		}
+	payloadStr := ""
+	if utf8.Valid(payload) {
+		payloadStr = string(payload)
+	}
 
-		jsonData, err := json.Marshal(tuple)
-		if err != nil {
-			log.Printf("JSON encode error: %v", err)
-			continue
-		}
+	return FiveTuple{
+		Protocol:     protocolName(proto),
+		App:          DetectApplicationProtocol(proto, srcPort, dstPort, payloadStr),
+		SrcIP:        srcIP.String(),
+		SrcPort:      srcPort,
+		SrcLocation:  srcLoc,
+		SrcLat:       srcLat,
+		SrcLon:       srcLon,
+		DstIP:        dstIP.String(),
+		DstPort:      dstPort,
+		DstLocation:  dstLoc,
+		DstLat:       dstLat,
+		DstLon:       dstLon,
+		Ts:           float64(time.Now().UnixNano()) / 1e9,
+		srcAddr:      srcIP,
+		dstAddr:      dstIP,
+		proto:        proto,
+	}, true
+}
 
-		err = rdb.Publish(ctx, "five_tuple_channel", string(jsonData)).Err()
-		if err != nil {
-			log.Printf("Redis publish failed: %v", err)
+func main() {
+	ctx := context.Background()
+	publish, stream, streamKey, streamMaxLen := streamConfig()
+	binaryFormat, batchMax := formatConfig()
+	binaryEncoding := os.Getenv("RAW_PACKET_ENCODING") == "binary"
+
+	rdb := redis.NewClient(&redis.Options{
+		Addr:       "127.0.0.1:6379",
+		ClientName: "getinfo", // watchdog 按名字在 CLIENT LIST 里识别订阅者
+	})
+	out := &sink{rdb: rdb, publish: publish, stream: stream, streamKey: streamKey, streamMaxLen: streamMaxLen}
+	sub := rdb.Subscribe(ctx, "raw_packet_channel")
+
+	_, err := sub.Receive(ctx)
+	if err != nil {
+		log.Fatalf("Subscription failed: %v", err)
+	}
+	ch := sub.Channel()
+
+	db, err := geoip2.Open("/FinalProject/tmp/info/GeoLite2-City.mmdb")
+	if err != nil {
+		log.Fatalf("Error opening GeoLite2 database: %v", err)
+	}
+	defer db.Close()
+
+	fmt.Println("Subscribed... waiting for packets")
+
+	batch := newTupleBatch()
+	flush := func() {
+		if batch.count == 0 {
+			return
+		}
+		data := batch.encode()
+		if err := out.send(ctx, data); err != nil {
+			log.Printf("Redis %v", err)
 		} else {
-			fmt.Printf("Published: %s\n", jsonData)
+			fmt.Printf("Published %d tuples (%d bytes)\n", batch.count, len(data))
+		}
+		batch.reset()
+	}
+	ticker := time.NewTicker(flushInterval)
+	defer ticker.Stop()
+
+	for {
+		select {
+		case <-ticker.C:
+			flush()
+		case msg, ok := <-ch:
+			if !ok {
+				flush()
+				return
+			}
+			data, err := decodeRawPacket(binaryEncoding, msg.Payload)
+			if err != nil {
+				log.Printf("raw packet decode failed: %v", err)
+				continue
+			}
+			tuple, ok := parsePacket(db, data)
+			if !ok {
+				continue
+			}
+
+			if binaryFormat {
+				batch.add(&tuple)
+				if batch.full(batchMax) {
+					flush()
+				}
+				continue
+			}
+
+			jsonData, err := json.Marshal(tuple)
+			if err != nil {
+				log.Printf("JSON encode error: %v", err)
+				continue
+			}
+			if err := out.send(ctx, jsonData); err != nil {
+				log.Printf("Redis %v", err)
+			} else {
+				fmt.Printf("Published: %s\n", jsonData)
+			}
 		}
 	}
 }
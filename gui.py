@@ -1,77 +1,1898 @@
 import redis
 import time
 import json
+import math
 import socket
 import subprocess
 import requests
 import os
-from flask import Flask, render_template, jsonify, request, send_from_directory
-from threading import Thread
-from scapy.all import IP, TCP, sr1
+import random
+import re
+import ipaddress
+import queue
+import asyncio
+import struct
+from functools import lru_cache
+from collections import Counter, OrderedDict, defaultdict, deque
+from bisect import bisect_left, insort
+from itertools import islice
+from array import array
+from flask import Flask, Response, render_template, jsonify, request, send_from_directory, stream_with_context
+from threading import Thread, RLock, Lock, Event, Timer
+from scapy.all import IP, ICMP, TCP, L3RawSocket, sr
 import folium
 from folium import PolyLine
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
 
 app = Flask(__name__)
-cached_ip_data = {}  # 長期緩存所有IP數據
-live_ip_data = {}    # 活躍IP（有過期機制）
 port_scan_results = {}  # 緩存端口掃描結果
 
 WATCHDOG_STATIC_PATH = "/FinalProject/tmp/watchdog/static"
 
+LIVE_EXPIRE_SECONDS = float(os.getenv("GUI_LIVE_EXPIRE_SECONDS", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("GUI_CACHE_MAX_ENTRIES", "1000000"))
+CACHE_MAX_AGE = float(os.getenv("GUI_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+CHANGE_LOG_MAX = int(os.getenv("GUI_CHANGE_LOG_MAX", "200000"))
+CACHE_PAGE_SIZE_MAX = 1000
+STATS_WINDOWS = ((60, 1), (300, 5), (900, 15), (3600, 60))  # (窗口秒數, 桶秒數)
+STATS_DIMS = ("app", "protocol", "location", "ip")
+GEO_CELL_DEGREES = 90.0  # zoom 0 時一個聚類格子的邊長，約四分之一個地圖瓦片
+GEO_POINT_ZOOM = int(os.getenv("GUI_GEO_POINT_ZOOM", "8"))
+PERSIST_ENABLED = os.getenv("GUI_PERSIST", "1") == "1"
+PERSIST_DIR = os.getenv("GUI_PERSIST_DIR", "/FinalProject/tmp/gui/state")
+PERSIST_FLUSH_INTERVAL = float(os.getenv("GUI_PERSIST_FLUSH_INTERVAL", "2"))
+PERSIST_SNAPSHOT_INTERVAL = float(os.getenv("GUI_PERSIST_SNAPSHOT_INTERVAL", "600"))
+PERSIST_COMPACT_BYTES = int(os.getenv("GUI_PERSIST_COMPACT_BYTES", str(256 * 1024 * 1024)))
+# 變更日誌溢出後按 last_seen 寫 delta 的最小間隔，和寫入端 now 與 flush 之間的時鐘餘量
+PERSIST_OVERFLOW_INTERVAL = float(os.getenv("GUI_PERSIST_OVERFLOW_INTERVAL", "10"))
+PERSIST_CLOCK_SLACK = float(os.getenv("GUI_PERSIST_CLOCK_SLACK", "2"))
+SSE_COALESCE_SECONDS = float(os.getenv("GUI_SSE_COALESCE_SECONDS", "0.5"))
+SSE_CLIENT_QUEUE_MAX = int(os.getenv("GUI_SSE_CLIENT_QUEUE_MAX", "64"))
+SSE_KEEPALIVE_SECONDS = 15
+INGEST_BATCH_MAX = int(os.getenv("GUI_INGEST_BATCH_MAX", "1000"))
+# 二進制批量五元組格式（getinfo.go 的 FIVE_TUPLE_FORMAT=binary），小端：
+#   頭部   <2sBBHI>  magic "FT"、版本、flags（保留）、字符串表條數、記錄條數
+#   字符串 每條 <H> 長度 + UTF-8，位置和應用名都只存一次，記錄裡用下標引用
+#   記錄   每條 44 字節 <4s4sHHiiiiHHHBxd>：src_ip dst_ip src_port dst_port
+#          src_lat src_lon dst_lat dst_lon（微度）src_loc dst_loc app ip協議號 填充 ts
+FIVE_TUPLE_MAGIC = b"FT"
+FIVE_TUPLE_VERSION = 1
+FIVE_TUPLE_HEADER = struct.Struct("<2sBBHI")
+FIVE_TUPLE_STRLEN = struct.Struct("<H")
+FIVE_TUPLE_RECORD = struct.Struct("<4s4sHHiiiiHHHBxd")
+IP_PROTOCOL_NAMES = {6: "TCP", 17: "UDP"}
+# pubsub（默認）：訂閱 five_tuple_channel；stream / both：從 Redis Stream 按消費組讀取
+FIVE_TUPLE_TRANSPORT = os.getenv("FIVE_TUPLE_TRANSPORT", "pubsub")
+STREAM_KEY = os.getenv("FIVE_TUPLE_STREAM", "five_tuple_stream")
+STREAM_GROUP = os.getenv("GUI_STREAM_GROUP", "gui")
+STREAM_CONSUMER = os.getenv("GUI_STREAM_CONSUMER", socket.gethostname())
+STREAM_WORKERS = int(os.getenv("GUI_STREAM_WORKERS", "1"))
+STREAM_BLOCK_MS = 1000
+STREAM_CLAIM_IDLE_MS = int(os.getenv("GUI_STREAM_CLAIM_IDLE_MS", "60000"))
+STREAM_CLAIM_INTERVAL = 30
+# 寫入失敗的條目轉存到死信流後確認，避免重啟後從 ID 0 重放時反覆卡在同一批
+STREAM_DEAD_KEY = os.getenv("FIVE_TUPLE_DEAD_STREAM", STREAM_KEY + ":dead")
+STREAM_DEAD_MAXLEN = int(os.getenv("FIVE_TUPLE_DEAD_STREAM_MAXLEN", "10000"))
+# all（默認）：單進程開發模式；ingest：唯一寫入進程，把狀態發布到 Redis；
+# web：只讀副本，給 gunicorn 之類的多 worker 服務器用（gunicorn -k gthread -w 4 gui:app）
+# 注意每個 web worker 各自在內存裡保存一份完整的 ReplicaIPStore：N 個 worker 就是 N 倍緩存內存
+# （1M 條目約 300~400MB/worker，見 bench_gui.py 的 memory 結果），worker 數要按內存來定
+GUI_ROLE = os.getenv("GUI_ROLE", "all")
+SHARED_CHANGES_KEY = "gui:changes"
+SHARED_SNAPSHOT_KEY = "gui:snapshot"  # 當前快照的元數據；記錄分塊存在 gui:snapshot:<代號> 哈希裡
+SHARED_SNAPSHOT_CHUNK = int(os.getenv("GUI_SHARED_SNAPSHOT_CHUNK", "20000"))
+SHARED_SNAPSHOT_GRACE = 120  # 舊快照在被替換後保留的秒數，讓正在讀的副本讀完
+SHARED_STATS_KEY = "gui:published_stats"
+SHARED_LEADER_KEY = "gui:ingest_leader"
+SHARED_LEADER_TTL = 10.0
+SHARED_PUBLISH_INTERVAL = float(os.getenv("GUI_SHARED_PUBLISH_INTERVAL", "0.5"))
+SHARED_SNAPSHOT_INTERVAL = float(os.getenv("GUI_SHARED_SNAPSHOT_INTERVAL", "300"))
+SHARED_STATS_INTERVAL = 1.0
+SHARED_STATS_TOP = 100
+SHARED_RECORDS_PER_ENTRY = 1000
+SHARED_CHANGES_MAXLEN = CHANGE_LOG_MAX
+IP_CLASSIFY_CACHE_SIZE = 65536
+SCAN_PORTS = [int(p) for p in os.getenv("GUI_SCAN_PORTS", "22,23,25,53,80,443,8080,3389").split(',')]
+SCAN_MAX_PORTS = 1024
+SCAN_CONCURRENCY = int(os.getenv("GUI_SCAN_CONCURRENCY", "512"))
+SCAN_CONNECT_TIMEOUT = float(os.getenv("GUI_SCAN_CONNECT_TIMEOUT", "0.5"))
+SCAN_HOST_TIMEOUT = float(os.getenv("GUI_SCAN_HOST_TIMEOUT", "3"))
+SCAN_TOTAL_TIMEOUT = float(os.getenv("GUI_SCAN_TOTAL_TIMEOUT", "60"))
+SCAN_RESULT_MAX_AGE = float(os.getenv("GUI_SCAN_RESULT_MAX_AGE", "300"))
+SCAN_BULK_MAX_IPS = 4096
+PROBE_PORT = int(os.getenv("GUI_PROBE_PORT", "80"))
+PROBE_TIMEOUT = float(os.getenv("GUI_PROBE_TIMEOUT", "2"))
+PROBE_BATCH_WINDOW = float(os.getenv("GUI_PROBE_BATCH_WINDOW", "0.05"))
+PROBE_BATCH_MAX = int(os.getenv("GUI_PROBE_BATCH_MAX", "1024"))
+# 單IP請求等批量結果的上限：等窗口 + loopback/非 loopback 兩輪 sr 超時 + 餘量
+PROBE_WAIT_TIMEOUT = float(os.getenv("GUI_PROBE_WAIT_TIMEOUT", str(PROBE_BATCH_WINDOW + 2 * PROBE_TIMEOUT + 5)))
+GEOIP_DB_PATH = os.getenv("GUI_GEOIP_DB", "/FinalProject/tmp/info/GeoLite2-City.mmdb")
+GEOIP_ONLINE_FALLBACK = os.getenv("GUI_GEOIP_ONLINE_FALLBACK", "1") == "1"
+GEO_CACHE_SIZE = 65536
+# 數據庫打不開時（還沒下載完、掛載晚了）隔多久再試
+GEOIP_RETRY_INTERVAL = float(os.getenv("GUI_GEOIP_RETRY_INTERVAL", "60"))
+TRACEROUTE_TIMEOUT = 30
+TRACEROUTE_STATIC_MAX_FILES = int(os.getenv("GUI_TRACEROUTE_STATIC_MAX_FILES", "200"))
+TRACEROUTE_STATIC_MAX_BYTES = int(os.getenv("GUI_TRACEROUTE_STATIC_MAX_BYTES", str(100 * 1024 * 1024)))
+TRACEROUTE_STATIC_MAX_AGE = float(os.getenv("GUI_TRACEROUTE_STATIC_MAX_AGE", str(24 * 3600)))
+ENRICH_TTLS = {
+    "banner": float(os.getenv("GUI_BANNER_TTL", "300")),
+    "webinfo": float(os.getenv("GUI_WEBINFO_TTL", "300")),
+    "os_detect": float(os.getenv("GUI_OS_DETECT_TTL", "900")),
+    "tcp_fingerprint": float(os.getenv("GUI_TCP_FINGERPRINT_TTL", "900")),
+    "dns_lookup": float(os.getenv("GUI_DNS_LOOKUP_TTL", "3600")),
+    "geo_online": 24 * 3600.0,
+    "traceroute": float(os.getenv("GUI_TRACEROUTE_TTL", "600")),
+}
+ENRICH_ERROR_TTL = float(os.getenv("GUI_ENRICH_ERROR_TTL", "30"))
+ENRICH_CACHE_MAX_ENTRIES = int(os.getenv("GUI_ENRICH_CACHE_MAX_ENTRIES", "20000"))
+# 等同一個鍵上正在跑的探測的上限；要比最慢的探測（traceroute）長
+ENRICH_WAIT_TIMEOUT = float(os.getenv("GUI_ENRICH_WAIT_TIMEOUT", str(TRACEROUTE_TIMEOUT + 15)))
+
+
+IP_QUERY = re.compile(r"^[0-9.]+(/[0-9]{1,2})?$")
+TOKEN_SPLIT = re.compile(r"[^0-9a-z]+")
+
+
+@lru_cache(maxsize=65536)
+def location_tokens(location):
+    return tuple(t for t in TOKEN_SPLIT.split(location.lower()) if t)
+
+
+class StringTable:
+    # 字符串 <-> 整數 id：同一個地點 / app 名在整個緩存裡只存一份
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def intern(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class CacheIndex:
+    # 長期緩存的二級索引：只有 /16 前綴桶存 IPStore 的槽位號；地點 / app 只按 id 記引用數，
+    # 過濾時掃 IPStore 的 _loc/_app 列，不按IP展開集合。分詞只對不同的地點做一次
+    # （token -> {loc_id}）；last_seen 順序直接用 LRU 鏈表
+    def __init__(self, locations, apps):
+        self.locations = locations
+        self.apps = apps
+        self.prefix = defaultdict(set)       # ip_int >> 16 -> {slot}
+        self.location_refs = {}              # loc_id -> 引用它的槽位數
+        self.app_refs = {}                   # app_id -> 引用它的槽位數
+        self.tokens = defaultdict(set)       # token -> {loc_id}
+        self.app_names = defaultdict(set)    # app.lower() -> {app_id}
+
+    @staticmethod
+    def _discard(index, key, value):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.discard(value)
+            if not bucket:
+                del index[key]
+
+    def _add_location(self, loc_id):
+        refs = self.location_refs.get(loc_id, 0)
+        if not refs:
+            for token in location_tokens(self.locations.strings[loc_id]):
+                self.tokens[token].add(loc_id)
+        self.location_refs[loc_id] = refs + 1
+
+    def _remove_location(self, loc_id):
+        refs = self.location_refs.get(loc_id)
+        if refs is None:
+            return
+        if refs > 1:
+            self.location_refs[loc_id] = refs - 1
+            return
+        del self.location_refs[loc_id]
+        for token in location_tokens(self.locations.strings[loc_id]):
+            self._discard(self.tokens, token, loc_id)
+
+    def _add_app(self, app_id):
+        refs = self.app_refs.get(app_id, 0)
+        if not refs:
+            self.app_names[self.apps.strings[app_id].lower()].add(app_id)
+        self.app_refs[app_id] = refs + 1
+
+    def _remove_app(self, app_id):
+        refs = self.app_refs.get(app_id)
+        if refs is None:
+            return
+        if refs > 1:
+            self.app_refs[app_id] = refs - 1
+            return
+        del self.app_refs[app_id]
+        self._discard(self.app_names, self.apps.strings[app_id].lower(), app_id)
+
+    def add(self, slot, ip_int, loc_id, app_id):
+        self.prefix[ip_int >> 16].add(slot)
+        self._add_location(loc_id)
+        self._add_app(app_id)
+
+    def move(self, slot, old_loc_id, old_app_id, loc_id, app_id):
+        if old_loc_id != loc_id:
+            self._remove_location(old_loc_id)
+            self._add_location(loc_id)
+        if old_app_id != app_id:
+            self._remove_app(old_app_id)
+            self._add_app(app_id)
+
+    def remove(self, slot, ip_int, loc_id, app_id):
+        self._discard(self.prefix, ip_int >> 16, slot)
+        self._remove_location(loc_id)
+        self._remove_app(app_id)
+
+    def match_ip(self, pattern, slot_ips):
+        # pattern 可以是 CIDR (1.2.0.0/16) 或字符串前綴 (1.2.3)；slot_ips 是槽位 -> ip_int 的列
+        if '/' in pattern:
+            net = ipaddress.ip_network(pattern, strict=False)
+            start, end = int(net.network_address), int(net.broadcast_address)
+            check = lambda slot: start <= slot_ips[slot] <= end
+        else:
+            octets = pattern.split('.')
+            partial = octets.pop()
+            if len(octets) > 3 or not all(o.isdigit() and int(o) <= 255 for o in octets):
+                return set()
+            start = 0
+            for o in octets:
+                start = (start << 8) | int(o)
+            shift = 8 * (3 - len(octets))
+            start <<= shift + 8
+            end = start + (1 << shift + 8) - 1
+            # 最後一段不完整時按字符串前綴匹配下一個八位組，例如 1.2.3 同時匹配 1.2.3.x 和 1.2.30.x
+            allowed = {v for v in range(256) if str(v).startswith(partial)}
+            check = lambda slot: start <= slot_ips[slot] <= end and (slot_ips[slot] >> shift) & 255 in allowed
+        matched = set()
+        for key in range(start >> 16, (end >> 16) + 1):
+            for slot in self.prefix.get(key, ()):
+                if check(slot):
+                    matched.add(slot)
+        return matched
+
+    def location_ids(self, text):
+        # 所有分詞都匹配的地點 id
+        loc_ids = None
+        for token in location_tokens(text):
+            ids = self.tokens.get(token, set())
+            loc_ids = set(ids) if loc_ids is None else loc_ids & ids
+            if not loc_ids:
+                return set()
+        return loc_ids or set()
+
+    def app_ids(self, app_name):
+        return set(self.app_names.get(app_name.lower(), ()))
+
+
+class GeoGrid:
+    # 活躍IP的經緯度網格：zoom z 的格子邊長為 GEO_CELL_DEGREES / 2**z 度。
+    # 低於 point_zoom 的每一級只存 [count, sum_lat, sum_lon]，用來返回聚類；
+    # point_zoom 這一級存格子裡的槽位號集合，用來按視野取單點
+    def __init__(self, point_zoom=GEO_POINT_ZOOM, cell_degrees=GEO_CELL_DEGREES):
+        self.point_zoom = point_zoom
+        self.cell_sizes = [cell_degrees / (2 ** z) for z in range(point_zoom + 1)]
+        self.clusters = [{} for _ in range(point_zoom)]
+        self.points = {}
+
+    def _cell(self, z, lat, lon):
+        size = self.cell_sizes[z]
+        return int((lon + 180) // size), int((lat + 90) // size)
+
+    def _cell_range(self, z, south, west, north, east):
+        x0, y0 = self._cell(z, max(south, -90), max(west, -180))
+        x1, y1 = self._cell(z, min(north, 90), min(east, 180))
+        return x0, y0, x1, y1
+
+    def add(self, slot, lat, lon):
+        if lat is None or lon is None or (lat == 0 and lon == 0):
+            return
+        for z, level in enumerate(self.clusters):
+            cell = self._cell(z, lat, lon)
+            cluster = level.get(cell)
+            if cluster is None:
+                level[cell] = [1, lat, lon]
+            else:
+                cluster[0] += 1
+                cluster[1] += lat
+                cluster[2] += lon
+        cell = self._cell(self.point_zoom, lat, lon)
+        slots = self.points.get(cell)
+        if slots is None:
+            slots = self.points[cell] = set()
+        slots.add(slot)
+
+    def remove(self, slot, lat, lon):
+        if lat is None or lon is None or (lat == 0 and lon == 0):
+            return
+        for z, level in enumerate(self.clusters):
+            cell = self._cell(z, lat, lon)
+            cluster = level.get(cell)
+            if cluster is None:
+                continue
+            cluster[0] -= 1
+            if cluster[0] <= 0:
+                del level[cell]
+            else:
+                cluster[1] -= lat
+                cluster[2] -= lon
+        cell = self._cell(self.point_zoom, lat, lon)
+        slots = self.points.get(cell)
+        if slots is not None:
+            slots.discard(slot)
+            if not slots:
+                del self.points[cell]
+
+    def move(self, slot, old_lat, old_lon, lat, lon):
+        if old_lat != lat or old_lon != lon:
+            self.remove(slot, old_lat, old_lon)
+            self.add(slot, lat, lon)
+
+    def query_clusters(self, zoom, south, west, north, east):
+        z = max(0, min(int(zoom), self.point_zoom - 1))
+        x0, y0, x1, y1 = self._cell_range(z, south, west, north, east)
+        return [[sum_lat / count, sum_lon / count, count]
+                for (x, y), (count, sum_lat, sum_lon) in self.clusters[z].items()
+                if x0 <= x <= x1 and y0 <= y <= y1]
+
+    def query_points(self, south, west, north, east):
+        x0, y0, x1, y1 = self._cell_range(self.point_zoom, south, west, north, east)
+        result = []
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.points):
+            for (x, y), slots in self.points.items():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    result.extend(slots)
+        else:
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    result.extend(self.points.get((x, y), ()))
+        return result
+
+
+class StoreSnapshot:
+    # IPStore.snapshot() 在鎖內只做這裡的拷貝：array 切片是整塊 memcpy，字符串表只複製列表；
+    # 沿鏈表轉成記錄、序列化、寫盤都在鎖外，用的是拷貝時的一致狀態
+    def __init__(self, store):
+        self.ip = store._ip[:]
+        self.lat = store._lat[:]
+        self.lon = store._lon[:]
+        self.last_seen = store._last_seen[:]
+        self.loc = store._loc[:]
+        self.app = store._app[:]
+        self.prev = store._prev[:]
+        self.next = store._next[:]
+        self.head = store._head
+        self.tail = store._tail
+        self.locations = store.locations.strings[:]
+        self.apps = store.apps.strings[:]
+        self.size = len(store._slots)
+        self.cursor = store.cursor()
+
+    def __len__(self):
+        return self.size
+
+    def rows(self, since=None):
+        # restore() 的記錄格式，按 last_seen 從舊到新；給 since 時只返回 last_seen >= since 的尾段
+        slot = self.head
+        if since is not None:
+            slot = -1
+            prev, last_seen = self.prev, self.last_seen
+            cur = self.tail
+            while cur != -1 and last_seen[cur] >= since:
+                slot = cur
+                cur = prev[cur]
+        ip, lat, lon, last_seen, loc, app = self.ip, self.lat, self.lon, self.last_seen, self.loc, self.app
+        locations, apps, nxt = self.locations, self.apps, self.next
+        while slot != -1:
+            yield (int_to_ip(ip[slot]), locations[loc[slot]], lat[slot], lon[slot], apps[app[slot]],
+                   last_seen[slot])
+            slot = nxt[slot]
+
+
+class IPStore:
+    # 每個緩存IP佔一個槽位，字段按列存在 array 裡（struct-of-arrays），地點和 app 只存字符串表 id，
+    # 唯一的 dict 是 ip_int -> 槽位；對外（HTTP、持久化）時才轉成 IP 字符串和 dict。
+    # 槽位按 last_seen 串成侵入式雙向鏈表（最舊在頭），緩存淘汰從頭開始；過期時間 = last_seen + ttl，
+    # 所以活躍IP都在鏈表尾部從 _live_head 開始的一段裡，過期沿鏈表往後走，不需要過期堆。
+    # changes: 活躍IP的變更日誌 (version, ip_int)，給 /get_ip_data?since= 做增量
+    def __init__(self, live_ttl=LIVE_EXPIRE_SECONDS, cache_max_entries=CACHE_MAX_ENTRIES,
+                 cache_max_age=CACHE_MAX_AGE, change_log_max=CHANGE_LOG_MAX):
+        self.lock = RLock()
+        self.epoch = f"{int(time.time() * 1000):x}"
+        self.version = 0
+        self._changes = deque(maxlen=change_log_max)
+        self.live_ttl = live_ttl
+        self.cache_max_entries = cache_max_entries
+        self.cache_max_age = cache_max_age
+        self.expired_count = 0
+        self.evicted_size_count = 0
+        self.evicted_age_count = 0
+        self._reset_storage()
+
+    def _reset_storage(self):
+        self._slots = {}                  # ip_int -> slot
+        self._ip = array('I')
+        self._lat = array('d')
+        self._lon = array('d')
+        self._last_seen = array('d')
+        self._expire = array('d')
+        self._loc = array('I')            # locations 裡的 id
+        self._app = array('I')            # apps 裡的 id
+        self._prev = array('i')           # LRU 鏈表，-1 表示沒有
+        self._next = array('i')
+        self._live = bytearray()          # 1 = 活躍
+        self._columns = (self._ip, self._lat, self._lon, self._last_seen, self._expire,
+                         self._loc, self._app, self._prev, self._next)
+        self._free = []                   # 被淘汰後可複用的槽位
+        self._head = self._tail = self._live_head = -1
+        self.live_count = 0
+        self.locations = StringTable()
+        self.apps = StringTable()
+        self.index = CacheIndex(self.locations, self.apps)
+        self.geo = GeoGrid()
+
+    def _alloc(self, ip_int):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._live)
+            for column in self._columns:
+                column.append(0)
+            self._live.append(0)
+        self._ip[slot] = ip_int
+        self._slots[ip_int] = slot
+        return slot
+
+    def _link(self, slot, hint=-1):
+        # 按 last_seen 插入，通常就是尾部；restore 的舊記錄要往前找位置，保持鏈表有序。
+        # hint 是 restore 上一條插入的槽位：記錄按時間升序，從它往後找，不用每次從尾部往回走
+        # （後台載入時尾部是並行收到的新數據）。插到了 _live_head 前面時返回 True
+        last_seen = self._last_seen
+        ts = last_seen[slot]
+        if hint != -1 and hint != slot and last_seen[hint] <= ts:
+            after = hint
+            nxt = self._next[after]
+            while nxt != -1 and last_seen[nxt] <= ts:
+                after = nxt
+                nxt = self._next[after]
+        else:
+            after = self._tail
+            while after != -1 and last_seen[after] > ts:
+                after = self._prev[after]
+        nxt = self._head if after == -1 else self._next[after]
+        self._prev[slot] = after
+        self._next[slot] = nxt
+        if after == -1:
+            self._head = slot
+        else:
+            self._next[after] = slot
+        if nxt == -1:
+            self._tail = slot
+        else:
+            self._prev[nxt] = slot
+        return self._live_head != -1 and last_seen[self._live_head] > ts
+
+    def _unlink(self, slot):
+        prev, nxt = self._prev[slot], self._next[slot]
+        if prev == -1:
+            self._head = nxt
+        else:
+            self._next[prev] = nxt
+        if nxt == -1:
+            self._tail = prev
+        else:
+            self._prev[nxt] = prev
+        if slot == self._live_head:
+            self._live_head = nxt
+
+    def _set_live(self, slot, was_live, old_lat, old_lon, before_live_head):
+        # slot 已經接進鏈表、列已經寫好新值
+        if was_live:
+            self.geo.move(slot, old_lat, old_lon, self._lat[slot], self._lon[slot])
+        else:
+            self._live[slot] = 1
+            self.live_count += 1
+            self.geo.add(slot, self._lat[slot], self._lon[slot])
+        if self._live_head == -1 or before_live_head:
+            self._live_head = slot
+
+    def _clear_live(self, slot):
+        self._live[slot] = 0
+        self.live_count -= 1
+        self.geo.remove(slot, self._lat[slot], self._lon[slot])
+
+    @staticmethod
+    def _check_row(ip, location, lat, lon, app_name, last_seen):
+        # 在改動任何列之前先轉換和校驗，壞記錄拋 ValueError；array 列寫到一半失敗會留下斷開的鏈表
+        try:
+            ip_int = ip_to_int(ip)
+            lat, lon, last_seen = float(lat), float(lon), float(last_seen)
+        except (TypeError, ValueError, OSError) as e:
+            raise ValueError(f"malformed record for {ip!r}: {e}") from e
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0 and math.isfinite(last_seen)):
+            raise ValueError(f"out-of-range record for {ip}: {lat}, {lon}, {last_seen}")
+        if not isinstance(location, str) or not isinstance(app_name, str):
+            raise ValueError(f"non-string location/app for {ip}")
+        return ip_int, lat, lon, last_seen
+
+    def _write(self, ip_int, location, lat, lon, app_name, last_seen, hint=-1):
+        # 寫入或更新一個槽位並重新接進鏈表，返回 (slot, 之前是否活躍, 舊 lat, 舊 lon, 是否在 _live_head 前)
+        # 參數必須已經過 _check_row
+        loc_id = self.locations.intern(location)
+        app_id = self.apps.intern(app_name)
+        slot = self._slots.get(ip_int)
+        if slot is None:
+            slot = self._alloc(ip_int)
+            self.index.add(slot, ip_int, loc_id, app_id)
+            was_live, old_lat, old_lon = False, 0.0, 0.0
+        else:
+            self.index.move(slot, self._loc[slot], self._app[slot], loc_id, app_id)
+            self._unlink(slot)
+            was_live, old_lat, old_lon = self._live[slot], self._lat[slot], self._lon[slot]
+        self._loc[slot] = loc_id
+        self._app[slot] = app_id
+        self._lat[slot] = lat
+        self._lon[slot] = lon
+        self._last_seen[slot] = last_seen
+        self._expire[slot] = last_seen + self.live_ttl
+        return slot, was_live, old_lat, old_lon, self._link(slot, hint)
+
+    def _remove_slot(self, slot):
+        self._unlink(slot)
+        ip_int = self._ip[slot]
+        del self._slots[ip_int]
+        self.index.remove(slot, ip_int, self._loc[slot], self._app[slot])
+        self._free.append(slot)
+
+    def _info(self, slot):
+        return {
+            "location": self.locations.strings[self._loc[slot]],
+            "lat": self._lat[slot],
+            "lon": self._lon[slot],
+            "app": self.apps.strings[self._app[slot]],
+            "expire_time": self._expire[slot],
+            "last_seen": self._last_seen[slot]
+        }
+
+    def _item(self, slot):
+        return int_to_ip(self._ip[slot]), self._info(slot)
+
+    def _row(self, slot):
+        # 持久化 / 共享狀態用的扁平記錄，和 restore() 的輸入格式一致
+        return (int_to_ip(self._ip[slot]), self.locations.strings[self._loc[slot]], self._lat[slot],
+                self._lon[slot], self.apps.strings[self._app[slot]], self._last_seen[slot])
+
+    def _lru(self, newest_first=False, start=None):
+        nxt = self._prev if newest_first else self._next
+        slot = start if start is not None else (self._tail if newest_first else self._head)
+        while slot != -1:
+            yield slot
+            slot = nxt[slot]
+
+    def upsert(self, ip, location, lat, lon, app_name, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            slot = self._upsert(ip, location, lat, lon, app_name, now)
+            ip_info = self._info(slot)
+            self._evict_cache(now)
+        return ip_info
+
+    def upsert_many(self, items, now=None):
+        # items: [(ip, (location, lat, lon, app_name)), ...]；壞記錄跳過，返回跳過的條數
+        if now is None:
+            now = time.time()
+        rejected = 0
+        with self.lock:
+            for ip, (location, lat, lon, app_name) in items:
+                try:
+                    self._upsert(ip, location, lat, lon, app_name, now)
+                except ValueError:
+                    rejected += 1
+            self._evict_cache(now)
+        return rejected
+
+    def _upsert(self, ip, location, lat, lon, app_name, now):
+        ip_int, lat, lon, now = self._check_row(ip, location, lat, lon, app_name, now)
+        slot, was_live, old_lat, old_lon, before = self._write(ip_int, location, lat, lon, app_name, now)
+        self._set_live(slot, was_live, old_lat, old_lon, before)
+        self._record_change(ip_int)
+        return slot
+
+    def _record_change(self, ip_int):
+        self.version += 1
+        self._changes.append((self.version, ip_int))
+
+    def expire(self, now=None):
+        # 活躍段按過期時間排列，到期的都在前面，遇到第一個未到期的就停
+        if now is None:
+            now = time.time()
+        expired = []
+        with self.lock:
+            slot = self._live_head
+            while slot != -1:
+                if self._live[slot]:
+                    if self._expire[slot] >= now:
+                        break
+                    self._clear_live(slot)
+                    ip_int = self._ip[slot]
+                    expired.append(int_to_ip(ip_int))
+                    self._record_change(ip_int)
+                slot = self._next[slot]
+            self._live_head = slot
+            self.expired_count += len(expired)
+        return expired
+
+    def _evict_cache(self, now):
+        # 從最舊的開始淘汰；活躍IP不淘汰，等它過期
+        live = self._live
+        while len(self._slots) > self.cache_max_entries and self._head != -1 and not live[self._head]:
+            self._remove_slot(self._head)
+            self.evicted_size_count += 1
+        oldest_allowed = now - self.cache_max_age
+        while self._head != -1 and not live[self._head] and self._last_seen[self._head] < oldest_allowed:
+            self._remove_slot(self._head)
+            self.evicted_age_count += 1
+
+    def live_items(self):
+        with self.lock:
+            live = self._live
+            return [self._item(slot) for slot in self._lru(start=self._live_head) if live[slot]]
+
+    def cursor(self):
+        return f"{self.epoch}-{self.version}"
+
+    def _parse_cursor(self, cursor):
+        # cursor 不屬於本進程或已超出日誌範圍時返回 None
+        epoch, _, version = (cursor or "").partition("-")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        since = int(version)
+        oldest = self._changes[0][0] if self._changes else self.version + 1
+        if since > self.version or since < oldest - 1:
+            return None
+        return since
+
+    def _changed_ips(self, since):
+        # 從新到舊，每個IP只出現一次
+        seen = set()
+        for version, ip_int in reversed(self._changes):
+            if version <= since:
+                break
+            if ip_int not in seen:
+                seen.add(ip_int)
+                yield ip_int
+
+    def viewport(self, zoom, bbox):
+        # 低縮放級別返回 ("clusters", [[lat, lon, count], ...])，放大後返回 ("points", [(ip, info), ...])
+        with self.lock:
+            if zoom >= self.geo.point_zoom:
+                south, west, north, east = bbox
+                lat, lon = self._lat, self._lon
+                return "points", [self._item(slot) for slot in self.geo.query_points(*bbox)
+                                  if south <= lat[slot] <= north and west <= lon[slot] <= east]
+            return "clusters", self.geo.query_clusters(zoom, *bbox)
+
+    def changes_since(self, cursor):
+        # 返回 (updated, removed, new_cursor, reset)；reset=True 時 updated 為完整快照
+        with self.lock:
+            since = self._parse_cursor(cursor)
+            if since is None:
+                return self.live_items(), [], self.cursor(), True
+
+            updated = []
+            removed = []
+            for ip_int in self._changed_ips(since):
+                slot = self._slots.get(ip_int)
+                if slot is None or not self._live[slot]:
+                    removed.append(int_to_ip(ip_int))
+                else:
+                    updated.append(self._item(slot))
+            return updated, removed, self.cursor(), False
+
+    def cache_changes_since(self, cursor):
+        # 給持久化用：返回 since 之後變過的緩存條目（按 last_seen 從舊到新，restore() 的記錄格式）
+        # 和新 cursor；cursor 失效時返回 (None, cursor)，調用方需要重寫完整快照
+        with self.lock:
+            since = self._parse_cursor(cursor)
+            if since is None:
+                return None, self.cursor()
+            slots = self._slots
+            rows = [self._row(slots[ip_int]) for ip_int in self._changed_ips(since) if ip_int in slots]
+            rows.reverse()
+            return rows, self.cursor()
+
+    def snapshot(self):
+        # 完整緩存的 StoreSnapshot（帶 cursor），記錄在鎖外用 rows() 逐條生成
+        with self.lock:
+            return StoreSnapshot(self)
+
+    def restore(self, entries, now=None):
+        # entries: [(ip, location, lat, lon, app_name, last_seen), ...]，需按 last_seen 從舊到新；
+        # 壞記錄跳過，返回跳過的條數
+        if now is None:
+            now = time.time()
+        rejected = 0
+        with self.lock:
+            hint = -1
+            for ip, location, lat, lon, app_name, last_seen in entries:
+                try:
+                    ip_int, lat, lon, last_seen = self._check_row(ip, location, lat, lon, app_name, last_seen)
+                except ValueError:
+                    rejected += 1
+                    continue
+                slot = self._slots.get(ip_int)
+                if slot is not None and self._last_seen[slot] > last_seen:
+                    continue  # 後台載入時寫入端已經收到了更新的數據
+                slot, was_live, old_lat, old_lon, before = self._write(ip_int, location, lat, lon,
+                                                                       app_name, last_seen, hint)
+                hint = slot
+                if self._expire[slot] >= now:
+                    self._set_live(slot, was_live, old_lat, old_lon, before)
+                elif was_live:
+                    self._live[slot] = 0
+                    self.live_count -= 1
+                    self.geo.remove(slot, old_lat, old_lon)
+            self._evict_cache(now)
+        return rejected
+
+    def cache_items(self):
+        with self.lock:
+            self._evict_cache(time.time())
+            return [self._item(slot) for slot in self._lru()]
+
+    def cache_query(self, q=None, ip=None, location=None, app_name=None, sort='last_seen',
+                    descending=True, offset=0, limit=100):
+        # 返回 (total, [(ip, info), ...])
+        with self.lock:
+            self._evict_cache(time.time())
+            candidates = None
 
+            def narrow(matched):
+                nonlocal candidates
+                candidates = matched if candidates is None else candidates & matched
+
+            # IP 條件先用前綴桶縮小候選，地點 / app 條件再按列過濾
+            filters = []  # [(loc_ids, app_ids)]，命中任一即可
+            if q:
+                if IP_QUERY.match(q):
+                    narrow(self.index.match_ip(q, self._ip))
+                else:
+                    filters.append((self.index.location_ids(q), self.index.app_ids(q)))
+            if ip:
+                narrow(self.index.match_ip(ip, self._ip))
+            if location:
+                filters.append((self.index.location_ids(location), ()))
+            if app_name:
+                filters.append(((), self.index.app_ids(app_name)))
+            for loc_ids, app_ids in filters:
+                candidates = self._scan_columns(loc_ids, app_ids, candidates)
+
+            if sort == 'ip':
+                if candidates is None:
+                    total = len(self._slots)
+                    slots = self._cache_by_ip(descending, offset + limit)[offset:]
+                else:
+                    total = len(candidates)
+                    slots = sorted(candidates, key=self._ip.__getitem__, reverse=descending)[offset:offset + limit]
+                return total, [self._item(slot) for slot in slots]
+
+            ordered = self._lru(newest_first=descending)
+            if candidates is None:
+                return len(self._slots), [self._item(slot) for slot in islice(ordered, offset, offset + limit)]
+            total = len(candidates)
+            if total * 8 < len(self._slots):
+                ordered = sorted(candidates, key=self._last_seen.__getitem__, reverse=descending)
+                return total, [self._item(slot) for slot in ordered[offset:offset + limit]]
+            matched = (slot for slot in ordered if slot in candidates)
+            return total, [self._item(slot) for slot in islice(matched, offset, offset + limit)]
+
+    def _scan_columns(self, loc_ids, app_ids, candidates):
+        # 掃 _loc/_app 列；候選已經縮小時只檢查候選
+        if not loc_ids and not app_ids:
+            return set()
+        loc, app = self._loc, self._app
+        source = self._slots.values() if candidates is None else candidates
+        return {slot for slot in source if loc[slot] in loc_ids or app[slot] in app_ids}
+
+    def _cache_by_ip(self, descending, count):
+        # 按 /16 桶順序取，只排序需要的桶
+        slots = []
+        for key in sorted(self.index.prefix, reverse=descending):
+            slots.extend(sorted(self.index.prefix[key], key=self._ip.__getitem__, reverse=descending))
+            if len(slots) >= count:
+                break
+        return slots[:count]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "live_size": self.live_count,
+                "cache_size": len(self._slots),
+                "cache_max_entries": self.cache_max_entries,
+                "cache_max_age": self.cache_max_age,
+                "slots_allocated": len(self._live),
+                "slots_free": len(self._free),
+                "locations": len(self.locations),
+                "apps": len(self.apps),
+                "expired": self.expired_count,
+                "evicted_size": self.evicted_size_count,
+                "evicted_age": self.evicted_age_count,
+                "version": self.version,
+                "change_log_size": len(self._changes),
+            }
+
+
+class ReplicaIPStore(IPStore):
+    # web worker 裡的只讀副本：內容和 cursor（epoch + version）都跟隨寫入進程，
+    # 同一個 cursor 在任何 worker 上都有效；過期也由寫入進程決定並作為變更發布過來
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._apply_version = 0
+        self._floor = 0
+
+    def _record_change(self, ip_int):
+        # 一批變更共用寫入端的 version，不在本地遞增
+        self._changes.append((self._apply_version, ip_int))
+
+    def _parse_cursor(self, cursor):
+        # version 不連續：載入快照時的 version 以後都可以增量；日誌滿了之後最舊的一批可能不完整，從它開始算
+        epoch, _, version = (cursor or "").partition("-")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        since = int(version)
+        floor = self._changes[0][0] if len(self._changes) == self._changes.maxlen else self._floor
+        if since > self.version or since < floor:
+            return None
+        return since
+
+    def expire(self, now=None):
+        return []
+
+    def load(self, cursor, records, now=None):
+        # records: [(ip, location, lat, lon, app_name, last_seen), ...]，按 last_seen 從舊到新
+        epoch, _, version = cursor.partition("-")
+        with self.lock:
+            self._reset_storage()
+            self._changes.clear()
+            self.epoch = epoch
+            self.version = self._apply_version = self._floor = int(version)
+            self.restore(records, now)
+
+    def apply(self, prev_cursor, cursor, records, removed, now=None):
+        # 寫入端換了 epoch，或者這條變更之前還有沒收到的（流被裁剪），返回 False 讓調用方重新載入快照
+        epoch, _, version = cursor.partition("-")
+        prev_epoch, _, prev_version = (prev_cursor or "").partition("-")
+        with self.lock:
+            if epoch != self.epoch or (prev_epoch == epoch and int(prev_version) > self.version):
+                return False
+            self._apply_version = int(version)
+            for ip, location, lat, lon, app_name, last_seen in records:
+                self._upsert(ip, location, lat, lon, app_name, last_seen)
+            for ip in removed:
+                ip_int = ip_to_int(ip)
+                slot = self._slots.get(ip_int)
+                if slot is not None and self._live[slot]:
+                    self._clear_live(slot)
+                    self.expired_count += 1
+                self._record_change(ip_int)
+            self.version = max(self.version, self._apply_version)
+            self._evict_cache(now if now is not None else time.time())
+        return True
+
+
+ip_store = ReplicaIPStore() if GUI_ROLE == "web" else IPStore()
+
+
+class SSEClient:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+
+class UpdateBroadcaster:
+    # 每隔一個合併窗口從 IPStore 變更日誌取出增量（同一IP只保留最新一條），
+    # 推到每個瀏覽器自己的有界隊列；隊列滿的慢客戶端直接斷開，不會拖住寫入線程
+    def __init__(self, store, interval=SSE_COALESCE_SECONDS, client_queue_max=SSE_CLIENT_QUEUE_MAX):
+        self.store = store
+        self.interval = interval
+        self.client_queue_max = client_queue_max
+        self.lock = Lock()
+        self.clients = set()
+        self.cursor = store.cursor()
+        self.dropped_clients = 0
+        self.events_sent = 0
+
+    def register(self, include_snapshot=True):
+        client = SSEClient(self.client_queue_max)
+        with self.lock:
+            with self.store.lock:
+                snapshot = {"cursor": self.store.cursor()}
+                if include_snapshot:
+                    snapshot["sorted_ip_data"] = self.store.live_items()
+            client.queue.put_nowait(("snapshot", json.dumps(snapshot)))
+            self.clients.add(client)
+        return client
+
+    def unregister(self, client):
+        with self.lock:
+            self.clients.discard(client)
+        client.closed = True
+
+    def flush(self, now=None):
+        self.store.expire(now)
+        with self.lock:
+            updated, removed, self.cursor, reset = self.store.changes_since(self.cursor)
+            if not self.clients or not (updated or removed or reset):
+                return
+            event = "reset" if reset else "delta"
+            payload = json.dumps({"updated": updated, "removed": removed, "cursor": self.cursor})
+            for client in list(self.clients):
+                try:
+                    client.queue.put_nowait((event, payload))
+                    self.events_sent += 1
+                except queue.Full:
+                    self.clients.discard(client)
+                    client.closed = True
+                    self.dropped_clients += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"SSE flush failed: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "clients": len(self.clients),
+                "dropped_clients": self.dropped_clients,
+                "events_sent": self.events_sent,
+            }
+
+
+broadcaster = UpdateBroadcaster(ip_store)
+
+
+PRIVATE_RANGES = (
+    (0x0A000000, 0x0AFFFFFF),  # 10.0.0.0/8
+    (0xAC100000, 0xAC1FFFFF),  # 172.16.0.0/12
+    (0xC0A80000, 0xC0A8FFFF),  # 192.168.0.0/16
+)
+
+
+IPV4 = struct.Struct("!I")
+
+
+def ip_to_int(ip):
+    return IPV4.unpack(socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(IPV4.pack(value))
+
+
+@lru_cache(maxsize=IP_CLASSIFY_CACHE_SIZE)
 def is_private_ip(ip):
     try:
-        parts = list(map(int, ip.split('.')))
-    except:
-        return True
-    if parts[0] == 10:
-        return True
-    if parts[0] == 172 and 16 <= parts[1] <= 31:
-        return True
-    if parts[0] == 192 and parts[1] == 168:
+        value = ip_to_int(ip)
+    except (OSError, TypeError):
         return True
+    for start, end in PRIVATE_RANGES:
+        if start <= value <= end:
+            return True
     return False
 
 
-def update_ip_data():
-    r = redis.StrictRedis(host='127.0.0.1', port=6379, db=0)
-    pubsub = r.pubsub()
-    pubsub.subscribe('five_tuple_channel')
+class IngestStats:
+    # 最近 window 秒內的批次記錄，用來算吞吐量和延遲
+    def __init__(self, window=10.0):
+        self.lock = Lock()
+        self.window = window
+        self.started = time.time()
+        self.recent = deque()  # (time, messages, tuples, records)
+        self.messages = 0
+        self.tuples = 0
+        self.records = 0
+        self.batches = 0
+        self.decode_errors = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+        self.last_lag = None
+        self.max_lag = 0.0
+
+    def record(self, now, messages, records, decode_errors, elapsed, lag, tuples=None):
+        # 二進制格式一條消息帶多條五元組，tuples 單獨計；不傳時按一條消息一條算
+        if tuples is None:
+            tuples = messages
+        with self.lock:
+            self.messages += messages
+            self.tuples += tuples
+            self.records += records
+            self.batches += 1
+            self.decode_errors += decode_errors
+            self.last_batch_size = messages
+            self.last_batch_seconds = elapsed
+            if lag is not None:
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+            self.recent.append((now, messages, tuples, records))
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+
+    def record_failure(self, messages):
+        with self.lock:
+            self.messages += messages
+            self.decode_errors += messages
+            self.failed_batches += 1
+
+    def snapshot(self):
+        with self.lock:
+            span = min(self.window, max(time.time() - self.started, 1e-3))
+            return {
+                "messages": self.messages,
+                "tuples": self.tuples,
+                "records": self.records,
+                "batches": self.batches,
+                "decode_errors": self.decode_errors,
+                "failed_batches": self.failed_batches,
+                "messages_per_sec": sum(m for _, m, _, _ in self.recent) / span,
+                "tuples_per_sec": sum(t for _, _, t, _ in self.recent) / span,
+                "records_per_sec": sum(r for _, _, _, r in self.recent) / span,
+                "last_batch_size": self.last_batch_size,
+                "last_batch_seconds": self.last_batch_seconds,
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag,
+                "ip_classify_cache": is_private_ip.cache_info()._asdict(),
+            }
+
+
+ingest_stats = IngestStats()
+
+
+class TopCounter:
+    # key -> count，另外按 count 分桶並維護有序的不同 count 值，取 Top-N 時從最大的桶往下走，
+    # 不需要對所有 key 排序
+    def __init__(self):
+        self.counts = {}
+        self.by_count = {}
+        self.levels = []
+
+    def add(self, key, delta):
+        old = self.counts.get(key, 0)
+        new = old + delta
+        if old:
+            keys = self.by_count[old]
+            keys.discard(key)
+            if not keys:
+                del self.by_count[old]
+                del self.levels[bisect_left(self.levels, old)]
+        if new > 0:
+            self.counts[key] = new
+            keys = self.by_count.get(new)
+            if keys is None:
+                keys = self.by_count[new] = set()
+                insort(self.levels, new)
+            keys.add(key)
+        else:
+            self.counts.pop(key, None)
+
+    def top(self, n):
+        result = []
+        for count in reversed(self.levels):
+            for key in self.by_count[count]:
+                result.append((key, count))
+                if len(result) >= n:
+                    return result
+        return result
+
 
-    expire_time = 60
+class RollingWindow:
+    # span 秒的滑動窗口，由 span / bucket_seconds 個環形桶組成；
+    # 桶滑出窗口時把它的計數從 totals 裡減掉，每次更新的代價與運行時間無關
+    def __init__(self, span, bucket_seconds, dims):
+        self.span = span
+        self.bucket_seconds = bucket_seconds
+        self.slots = max(int(span // bucket_seconds), 1)
+        self.buckets = [None] * self.slots  # (total, {dim: Counter})
+        self.totals = {dim: TopCounter() for dim in dims}
+        self.total = 0
+        self.head = int(time.time() // bucket_seconds)
 
-    for message in pubsub.listen():
-        if message['type'] != 'message':
+    def advance(self, now):
+        bucket_id = int(now // self.bucket_seconds)
+        if bucket_id <= self.head:
+            return
+        steps = min(bucket_id - self.head, self.slots)
+        for bid in range(bucket_id - steps + 1, bucket_id + 1):
+            self._drop(bid % self.slots)
+        self.head = bucket_id
+
+    def _drop(self, slot):
+        bucket = self.buckets[slot]
+        if bucket is None:
+            return
+        total, counts = bucket
+        self.total -= total
+        for dim, counter in counts.items():
+            top_counter = self.totals[dim]
+            for key, count in counter.items():
+                top_counter.add(key, -count)
+        self.buckets[slot] = None
+
+    def add(self, now, total, counts):
+        self.advance(now)
+        slot = self.head % self.slots
+        bucket = self.buckets[slot]
+        if bucket is None:
+            bucket = self.buckets[slot] = [0, {dim: Counter() for dim in self.totals}]
+        bucket[0] += total
+        self.total += total
+        for dim, counter in counts.items():
+            bucket[1][dim].update(counter)
+            top_counter = self.totals[dim]
+            for key, count in counter.items():
+                top_counter.add(key, count)
+
+
+class TrafficStats:
+    def __init__(self, windows=STATS_WINDOWS, dims=STATS_DIMS):
+        self.lock = Lock()
+        self.started = time.time()
+        self.dims = dims
+        self.windows = [RollingWindow(span, bucket_seconds, dims) for span, bucket_seconds in windows]
+
+    def record(self, now, total, counts):
+        with self.lock:
+            for window in self.windows:
+                window.add(now, total, counts)
+
+    def window_for(self, span):
+        for window in self.windows:
+            if window.span >= span:
+                return window
+        return self.windows[-1]
+
+    def query(self, span, top_n, dims=None, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            window = self.window_for(span)
+            window.advance(now)
+            elapsed = min(window.span, max(now - self.started, 1e-3))
+            return {
+                "window": window.span,
+                "bucket_seconds": window.bucket_seconds,
+                "total": window.total,
+                "per_sec": window.total / elapsed,
+                "top": {dim: window.totals[dim].top(top_n) for dim in (dims or self.dims)},
+            }
+
+
+traffic_stats = TrafficStats()
+
+
+def decode_five_tuple_batch(raw):
+    # 解一條二進制批量消息，返回和 JSON 路徑相同形狀的行；記錄區用 iter_unpack 直接在
+    # memoryview 上解，不複製；格式錯誤統一拋 ValueError
+    view = memoryview(raw)
+    try:
+        magic, version, _flags, n_strings, n_records = FIVE_TUPLE_HEADER.unpack_from(view, 0)
+        if magic != FIVE_TUPLE_MAGIC or version != FIVE_TUPLE_VERSION:
+            raise ValueError(f"unsupported five-tuple batch {bytes(magic)!r} v{version}")
+        offset = FIVE_TUPLE_HEADER.size
+        strings = []
+        for _ in range(n_strings):
+            (length,) = FIVE_TUPLE_STRLEN.unpack_from(view, offset)
+            offset += FIVE_TUPLE_STRLEN.size
+            if offset + length > len(view):
+                raise ValueError("truncated string table")
+            strings.append(str(view[offset:offset + length], "utf-8"))
+            offset += length
+        end = offset + n_records * FIVE_TUPLE_RECORD.size
+        if end != len(view):
+            raise ValueError(f"record area is {len(view) - offset} bytes, expected {n_records} records")
+        ntoa = socket.inet_ntoa
+        return [
+            (IP_PROTOCOL_NAMES.get(proto, "UNKNOWN"), strings[app], ntoa(src), strings[src_loc],
+             src_lat / 1e6, src_lon / 1e6, ntoa(dst), strings[dst_loc], dst_lat / 1e6, dst_lon / 1e6, ts)
+            for (src, dst, _sport, _dport, src_lat, src_lon, dst_lat, dst_lon,
+                 src_loc, dst_loc, app, proto, ts) in FIVE_TUPLE_RECORD.iter_unpack(view[offset:end])
+        ]
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed five-tuple batch: {e}") from e
+
+
+def five_tuple_rows(payloads):
+    # 兩種格式都轉成 (protocol, app, src_ip, src_loc, src_lat, src_lon,
+    # dst_ip, dst_loc, dst_lat, dst_lon, ts)；JSON 每條消息一行，二進制每條消息多行
+    rows = []
+    decode_errors = 0
+    for raw in payloads:
+        if raw[:2] == FIVE_TUPLE_MAGIC:
+            try:
+                rows.extend(decode_five_tuple_batch(raw))
+            except ValueError:
+                decode_errors += 1
             continue
         try:
-            msg_data = json.loads(message['data'].decode('utf-8'))
-        except json.JSONDecodeError:
+            msg_data = json_loads(raw)
+        except ValueError:
+            decode_errors += 1
             continue
+        if not isinstance(msg_data, dict):
+            decode_errors += 1
+            continue
+        get = msg_data.get
+        ts = get("ts")
+        if isinstance(ts, bool) or not isinstance(ts, (int, float)):
+            ts = None  # 只用來算延遲，類型不對就當沒帶
+        rows.append((get("protocol", "UNKNOWN"), get("app", "UNKNOWN"),
+                     get("src_ip"), get("src_location", "Unknown"), get("src_lat", 0.0), get("src_lon", 0.0),
+                     get("dst_ip"), get("dst_location", "Unknown"), get("dst_lat", 0.0), get("dst_lon", 0.0),
+                     ts))
+    return rows, decode_errors
+
+
+def ingest_batch(payloads, now=None):
+    # 同一批裡同一個IP只保留最後一條，整批一次寫入 IPStore
+    if now is None:
+        now = time.time()
+    started = time.perf_counter()
+    latest = {}
+    oldest_ts = None
+    apps = []
+    protocols = []
+    locations = []
+    public_ips = []
+
+    rows, decode_errors = five_tuple_rows(payloads)
+    for (protocol, app_name, src_ip, src_loc, src_lat, src_lon,
+         dst_ip, dst_loc, dst_lat, dst_lon, ts) in rows:
+        if ts and (oldest_ts is None or ts < oldest_ts):
+            oldest_ts = ts
+        apps.append(app_name)
+        protocols.append(protocol)
+
+        if src_ip and not is_private_ip(src_ip):
+            latest[src_ip] = (src_loc, src_lat, src_lon, app_name)
+            public_ips.append(src_ip)
+            locations.append(src_loc)
+        if dst_ip and not is_private_ip(dst_ip):
+            latest[dst_ip] = (dst_loc, dst_lat, dst_lon, app_name)
+            public_ips.append(dst_ip)
+            locations.append(dst_loc)
+
+    # 坐標或字段類型不對的記錄在 IPStore 裡被跳過，也算作解碼錯誤
+    rejected = ip_store.upsert_many(latest.items(), now)
+    if apps:
+        traffic_stats.record(now, len(apps), {
+            "app": Counter(apps),
+            "protocol": Counter(protocols),
+            "location": Counter(locations),
+            "ip": Counter(public_ips),
+        })
+
+    lag = now - oldest_ts if oldest_ts is not None else None
+    ingest_stats.record(now, len(payloads), len(latest) - rejected, decode_errors + rejected,
+                        time.perf_counter() - started, lag, tuples=len(rows))
+    return len(latest) - rejected
+
+
+def ingest_batch_safely(payloads):
+    # 一批裡有解碼之外的意外錯誤時整批記為錯誤並繼續，不讓消費線程退出；返回是否成功
+    try:
+        ingest_batch(payloads)
+        return True
+    except Exception as e:
+        print(f"Dropped ingest batch of {len(payloads)} messages: {e!r}")
+        ingest_stats.record_failure(len(payloads))
+        return False
 
-        current_time = time.time()
-        src_ip = msg_data.get("src_ip")
-        dst_ip = msg_data.get("dst_ip")
-        app_name = msg_data.get("app", "UNKNOWN")
 
-        for ip_key in [("src", src_ip), ("dst", dst_ip)]:
-            ip_type, ip = ip_key
-            if not ip or is_private_ip(ip):
+def drain_messages(pubsub, max_batch=INGEST_BATCH_MAX, timeout=1.0):
+    # 阻塞等第一條，之後把已經到達的消息一次取完（最多 max_batch 條）
+    message = pubsub.get_message(timeout=timeout)
+    if message is None:
+        return []
+    batch = [message['data']]
+    while len(batch) < max_batch:
+        message = pubsub.get_message(timeout=0)
+        if message is None:
+            break
+        batch.append(message['data'])
+    return batch
+
+
+def update_ip_data():
+    while True:
+        try:
+            # client_name 讓 watchdog 能在 CLIENT LIST 裡認出這個訂閱者
+            r = redis.StrictRedis(host='127.0.0.1', port=6379, db=0, client_name='gui')
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe('five_tuple_channel')
+            while True:
+                batch = drain_messages(pubsub)
+                if batch:
+                    ingest_batch_safely(batch)
+        except redis.ConnectionError as e:
+            print(f"five_tuple_channel subscriber disconnected: {e}, reconnecting...")
+            time.sleep(1)
+        except Exception as e:
+            print(f"five_tuple_channel subscriber failed: {e!r}, resubscribing...")
+            time.sleep(1)
+
+
+stream_stats_lock = Lock()
+stream_stats = {"acked": 0, "replayed": 0, "claimed": 0, "trimmed": 0, "dead_lettered": 0}
+
+
+def count_stream_stat(name, n):
+    with stream_stats_lock:
+        stream_stats[name] += n
+
+
+def ensure_stream_group(r):
+    # 組從流的開頭建，第一次啟動時把流裡已有的消息也消費掉
+    try:
+        r.xgroup_create(STREAM_KEY, STREAM_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def ingest_stream_entries(r, entries):
+    # 先寫入再確認：崩潰時未確認的條目留在 PEL 裡，重啟後重放（至少一次，upsert 冪等）
+    ids = []
+    payloads = []
+    live_ids = []
+    for entry_id, fields in entries:
+        ids.append(entry_id)
+        data = fields.get(b'data') if fields else None
+        if data is None:
+            count_stream_stat("trimmed", 1)  # 已被 MAXLEN 裁掉，只剩 PEL 裡的 ID
+        else:
+            payloads.append(data)
+            live_ids.append(entry_id)
+    if payloads and not ingest_batch_safely(payloads):
+        dead_letter_entries(r, live_ids, payloads)
+    if ids:
+        r.xack(STREAM_KEY, STREAM_GROUP, *ids)
+        count_stream_stat("acked", len(ids))
+    return len(ids)
+
+
+def dead_letter_entries(r, ids, payloads):
+    # 原樣轉存，帶上原條目 ID，修好後可以從死信流重新投遞
+    pipe = r.pipeline(transaction=False)
+    for entry_id, data in zip(ids, payloads):
+        pipe.xadd(STREAM_DEAD_KEY, {"data": data, "id": entry_id},
+                  maxlen=STREAM_DEAD_MAXLEN, approximate=True)
+    pipe.execute()
+    count_stream_stat("dead_lettered", len(ids))
+
+
+def claim_idle_entries(r, consumer):
+    # 接管其他消費者空閒超過 STREAM_CLAIM_IDLE_MS 的待確認條目（它多半已經掛了）
+    start_id = '0-0'
+    while True:
+        result = r.xautoclaim(STREAM_KEY, STREAM_GROUP, consumer, STREAM_CLAIM_IDLE_MS,
+                              start_id=start_id, count=INGEST_BATCH_MAX)
+        start_id, entries = result[0], result[1]
+        if entries:
+            count_stream_stat("claimed", ingest_stream_entries(r, entries))
+        if start_id in (b'0-0', '0-0'):
+            return
+
+
+def stream_ingest(consumer):
+    # 消費者名穩定（主機名 + 序號），重啟後先用 ID 0 重放自己名下未確認的條目，再用 > 讀新消息
+    while True:
+        try:
+            r = redis.StrictRedis(host='127.0.0.1', port=6379, db=0, client_name='gui')
+            ensure_stream_group(r)
+            last_id = '0'
+            next_claim = time.monotonic()
+            while True:
+                if time.monotonic() >= next_claim:
+                    claim_idle_entries(r, consumer)
+                    next_claim = time.monotonic() + STREAM_CLAIM_INTERVAL
+                response = r.xreadgroup(STREAM_GROUP, consumer, {STREAM_KEY: last_id},
+                                        count=INGEST_BATCH_MAX, block=STREAM_BLOCK_MS)
+                entries = response[0][1] if response else []
+                if last_id != '>':
+                    if not entries:
+                        last_id = '>'
+                        continue
+                    last_id = entries[-1][0]
+                    count_stream_stat("replayed", len(entries))
+                ingest_stream_entries(r, entries)
+        except (redis.ConnectionError, redis.ResponseError) as e:
+            print(f"{STREAM_KEY} consumer {consumer} failed: {e}, reconnecting...")
+            time.sleep(1)
+        except Exception as e:
+            print(f"{STREAM_KEY} consumer {consumer} failed: {e!r}, restarting...")
+            time.sleep(1)
+
+
+class CachePersister:
+    # 快照 + 追加日誌：後台線程定期把 IPStore 變更日誌裡的緩存條目追加到 delta 文件，
+    # 到時間或 delta 太大時重寫完整快照並清空 delta。寫入線程只在取變更時短暫持有鎖
+    def __init__(self, store, path=PERSIST_DIR, flush_interval=PERSIST_FLUSH_INTERVAL,
+                 snapshot_interval=PERSIST_SNAPSHOT_INTERVAL, compact_bytes=PERSIST_COMPACT_BYTES):
+        self.store = store
+        self.path = path
+        self.snapshot_path = os.path.join(path, 'ip_cache.snapshot')
+        self.delta_path = os.path.join(path, 'ip_cache.delta')
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.compact_bytes = compact_bytes
+        self.cursor = store.cursor()
+        self.last_flush = 0.0
+        self.delta_file = None
+        self.delta_bytes = 0
+        self.snapshots_written = 0
+        self.last_snapshot_seconds = 0.0
+        self.overflow_flushes = 0
+        self.last_overflow = 0.0
+        self.load_seconds = 0.0
+        self.loaded = 0
+        self.skipped = 0
+        self.loading = False
+        self.on_loaded = None  # 載入完成後的回調（ingest 角色用來重發共享快照）
+
+    def load(self):
+        # 和消費線程並行執行：cursor 取載入之前的，載入期間收到的變更由第一次 flush 寫出；
+        # restore() 跳過比緩存裡更舊的記錄，不會覆蓋剛收到的數據
+        started = time.perf_counter()
+        self.loading = True
+        cursor = self.store.cursor()
+        self.last_flush = time.time()
+        # 不動 GC：載入和消費線程、請求並行，關掉 GC 或 freeze 會影響整個進程；
+        # 緩存存在 array 列裡，載入產生的長期對象很少
+        try:
+            self._load_files()
+        finally:
+            self.loading = False
+        self.cursor = cursor
+        self.load_seconds = time.perf_counter() - started
+        print(f"Restored {self.loaded} cached IP records in {self.load_seconds:.2f}s"
+              + (f", skipped {self.skipped} malformed lines" if self.skipped else ""))
+        if self.on_loaded:
+            self.on_loaded()
+
+    def _load_files(self):
+        for file_path in (self.snapshot_path, self.delta_path):
+            if not os.path.exists(file_path):
                 continue
-            lat = msg_data.get(f"{ip_type}_lat", 0.0)
-            lon = msg_data.get(f"{ip_type}_lon", 0.0)
-            location = msg_data.get(f"{ip_type}_location", "Unknown")
-
-            ip_info = {
-                "location": location,
-                "lat": lat,
-                "lon": lon,
-                "app": app_name,
-                "expire_time": current_time + expire_time,
-                "last_seen": current_time
-            }
-            live_ip_data[ip] = ip_info
-            cached_ip_data[ip] = ip_info
+            batch = []
+            with open(file_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json_loads(line)
+                    except ValueError:
+                        self.skipped += 1  # 進程被殺時最後一行可能不完整
+                        continue
+                    if not isinstance(record, list) or not record:
+                        self.skipped += 1
+                    elif record[0] == 'c' and len(record) == 7:
+                        batch.append(record[1:])
+                        if len(batch) >= 2000:  # 每批持鎖時間短，不卡住並行的消費線程
+                            self._restore(batch)
+                            batch = []
+                    elif record[0] == 's' and len(record) == 3 and isinstance(record[1], str) \
+                            and isinstance(record[2], dict):
+                        port_scan_results[record[1]] = record[2]
+                    else:
+                        self.skipped += 1
+            self._restore(batch)
+
+    def _restore(self, batch):
+        # 字段類型或坐標不對的記錄由 restore() 跳過
+        rejected = self.store.restore(batch)
+        self.loaded += len(batch) - rejected
+        self.skipped += rejected
+
+    def _set_aside(self):
+        # 載入失敗時把文件改名保留，否則下一次寫快照會用不完整的緩存覆蓋它們
+        for file_path in (self.snapshot_path, self.delta_path):
+            try:
+                os.replace(file_path, file_path + '.failed')
+            except OSError:
+                pass
+
+    @staticmethod
+    def _encode_entry(row):
+        # row: (ip, location, lat, lon, app_name, last_seen)
+        return json_dumps(["c", *row]) + b"\n"
+
+    def _scan_lines(self, since):
+        for ip, result in list(port_scan_results.items()):
+            if result.get("timestamp", 0) > since:
+                yield json_dumps(["s", ip, result]) + b"\n"
+
+    def flush(self):
+        now = time.time()
+        entries, cursor = self.store.cache_changes_since(self.cursor)
+        if entries is None:
+            # 兩次 flush 之間的變更超過了日誌長度：不重寫完整快照，在鎖外拷貝上取
+            # last_seen 在上次 flush 之後的尾段寫 delta。高負載下每次都會溢出，所以按
+            # PERSIST_OVERFLOW_INTERVAL 限頻，期間的變更合併到下一次（同一IP只寫一次）
+            if now - self.last_overflow < PERSIST_OVERFLOW_INTERVAL:
+                return
+            snapshot = self.store.snapshot()
+            entries, cursor = snapshot.rows(since=self.last_flush - PERSIST_CLOCK_SLACK), snapshot.cursor
+            self.overflow_flushes += 1
+            self.last_overflow = now
+        lines = [self._encode_entry(row) for row in entries]
+        lines.extend(self._scan_lines(self.last_flush))
+        self.cursor = cursor
+        self.last_flush = now
+        if not lines:
+            return
+        if self.delta_file is None:
+            self.delta_file = open(self.delta_path, 'ab')
+        data = b"".join(lines)
+        self.delta_file.write(data)
+        self.delta_file.flush()
+        self.delta_bytes += len(data)
+
+    def write_snapshot(self):
+        started = time.perf_counter()
+        now = time.time()
+        snapshot = self.store.snapshot()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            lines = []
+            for row in snapshot.rows():
+                lines.append(self._encode_entry(row))
+                if len(lines) >= 10000:
+                    f.write(b"".join(lines))
+                    lines = []
+            lines.extend(self._scan_lines(0))
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # 快照已包含 cursor 之前的所有變更，delta 從頭開始
+        if self.delta_file is not None:
+            self.delta_file.close()
+        self.delta_file = open(self.delta_path, 'wb')
+        self.delta_bytes = 0
+        self.cursor = snapshot.cursor
+        self.last_flush = now
+        self.snapshots_written += 1
+        self.last_snapshot_seconds = time.perf_counter() - started
+
+    def run(self):
+        # 載入失敗不能讓線程退出，否則之後的變更都不會再落盤
+        try:
+            self.load()
+        except Exception as e:
+            print(f"Cache restore from {self.path} failed: {e!r}, starting with what was loaded")
+            self._set_aside()
+        os.makedirs(self.path, exist_ok=True)
+        last_snapshot = time.time()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - last_snapshot >= self.snapshot_interval or self.delta_bytes >= self.compact_bytes:
+                    self.write_snapshot()
+                    last_snapshot = time.time()
+            except Exception as e:
+                print(f"Cache persistence failed: {e!r}")
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "loaded": self.loaded,
+            "skipped": self.skipped,
+            "loading": self.loading,
+            "load_seconds": round(self.load_seconds, 3),
+            "delta_bytes": self.delta_bytes,
+            "snapshots_written": self.snapshots_written,
+            "last_snapshot_seconds": round(self.last_snapshot_seconds, 3),
+            "overflow_flushes": self.overflow_flushes,
+        }
+
+
+persister = CachePersister(ip_store)
+
+
+def shared_record(ip, ip_info):
+    return [ip, ip_info["location"], ip_info["lat"], ip_info["lon"], ip_info["app"], ip_info["last_seen"]]
+
+
+class SharedStatePublisher:
+    # 寫入端（GUI_ROLE=ingest）：每隔 interval 把 IPStore 的變更（更新後的完整記錄 + 過期的IP）
+    # XADD 到 gui:changes；定期把完整緩存寫成 gui:snapshot 給新啟動的 web worker 引導；
+    # 統計（ingest / traffic Top-N / store）寫到 gui:published_stats
+    def __init__(self, store, interval=SHARED_PUBLISH_INTERVAL, snapshot_interval=SHARED_SNAPSHOT_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.cursor = None
+        self.next_snapshot = 0.0
+        self.next_stats = 0.0
+        self.entries_published = 0
+        self.records_published = 0
+        self.snapshots_published = 0
+        self.last_snapshot_seconds = 0.0
+        self.last_snapshot_bytes = 0
+
+    def publish_changes(self, r, now):
+        self.store.expire(now)
+        prev_cursor = self.cursor
+        updated, removed, cursor, reset = self.store.changes_since(prev_cursor)
+        self.cursor = cursor
+        if reset:
+            # 第一次或日誌已經追不上：直接發完整快照，副本重新引導
+            self.next_snapshot = 0.0
+            return
+        if not updated and not removed:
+            return
+        records = [shared_record(ip, ip_info) for ip, ip_info in updated]
+        pipe = r.pipeline(transaction=False)
+        chunks = range(0, max(len(records), 1), SHARED_RECORDS_PER_ENTRY)
+        for start in chunks:
+            pipe.xadd(SHARED_CHANGES_KEY, {
+                "p": prev_cursor,
+                "c": cursor,
+                "u": json_dumps(records[start:start + SHARED_RECORDS_PER_ENTRY]),
+                "r": json_dumps(removed if start == 0 else []),
+            }, maxlen=SHARED_CHANGES_MAXLEN, approximate=True)
+        pipe.execute()
+        self.entries_published += len(chunks)
+        self.records_published += len(records) + len(removed)
+
+    def request_snapshot(self):
+        self.next_snapshot = 0.0
+
+    def publish_snapshot(self, r):
+        # 先記下流的最後一條 ID，副本載入快照後從它之後開始追；之後的變更都不早於快照內容。
+        # 鎖內只拷貝列（StoreSnapshot），序列化在鎖外；記錄按 SHARED_SNAPSHOT_CHUNK 條一塊寫進
+        # 新代號的哈希，全部寫完才切換 gui:snapshot，舊哈希設過期而不是立刻刪。
+        # 寫的過程中新哈希也帶過期時間，寫入端中途掛掉不會留下孤兒鍵，切換時再 PERSIST
+        started = time.perf_counter()
+        last = r.xrevrange(SHARED_CHANGES_KEY, count=1)
+        stream_id = last[0][0] if last else b"0-0"
+        snapshot = self.store.snapshot()
+        data_key = f"{SHARED_SNAPSHOT_KEY}:{snapshot.cursor}.{self.snapshots_published}"
+        pipe = r.pipeline(transaction=False)
+        chunks = 0
+        total_bytes = 0
+        records = []
+
+        def write_chunk():
+            nonlocal chunks, total_bytes
+            chunk = json_dumps(records)
+            pipe.hset(data_key, str(chunks), chunk)
+            pipe.expire(data_key, SHARED_SNAPSHOT_GRACE)
+            chunks += 1
+            total_bytes += len(chunk)
+            if chunks % 16 == 0:
+                pipe.execute()
+
+        for row in snapshot.rows():
+            records.append(row)
+            if len(records) >= SHARED_SNAPSHOT_CHUNK:
+                write_chunk()
+                records = []
+        if records or not chunks:
+            write_chunk()
+        pipe.execute()
+
+        previous = r.get(SHARED_SNAPSHOT_KEY)
+        meta = json_dumps({
+            "cursor": snapshot.cursor,
+            "stream_id": stream_id.decode() if isinstance(stream_id, bytes) else stream_id,
+            "key": data_key,
+            "chunks": chunks,
+            "records": len(snapshot),
+        })
+        pipe = r.pipeline(transaction=False)
+        pipe.persist(data_key)
+        pipe.set(SHARED_SNAPSHOT_KEY, meta)
+        if previous:
+            try:
+                previous_key = json_loads(previous).get("key")
+            except (ValueError, AttributeError):
+                previous_key = None
+            if previous_key and previous_key != data_key:
+                pipe.expire(previous_key, SHARED_SNAPSHOT_GRACE)
+        pipe.execute()
+        self.snapshots_published += 1
+        self.last_snapshot_bytes = total_bytes
+        self.last_snapshot_seconds = time.perf_counter() - started
+
+    def publish_stats(self, r, now):
+        r.set(SHARED_STATS_KEY, json_dumps({
+            "published_at": now,
+            "ingest": ingest_stats.snapshot(),
+            "traffic": [traffic_stats.query(span, SHARED_STATS_TOP, now=now) for span, _ in STATS_WINDOWS],
+            "store": self.store.stats(),
+            "publisher": self.stats(),
+        }))
+
+    def run(self):
+        while True:
+            try:
+                r = redis.StrictRedis(host='127.0.0.1', port=6379, db=0, client_name='gui-ingest')
+                while True:
+                    now = time.time()
+                    self.publish_changes(r, now)
+                    if time.monotonic() >= self.next_snapshot:
+                        self.publish_snapshot(r)
+                        self.next_snapshot = time.monotonic() + self.snapshot_interval
+                    if time.monotonic() >= self.next_stats:
+                        self.publish_stats(r, now)
+                        self.next_stats = time.monotonic() + SHARED_STATS_INTERVAL
+                    time.sleep(self.interval)
+            except redis.ConnectionError as e:
+                print(f"Shared state publisher disconnected: {e}, reconnecting...")
+                self.cursor = None
+                time.sleep(1)
+
+    def stats(self):
+        return {
+            "cursor": self.cursor,
+            "entries_published": self.entries_published,
+            "records_published": self.records_published,
+            "snapshots_published": self.snapshots_published,
+            "last_snapshot_seconds": round(self.last_snapshot_seconds, 3),
+            "last_snapshot_bytes": self.last_snapshot_bytes,
+        }
+
+
+class SharedStateReplica:
+    # web 端：從 gui:snapshot 引導 ReplicaIPStore，再 XREAD 追 gui:changes；
+    # 寫入端重啟（epoch 變了）或流被裁剪導致缺變更時重新載入快照
+    def __init__(self, store):
+        self.store = store
+        self.last_id = None
+        self.entries_applied = 0
+        self.snapshots_loaded = 0
+        self.published = {}
+        self.next_stats = 0.0
+
+    def load_snapshot(self, r):
+        # 逐塊讀 gui:snapshot:<代號>；中途被寫入端替換並過期掉了（缺塊）就返回 False 重試
+        raw = r.get(SHARED_SNAPSHOT_KEY)
+        if raw is None:
+            return False
+        meta = json_loads(raw)
+        if "key" not in meta:
+            return False  # 舊版本寫入端的單值快照，等它發新格式
+        records = []
+        for i in range(meta["chunks"]):
+            chunk = r.hget(meta["key"], str(i))
+            if chunk is None:
+                return False
+            records.extend(json_loads(chunk))
+        self.store.load(meta["cursor"], records)
+        self.last_id = meta["stream_id"]
+        self.snapshots_loaded += 1
+        return True
+
+    def refresh_stats(self, r):
+        raw = r.get(SHARED_STATS_KEY)
+        if raw is not None:
+            self.published = json_loads(raw)
+
+    def run(self):
+        while True:
+            try:
+                r = redis.StrictRedis(host='127.0.0.1', port=6379, db=0, client_name='gui-web')
+                while not self.load_snapshot(r):
+                    time.sleep(1)
+                while True:
+                    response = r.xread({SHARED_CHANGES_KEY: self.last_id}, count=100, block=1000)
+                    for _, entries in response or []:
+                        for entry_id, fields in entries:
+                            prev_cursor = fields.get(b"p", b"").decode()
+                            applied = self.store.apply(prev_cursor, fields[b"c"].decode(),
+                                                       json_loads(fields[b"u"]), json_loads(fields[b"r"]))
+                            if not applied:
+                                time.sleep(0.5)
+                                while not self.load_snapshot(r):
+                                    time.sleep(1)
+                                break
+                            self.last_id = entry_id
+                            self.entries_applied += 1
+                    if time.monotonic() >= self.next_stats:
+                        self.refresh_stats(r)
+                        self.next_stats = time.monotonic() + SHARED_STATS_INTERVAL
+            except redis.ConnectionError as e:
+                print(f"Shared state replica disconnected: {e}, reconnecting...")
+                time.sleep(1)
+
+    def traffic_query(self, span, top_n, dims=None):
+        windows = self.published.get("traffic") or []
+        if not windows:
+            return {"window": span, "bucket_seconds": None, "total": 0, "per_sec": 0.0, "top": {}}
+        window = next((w for w in windows if w["window"] >= span), windows[-1])
+        result = dict(window)
+        result["top"] = {dim: window["top"].get(dim, [])[:top_n] for dim in (dims or STATS_DIMS)}
+        return result
+
+    def stats(self):
+        return {
+            "last_id": self.last_id.decode() if isinstance(self.last_id, bytes) else self.last_id,
+            "entries_applied": self.entries_applied,
+            "snapshots_loaded": self.snapshots_loaded,
+            "published_at": self.published.get("published_at"),
+        }
+
+
+class IngestLeader:
+    # 保證只有一個寫入進程：SET NX PX 搶鎖，持有期間定期續期；
+    # 續不上（鎖過期被別人拿走）就立刻退出，讓 supervisor 把它重啟成備用進程
+    RENEW_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                    "return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0")
+
+    def __init__(self, key=SHARED_LEADER_KEY, ttl=SHARED_LEADER_TTL):
+        self.key = key
+        self.ttl = ttl
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}"
+        self.r = redis.StrictRedis(host='127.0.0.1', port=6379, db=0)
+
+    def acquire(self):
+        waiting = False
+        while True:
+            try:
+                if self.r.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)):
+                    print(f"Ingest leadership acquired ({self.token})")
+                    return
+                if not waiting:
+                    print(f"Another ingest writer holds {self.key}, waiting as standby...")
+                    waiting = True
+            except redis.ConnectionError as e:
+                print(f"Leader election failed: {e}")
+            time.sleep(self.ttl / 3)
+
+    def hold(self):
+        renew = self.r.register_script(self.RENEW_SCRIPT)
+        last_renewed = time.monotonic()
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                if not renew(keys=[self.key], args=[self.token, int(self.ttl * 1000)]):
+                    print("Ingest leadership lost, exiting")
+                    os._exit(1)
+                last_renewed = time.monotonic()
+            except redis.ConnectionError as e:
+                if time.monotonic() - last_renewed >= self.ttl:
+                    print(f"Could not renew ingest leadership: {e}, exiting")
+                    os._exit(1)
+
+
+shared_publisher = SharedStatePublisher(ip_store)
+shared_replica = SharedStateReplica(ip_store)
 
 
 @app.route('/')
@@ -81,16 +1902,215 @@ def index():
 
 @app.route('/get_ip_data')
 def get_ip_data():
+    # bbox=south,west,north,east&zoom=z：按視野返回聚類或單點；
+    # since=<cursor>：只返回變更，帶 bbox 時 updated 只包含視野內的IP
     current_time = time.time()
-    expired_ips = [ip for ip, data in live_ip_data.items() if current_time > data['expire_time']]
-    for ip in expired_ips:
-        del live_ip_data[ip]
-    return jsonify(sorted_ip_data=list(live_ip_data.items()), current_time=current_time)
+    ip_store.expire(current_time)
+    since = request.args.get('since')
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            bbox = [float(v) for v in bbox.split(',')]
+            zoom = float(request.args.get('zoom', 0))
+            if len(bbox) != 4:
+                raise ValueError("bbox must be south,west,north,east")
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+
+    if since is None:
+        with ip_store.lock:
+            cursor = ip_store.cursor()
+            if not bbox:
+                return jsonify(sorted_ip_data=ip_store.live_items(), cursor=cursor, current_time=current_time)
+            mode, items = ip_store.viewport(zoom, bbox)
+        if mode == "clusters":
+            return jsonify(mode=mode, clusters=items, cursor=cursor, current_time=current_time)
+        return jsonify(mode=mode, sorted_ip_data=items, cursor=cursor, current_time=current_time)
+
+    updated, removed, cursor, reset = ip_store.changes_since(since)
+    if bbox:
+        south, west, north, east = bbox
+        updated = [(ip, ip_info) for ip, ip_info in updated
+                   if south <= ip_info["lat"] <= north and west <= ip_info["lon"] <= east]
+    return jsonify(updated=updated, removed=removed, cursor=cursor, reset=reset,
+                   current_time=current_time)
+
+
+@app.route('/stream')
+def stream():
+    # snapshot=0 時首個事件只帶 cursor，頁面自己按視野拉數據
+    client = broadcaster.register(request.args.get('snapshot') != '0')
+
+    def generate():
+        try:
+            while not client.closed:
+                try:
+                    event, payload = client.queue.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {payload}\n\n"
+        finally:
+            broadcaster.unregister(client)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stats')
+def get_stats():
+    try:
+        window = float(request.args.get('window', 300))
+        top_n = min(max(int(request.args.get('top', 10)), 1), 1000)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    dims = [d for d in request.args.get('dim', '').split(',') if d]
+    unknown = [d for d in dims if d not in STATS_DIMS]
+    if unknown:
+        return jsonify(error=f"Unknown dim {unknown}, expected one of {list(STATS_DIMS)}"), 400
+    if GUI_ROLE == "web":
+        return jsonify(shared_replica.traffic_query(window, top_n, dims or None))
+    return jsonify(traffic_stats.query(window, top_n, dims or None))
+
+
+@app.route('/ingest_stats')
+def get_ingest_stats():
+    stats = dict(shared_replica.published.get("ingest", {})) if GUI_ROLE == "web" else ingest_stats.snapshot()
+    stats["transport"] = FIVE_TUPLE_TRANSPORT
+    if FIVE_TUPLE_TRANSPORT in ("stream", "both"):
+        with stream_stats_lock:
+            stats["stream"] = dict(stream_stats, key=STREAM_KEY, group=STREAM_GROUP, dead_key=STREAM_DEAD_KEY,
+                                   consumers=[f"{STREAM_CONSUMER}-{i}" for i in range(STREAM_WORKERS)])
+    return jsonify(stats)
 
 
 @app.route('/all_cache')
 def all_cache():
-    return jsonify(all_data=list(cached_ip_data.items()))
+    # 不帶參數時保持原來的全量輸出；帶 page/page_size/q/ip/location/app/sort 時分頁查詢
+    args = request.args
+    if not args:
+        return jsonify(all_data=ip_store.cache_items())
+    try:
+        page = max(int(args.get('page', 1)), 1)
+        page_size = min(max(int(args.get('page_size', 100)), 1), CACHE_PAGE_SIZE_MAX)
+        total, items = ip_store.cache_query(
+            q=args.get('q', '').strip(),
+            ip=args.get('ip', '').strip(),
+            location=args.get('location', '').strip(),
+            app_name=args.get('app', '').strip(),
+            sort=args.get('sort', 'last_seen'),
+            descending=args.get('order', 'desc') != 'asc',
+            offset=(page - 1) * page_size,
+            limit=page_size,
+        )
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(total=total, page=page, page_size=page_size, items=items)
+
+
+@app.route('/store_stats')
+def store_stats():
+    stats = ip_store.stats()
+    stats["stream"] = broadcaster.stats()
+    stats["persistence"] = persister.stats() if PERSIST_ENABLED and GUI_ROLE != "web" else None
+    stats["role"] = GUI_ROLE
+    if GUI_ROLE == "web":
+        stats["shared"] = shared_replica.stats()
+    elif GUI_ROLE == "ingest":
+        stats["shared"] = shared_publisher.stats()
+    return jsonify(stats)
+
+
+def parse_ports(value, default=None):
+    if not value:
+        return list(default if default is not None else SCAN_PORTS)
+    ports = sorted({int(p) for p in str(value).split(',') if p.strip()})
+    if not ports or ports[0] < 1 or ports[-1] > 65535 or len(ports) > SCAN_MAX_PORTS:
+        raise ValueError(f"ports must be 1-{SCAN_MAX_PORTS} values in 1..65535")
+    return ports
+
+
+async def _probe_port(ip, port, semaphore, connect_timeout, started):
+    async with semaphore:
+        started.set()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return port
+
+
+async def _scan_host(ip, ports, semaphore, connect_timeout, host_timeout, found):
+    # host_timeout 從該IP第一個探測拿到 semaphore 才開始算，排隊時間不計入
+    # found 隨探測完成逐個記錄開放端口，總超時被取消時也能拿到部分結果
+    started = asyncio.Event()
+    tasks = [asyncio.ensure_future(_probe_port(ip, port, semaphore, connect_timeout, started)) for port in ports]
+    for task in tasks:
+        task.add_done_callback(
+            lambda t: found.append(t.result()) if not t.cancelled() and not t.exception()
+            and t.result() is not None else None)
+    await started.wait()
+    done, pending = await asyncio.wait(tasks, timeout=host_timeout)
+    for task in pending:
+        task.cancel()
+    open_ports = sorted(t.result() for t in done if not t.exception() and t.result() is not None)
+    return ip, open_ports, bool(pending)
+
+
+async def scan_hosts(ips, ports, on_result=None, concurrency=SCAN_CONCURRENCY,
+                     connect_timeout=SCAN_CONNECT_TIMEOUT, host_timeout=SCAN_HOST_TIMEOUT,
+                     total_timeout=SCAN_TOTAL_TIMEOUT):
+    # 所有IP的所有端口並行探測，semaphore 限制全局同時連接數
+    semaphore = asyncio.Semaphore(concurrency)
+    found = {ip: [] for ip in ips}
+    tasks = [asyncio.ensure_future(_scan_host(ip, ports, semaphore, connect_timeout, host_timeout, found[ip]))
+             for ip in ips]
+    results = []
+    finished = set()
+    try:
+        for fut in asyncio.as_completed(tasks, timeout=total_timeout):
+            ip, open_ports, timed_out = await fut
+            result = record_scan_result(ip, open_ports, ports, timed_out)
+            finished.add(ip)
+            results.append(result)
+            if on_result:
+                on_result(result)
+    except asyncio.TimeoutError:
+        for task in tasks:
+            task.cancel()
+        for ip in ips:
+            if ip in finished:
+                continue
+            result = record_scan_result(ip, sorted(found[ip]), ports, timed_out=True)
+            results.append(result)
+            if on_result:
+                on_result(result)
+    return results
+
+
+def record_scan_result(ip, open_ports, ports, timed_out=False):
+    result = {
+        "ip": ip,
+        "open_ports": open_ports,
+        "ports": ports,
+        "timed_out": timed_out,
+        "timestamp": time.time(),
+    }
+    port_scan_results[ip] = result
+    return result
+
+
+def cached_scan_result(ip, ports, max_age):
+    result = port_scan_results.get(ip)
+    if (result and not result["timed_out"] and time.time() - result["timestamp"] <= max_age
+            and set(ports) <= set(result["ports"])):
+        return result
+    return None
 
 
 @app.route('/scan')
@@ -98,25 +2118,201 @@ def scan_ports():
     target_ip = request.args.get('ip')
     if not target_ip:
         return jsonify(error="Missing IP"), 400
+    try:
+        ports = parse_ports(request.args.get('ports'))
+        max_age = float(request.args.get('max_age', SCAN_RESULT_MAX_AGE))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    cached = cached_scan_result(target_ip, ports, max_age)
+    if cached:
+        open_ports = [p for p in cached["open_ports"] if p in ports]
+        return jsonify(ip=target_ip, open_ports=open_ports, timestamp=cached["timestamp"], cached=True)
 
-    common_ports = [22, 23, 25, 53, 80, 443, 8080, 3389]
-    open_ports = []
+    result = asyncio.run(scan_hosts([target_ip], ports))[0]
+    return jsonify(ip=target_ip, open_ports=result["open_ports"], timestamp=result["timestamp"],
+                   timed_out=result["timed_out"], cached=False)
 
-    for port in common_ports:
+
+@app.route('/scan_bulk', methods=['GET', 'POST'])
+def scan_bulk():
+    # 返回 NDJSON，每掃完一個IP輸出一行
+    body = request.get_json(silent=True) or {}
+    if request.args.get('live') or body.get('live'):
+        ips = [ip for ip, _ in ip_store.live_items()]
+    else:
+        ips = body.get('ips') or [ip for ip in request.args.get('ips', '').split(',') if ip]
+    ips = list(dict.fromkeys(ips))
+    if not ips:
+        return jsonify(error="Missing IPs"), 400
+    if len(ips) > SCAN_BULK_MAX_IPS:
+        return jsonify(error=f"Too many IPs (max {SCAN_BULK_MAX_IPS})"), 400
+    ports_arg = body.get('ports') or request.args.get('ports')
+    if isinstance(ports_arg, list):
+        ports_arg = ','.join(map(str, ports_arg))
+    try:
+        ports = parse_ports(ports_arg)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    results = queue.Queue()
+    done = object()
+
+    def run_scan():
         try:
-            with socket.create_connection((target_ip, port), timeout=0.5):
-                open_ports.append(port)
-        except:
-            continue
+            asyncio.run(scan_hosts(ips, ports, on_result=results.put))
+        except Exception as e:
+            results.put({"error": str(e)})
+        finally:
+            results.put(done)
 
-    port_scan_results[target_ip] = open_ports
-    return jsonify(ip=target_ip, open_ports=open_ports)
+    Thread(target=run_scan, daemon=True).start()
 
+    def generate():
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            yield json.dumps(item) + "\n"
 
-@app.route('/banner')
-def banner_grab():
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+class _Flight:
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.timestamp = None
+
+
+class EnrichmentCache:
+    # 以 (endpoint, ip) 為鍵的 TTL + LRU 緩存；同一個鍵同時只跑一次探測，其餘請求等結果
+    def __init__(self, ttls, max_entries=ENRICH_CACHE_MAX_ENTRIES, default_ttl=300.0,
+                 error_ttl=ENRICH_ERROR_TTL, wait_timeout=ENRICH_WAIT_TIMEOUT):
+        self.lock = Lock()
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.error_ttl = error_ttl
+        self.wait_timeout = wait_timeout
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (endpoint, ip) -> (timestamp, result)
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.wait_timeouts = 0
+        self.evicted = 0
+
+    def _ttl(self, endpoint, result):
+        ttl = self.ttls.get(endpoint, self.default_ttl)
+        if isinstance(result, dict) and "error" in result:
+            return min(ttl, self.error_ttl)
+        return ttl
+
+    def get_or_compute(self, endpoint, ip, compute, refresh=False):
+        # 返回 (result, "hit" | "miss" | "coalesced" | "timeout", age)
+        key = (endpoint, ip)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not refresh:
+                timestamp, result = entry
+                age = time.time() - timestamp
+                if age <= self._ttl(endpoint, result):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result, "hit", age
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.event.wait(self.wait_timeout):
+                with self.lock:
+                    self.wait_timeouts += 1
+                return {"ip": ip, "error": f"{endpoint} still running after {self.wait_timeout:.0f}s"}, \
+                    "timeout", 0.0
+            return flight.result, "coalesced", time.time() - flight.timestamp
+
+        # finally 保證等待者一定被喚醒、inflight 一定被清掉，否則這個鍵之後的請求都會卡住
+        try:
+            flight.result = compute()
+        except Exception as e:
+            flight.result = {"ip": ip, "error": str(e)}
+        finally:
+            if flight.result is None:
+                flight.result = {"ip": ip, "error": f"{endpoint} was interrupted"}
+            flight.timestamp = time.time()
+            with self.lock:
+                self.inflight.pop(key, None)
+                self._store(key, flight.timestamp, flight.result)
+            flight.event.set()
+        return flight.result, "miss", 0.0
+
+    def get_fresh(self, endpoint, ip):
+        # 只讀緩存，不觸發探測；返回 (result, age) 或 None
+        with self.lock:
+            entry = self.entries.get((endpoint, ip))
+            if not entry:
+                return None
+            timestamp, result = entry
+            age = time.time() - timestamp
+            if age > self._ttl(endpoint, result):
+                return None
+            self.entries.move_to_end((endpoint, ip))
+            self.hits += 1
+            return result, age
+
+    def put(self, endpoint, ip, result):
+        with self.lock:
+            self._store((endpoint, ip), time.time(), result)
+
+    def _store(self, key, timestamp, result):
+        self.entries[key] = (timestamp, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "inflight": len(self.inflight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "wait_timeouts": self.wait_timeouts,
+                "evicted": self.evicted,
+            }
+
+
+enrichment_cache = EnrichmentCache(ENRICH_TTLS)
+geo_executor = ThreadPoolExecutor(max_workers=8)
+_geoip_reader = None
+_geoip_retry_at = 0.0
+_geoip_lock = Lock()
+
+
+def enriched_response(endpoint, compute):
     ip = request.args.get('ip')
-    ports = port_scan_results.get(ip, [80])
+    if not ip:
+        return jsonify(error="Missing IP"), 400
+    refresh = request.args.get('refresh') == '1'
+    result, status, age = enrichment_cache.get_or_compute(endpoint, ip, lambda: compute(ip), refresh)
+    response = dict(result)
+    response["cache"] = status
+    response["age"] = round(age, 3)
+    return jsonify(response)
+
+
+def grab_banners(ip):
+    scan_result = port_scan_results.get(ip)
+    ports = scan_result["open_ports"] if scan_result else [80]
     result = {}
 
     for port in ports:
@@ -134,14 +2330,10 @@ def banner_grab():
         except Exception as e:
             result[port] = f"Error: {str(e)}"
 
-    return jsonify(ip=ip, banners=result)
+    return {"ip": ip, "banners": result}
 
 
-@app.route('/webinfo')
-def web_info():
-    ip = request.args.get('ip')
-    if not ip:
-        return jsonify(error="Missing IP"), 400
+def fetch_web_info(ip):
     url = f"http://{ip}"
     try:
         r = requests.get(url, timeout=2)
@@ -150,74 +2342,471 @@ def web_info():
             start = r.text.lower().index("<title>") + 7
             end = r.text.lower().index("</title>", start)
             title = r.text[start:end]
-        return jsonify(
-            ip=ip,
-            status_code=r.status_code,
-            server=r.headers.get("Server", "Unknown"),
-            title=title.strip()
-        )
+        return {
+            "ip": ip,
+            "status_code": r.status_code,
+            "server": r.headers.get("Server", "Unknown"),
+            "title": title.strip()
+        }
     except Exception as e:
-        return jsonify(ip=ip, error=str(e))
+        return {"ip": ip, "error": str(e)}
 
 
-@app.route('/os_detect')
-def os_detect():
-    ip = request.args.get('ip')
-    if not ip:
-        return jsonify(error="Missing IP"), 400
+def guess_os_by_ttl(ttl):
+    if ttl >= 128:
+        return "Windows"
+    if ttl >= 64:
+        return "Linux/Unix"
+    return "Unknown"
+
+
+def guess_os_by_syn_ack(ttl, window):
+    if ttl >= 128 and window in [8192, 65535]:
+        return "Windows"
+    if ttl >= 64 and window in [5840, 14600]:
+        return "Linux"
+    return "Unknown"
+
+
+def _tcp_options(options):
+    # scapy 的選項值可能是 bytes，jsonify 不認
+    return [(name, value.hex() if isinstance(value, bytes) else value) for name, value in options]
+
+
+def _send_probes(packets, timeout):
+    # 127.0.0.0/8 收不到 L3PacketSocket 發的包，要改用 raw socket
+    loopback = [p for p in packets if p[IP].dst.startswith("127.")]
+    others = [p for p in packets if not p[IP].dst.startswith("127.")]
+    answered = []
+    if loopback:
+        sock = L3RawSocket()
+        try:
+            ans, _ = sock.sr(loopback, timeout=timeout, verbose=0)
+        finally:
+            sock.close()
+        answered.extend(ans)
+    if others:
+        ans, _ = sr(others, timeout=timeout, verbose=0)
+        answered.extend(ans)
+    return answered
+
+
+def probe_error(ip, message):
+    error = {"ip": ip, "error": message}
+    return {"os_detect": error, "tcp_fingerprint": error}
+
+
+def probe_hosts(ips, port=PROBE_PORT, timeout=PROBE_TIMEOUT):
+    # 一次 sr() 對所有IP各發一個 ICMP echo 和一個 TCP SYN，由 scapy 按 id/seq、端口匹配回包
+    # 返回 {ip: {"os_detect": {...}, "tcp_fingerprint": {...}}}；全部答完即返回，否則等到 timeout
+    results = {}
+    targets = []
+    for ip in ips:
+        try:
+            ipaddress.IPv4Address(ip)
+        except ValueError:
+            results[ip] = probe_error(ip, "Invalid IPv4 address")
+            continue
+        targets.append(ip)
+        results[ip] = {
+            "os_detect": {"ip": ip, "error": "No TTL found, host may be unreachable"},
+            "tcp_fingerprint": {"ip": ip, "error": "No response"},
+        }
+    if not targets:
+        return results
+
+    ident = random.randrange(1, 0x10000)
+    sport = random.randrange(32768, 61000)
+    packets = []
+    for seq, ip in enumerate(targets):
+        packets.append(IP(dst=ip)/ICMP(id=ident, seq=seq & 0xFFFF))
+        packets.append(IP(dst=ip)/TCP(sport=sport, dport=port, flags='S', seq=random.getrandbits(32)))
     try:
-        result = subprocess.run(['ping', '-c', '1', ip], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if 'ttl=' in result.stdout.lower():
-            ttl = int(result.stdout.lower().split('ttl=')[1].split()[0])
-            if ttl >= 128:
-                os_type = "Windows"
-            elif ttl >= 64:
-                os_type = "Linux/Unix"
-            else:
-                os_type = "Unknown"
-            return jsonify(ip=ip, ttl=ttl, guessed_os=os_type)
-        else:
-            return jsonify(ip=ip, error="No TTL found, host may be unreachable")
+        answered = _send_probes(packets, timeout)
     except Exception as e:
-        return jsonify(ip=ip, error=str(e))
+        for ip in targets:
+            results[ip] = probe_error(ip, str(e))
+        return results
+
+    for sent, received in answered:
+        ip = sent[IP].dst
+        ttl = received.ttl
+        rtt_ms = round((received.time - sent.sent_time) * 1000.0, 3)
+        if sent.haslayer(ICMP):
+            if received.haslayer(ICMP) and received[ICMP].type == 0:
+                results[ip]["os_detect"] = {"ip": ip, "ttl": ttl, "guessed_os": guess_os_by_ttl(ttl),
+                                            "rtt_ms": rtt_ms}
+        elif received.haslayer(TCP):
+            tcp = received[TCP]
+            results[ip]["tcp_fingerprint"] = {
+                "ip": ip, "port": port, "ttl": ttl, "window": tcp.window, "flags": str(tcp.flags),
+                "options": _tcp_options(tcp.options), "os_guess": guess_os_by_syn_ack(ttl, tcp.window),
+                "rtt_ms": rtt_ms,
+            }
+        elif received.haslayer(ICMP):
+            results[ip]["tcp_fingerprint"] = {"ip": ip, "error": f"ICMP type {received[ICMP].type} "
+                                                                 f"code {received[ICMP].code}"}
+    return results
+
+
+def cache_probe_results(results):
+    for ip, result in results.items():
+        enrichment_cache.put('os_detect', ip, result["os_detect"])
+        enrichment_cache.put('tcp_fingerprint', ip, result["tcp_fingerprint"])
+
+
+class ProbeBatcher:
+    # 把一個時間窗內的 /os_detect、/tcp_fingerprint 請求合併成一次 probe_hosts()
+    # 同一IP的兩種探測一起發，結果都寫進 enrichment_cache
+    def __init__(self, window=PROBE_BATCH_WINDOW, max_batch=PROBE_BATCH_MAX, wait_timeout=PROBE_WAIT_TIMEOUT):
+        self.window = window
+        self.max_batch = max_batch
+        self.wait_timeout = wait_timeout
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.pending = OrderedDict()  # ip -> _Flight
+        self.thread = None
+        self.batches = 0
+        self.probed = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+        self.wait_timeouts = 0
+
+    def probe(self, ip):
+        with self.lock:
+            flight = self.pending.get(ip)
+            if flight is None:
+                flight = self.pending[ip] = _Flight()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        if not flight.event.wait(self.wait_timeout):
+            with self.lock:
+                self.wait_timeouts += 1
+            return probe_error(ip, "Probe timed out")
+        return flight.result
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.window)
+            with self.lock:
+                batch = OrderedDict()
+                while self.pending and len(batch) < self.max_batch:
+                    ip, flight = self.pending.popitem(last=False)
+                    batch[ip] = flight
+                if not self.pending:
+                    self.wakeup.clear()
+                self.batches += 1
+                self.probed += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+            results = {}
+            try:
+                results = probe_hosts(list(batch))
+                cache_probe_results(results)
+            except Exception as e:
+                with self.lock:
+                    self.failed_batches += 1
+                print(f"Probe batch failed: {e!r}")
+                results = {ip: results.get(ip) or probe_error(ip, str(e)) for ip in batch}
+            finally:
+                # 無論成功與否都要喚醒等待者，不然請求會一直掛著
+                now = time.time()
+                for ip, flight in batch.items():
+                    flight.result = results.get(ip) or probe_error(ip, "Probe batch aborted")
+                    flight.timestamp = now
+                    flight.event.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "batches": self.batches,
+                "probed": self.probed,
+                "largest_batch": self.largest_batch,
+                "failed_batches": self.failed_batches,
+                "wait_timeouts": self.wait_timeouts,
+                "window": self.window,
+            }
+
+
+probe_batcher = ProbeBatcher()
+
+
+def detect_os(ip):
+    return probe_batcher.probe(ip)["os_detect"]
+
+
+def fingerprint_tcp(ip):
+    return probe_batcher.probe(ip)["tcp_fingerprint"]
+
+
+def reverse_dns(ip):
+    try:
+        hostname, _, _ = socket.gethostbyaddr(ip)
+        return {"ip": ip, "hostname": hostname}
+    except Exception:
+        return {"ip": ip, "error": "No reverse DNS found"}
+
+
+@app.route('/banner')
+def banner_grab():
+    return enriched_response('banner', grab_banners)
+
+
+@app.route('/webinfo')
+def web_info():
+    return enriched_response('webinfo', fetch_web_info)
+
+
+@app.route('/os_detect')
+def os_detect():
+    return enriched_response('os_detect', detect_os)
 
 
 @app.route('/tcp_fingerprint')
 def tcp_fingerprint():
-    ip = request.args.get('ip')
-    if not ip:
-        return jsonify(error="Missing IP"), 400
-    try:
-        pkt = IP(dst=ip)/TCP(dport=80, flags='S')
-        resp = sr1(pkt, timeout=2, verbose=0)
-        if resp is None or not resp.haslayer(TCP):
-            return jsonify(ip=ip, error="No response")
-
-        ttl = resp.ttl
-        window = resp[TCP].window
-        options = resp[TCP].options
-        os_guess = "Unknown"
-
-        if ttl >= 128 and window in [8192, 65535]:
-            os_guess = "Windows"
-        elif ttl >= 64 and window in [5840, 14600]:
-            os_guess = "Linux"
-
-        return jsonify(ip=ip, ttl=ttl, window=window, options=options, os_guess=os_guess)
-    except Exception as e:
-        return jsonify(ip=ip, error=str(e))
+    return enriched_response('tcp_fingerprint', fingerprint_tcp)
+
+
+@app.route('/probe_bulk', methods=['GET', 'POST'])
+def probe_bulk():
+    # 批量 os_detect + tcp_fingerprint，返回 NDJSON；緩存命中的先輸出，其餘按 PROBE_BATCH_MAX 分批探測
+    body = request.get_json(silent=True) or {}
+    if request.args.get('live') or body.get('live'):
+        ips = [ip for ip, _ in ip_store.live_items()]
+    else:
+        ips = body.get('ips') or [ip for ip in request.args.get('ips', '').split(',') if ip]
+    ips = list(dict.fromkeys(ips))
+    if not ips:
+        return jsonify(error="Missing IPs"), 400
+    if len(ips) > SCAN_BULK_MAX_IPS:
+        return jsonify(error=f"Too many IPs (max {SCAN_BULK_MAX_IPS})"), 400
+    refresh = request.args.get('refresh') == '1' or bool(body.get('refresh'))
+
+    cached = []
+    missing = []
+    for ip in ips:
+        os_entry = None if refresh else enrichment_cache.get_fresh('os_detect', ip)
+        tcp_entry = None if refresh else enrichment_cache.get_fresh('tcp_fingerprint', ip)
+        if os_entry and tcp_entry:
+            cached.append({"ip": ip, "os_detect": os_entry[0], "tcp_fingerprint": tcp_entry[0],
+                           "cache": "hit", "age": round(max(os_entry[1], tcp_entry[1]), 3)})
+        else:
+            missing.append(ip)
+
+    results = queue.Queue()
+    done = object()
+
+    def run_probes():
+        try:
+            for start in range(0, len(missing), PROBE_BATCH_MAX):
+                chunk = probe_hosts(missing[start:start + PROBE_BATCH_MAX])
+                cache_probe_results(chunk)
+                for ip, result in chunk.items():
+                    results.put({"ip": ip, **result, "cache": "miss", "age": 0.0})
+        except Exception as e:
+            results.put({"error": str(e)})
+        finally:
+            results.put(done)
+
+    if missing:
+        Thread(target=run_probes, daemon=True).start()
+    else:
+        results.put(done)
+
+    def generate():
+        for item in cached:
+            yield json.dumps(item) + "\n"
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            yield json.dumps(item) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @app.route('/dns_lookup')
 def dns_lookup():
-    ip = request.args.get('ip')
-    if not ip:
-        return jsonify(error="Missing IP"), 400
+    return enriched_response('dns_lookup', reverse_dns)
+
+
+@app.route('/enrichment_stats')
+def enrichment_stats():
+    return jsonify({**enrichment_cache.stats(), "probe": probe_batcher.stats()})
+
+
+def get_geoip_reader():
+    # 打開失敗不永久記住，按 GEOIP_RETRY_INTERVAL 重試；沒裝 maxminddb 時不再試
+    global _geoip_reader, _geoip_retry_at
+    if _geoip_reader is None and time.monotonic() >= _geoip_retry_at:
+        with _geoip_lock:
+            if _geoip_reader is None and time.monotonic() >= _geoip_retry_at:
+                if maxminddb is None:
+                    print("maxminddb not installed, offline GeoIP disabled")
+                    _geoip_retry_at = float('inf')
+                else:
+                    try:
+                        _geoip_reader = maxminddb.open_database(GEOIP_DB_PATH, maxminddb.MODE_MMAP)
+                    except (OSError, ValueError) as e:
+                        print(f"Cannot open GeoIP database {GEOIP_DB_PATH}: {e}, "
+                              f"retrying in {GEOIP_RETRY_INTERVAL:.0f}s")
+                        _geoip_retry_at = time.monotonic() + GEOIP_RETRY_INTERVAL
+    return _geoip_reader
+
+
+def geo_lookup_local(ip):
+    # 只緩存數據庫可用時的查詢結果，不可用期間的 None 不進 lru_cache
+    reader = get_geoip_reader()
+    if reader is None:
+        return None
+    return _geo_lookup_open(ip)
+
+
+@lru_cache(maxsize=GEO_CACHE_SIZE)
+def _geo_lookup_open(ip):
+    # 只在 get_geoip_reader() 已經返回了 reader 之後調用
     try:
-        hostname, _, _ = socket.gethostbyaddr(ip)
-        return jsonify(ip=ip, hostname=hostname)
-    except Exception:
-        return jsonify(ip=ip, error="No reverse DNS found")
+        record = _geoip_reader.get(ip)
+    except ValueError:
+        return None
+    location = (record or {}).get('location')
+    if not location or location.get('latitude') is None:
+        return None
+    subdivisions = record.get('subdivisions') or [{}]
+    return {
+        'ip': ip,
+        'lat': location['latitude'],
+        'lon': location['longitude'],
+        'city': record.get('city', {}).get('names', {}).get('en', ''),
+        'region': subdivisions[0].get('names', {}).get('en', ''),
+        'country': record.get('country', {}).get('names', {}).get('en', ''),
+        'isp': ''
+    }
+
+
+def _fetch_ip_api(ip):
+    resp = requests.get(f'http://ip-api.com/json/{ip}', timeout=3)
+    data = resp.json()
+    if data.get('status') != 'success' or data.get('lat') is None or data.get('lon') is None:
+        return {"ip": ip, "error": data.get('message', 'lookup failed')}
+    return {
+        'ip': ip,
+        'lat': data.get('lat'),
+        'lon': data.get('lon'),
+        'city': data.get('city', ''),
+        'region': data.get('regionName', ''),
+        'country': data.get('country', ''),
+        'isp': data.get('isp', '')
+    }
+
+
+def geo_lookup_online(ip):
+    result, _, _ = enrichment_cache.get_or_compute('geo_online', ip, lambda: _fetch_ip_api(ip))
+    return None if "error" in result else result
+
+
+def locate_hops(hops):
+    # 先查本地 mmdb，查不到的公網IP再並行走 ip-api.com
+    points = {}
+    missing = []
+    for hop_ip in hops:
+        point = geo_lookup_local(hop_ip)
+        if point:
+            points[hop_ip] = point
+        elif not is_private_ip(hop_ip):
+            missing.append(hop_ip)
+    if missing and GEOIP_ONLINE_FALLBACK:
+        for hop_ip, point in zip(missing, geo_executor.map(geo_lookup_online, missing)):
+            if point:
+                points[hop_ip] = point
+    return [points[hop_ip] for hop_ip in hops if hop_ip in points]
+
+
+def iter_traceroute_hops(ip, timeout=TRACEROUTE_TIMEOUT):
+    # 逐行讀 traceroute 輸出，每解析出一跳就 yield (ttl, hop_ip)
+    proc = subprocess.Popen(['traceroute', '-n', ip], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            text=True, bufsize=1)
+    killer = Timer(timeout, proc.kill)
+    killer.start()
+    try:
+        for line in proc.stdout:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].isdigit() and parts[1] != '*':
+                yield int(parts[0]), parts[1]
+    finally:
+        killer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+def run_traceroute(ip):
+    started = time.perf_counter()
+    hops = [hop_ip for _, hop_ip in iter_traceroute_hops(ip)]
+    trace_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    points = locate_hops(hops)
+    geo_seconds = time.perf_counter() - started
+    return {"ip": ip, "hops": points, "traced_at": time.time(),
+            "timings": {"trace": round(trace_seconds, 4), "geo": round(geo_seconds, 4)}}
+
+
+def prune_static_dir(path=WATCHDOG_STATIC_PATH, max_files=TRACEROUTE_STATIC_MAX_FILES,
+                     max_bytes=TRACEROUTE_STATIC_MAX_BYTES, max_age=TRACEROUTE_STATIC_MAX_AGE):
+    # 只清理 traceroute_map_*.html，先刪過期的，再從最舊的刪到數量和總大小都在限制內
+    now = time.time()
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.startswith('traceroute_map_'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+    files.sort()
+    total_bytes = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, file_path in files:
+        if now - mtime <= max_age and len(files) - removed <= max_files and total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(file_path)
+        except OSError:
+            continue
+        removed += 1
+        total_bytes -= size
+    return removed
+
+
+def render_trace_map(trace):
+    # 同一次 traceroute 結果只渲染一次，文件名由目標和 traced_at 決定
+    os.makedirs(WATCHDOG_STATIC_PATH, exist_ok=True)
+    safe_ip = trace['ip'].replace(':', '_').replace('/', '_')
+    filename = f"traceroute_map_{safe_ip}_{int(trace['traced_at'] * 1000)}.html"
+    output_path = os.path.join(WATCHDOG_STATIC_PATH, filename)
+    if os.path.exists(output_path):
+        return filename, False
+
+    points = trace['hops']
+    m = folium.Map(location=[20, 0], zoom_start=2)
+    latlons = [(p['lat'], p['lon']) for p in points]
+    if latlons:
+        PolyLine(latlons, color='red', weight=2, opacity=0.8).add_to(m)
+        for p in points:
+            popup_html = (
+                f"<b>IP:</b> {p['ip']}<br>"
+                f"<b>Location:</b> {p['city']}, {p['region']}, {p['country']}<br>"
+                f"<b>ISP:</b> {p['isp']}"
+            )
+            folium.Marker(
+                location=(p['lat'], p['lon']),
+                popup=folium.Popup(popup_html, max_width=300)
+            ).add_to(m)
+    m.save(output_path)
+    prune_static_dir()
+    return filename, True
 
 
 @app.route('/traceroute')
@@ -225,62 +2814,67 @@ def traceroute():
     ip = request.args.get('ip')
     if not ip:
         return jsonify(error="Missing IP"), 400
+    refresh = request.args.get('refresh') == '1'
 
     try:
-        os.makedirs(WATCHDOG_STATIC_PATH, exist_ok=True)
-        command = ['traceroute', '-n', ip]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=30)
+        trace, status, age = enrichment_cache.get_or_compute('traceroute', ip, lambda: run_traceroute(ip), refresh)
+        if "error" in trace:
+            return jsonify(trace)
+        response = {"hops": trace['hops'], "cache": status, "age": round(age, 3),
+                    "timings": dict(trace['timings'])}
+        if request.args.get('format') == 'json':
+            return jsonify(response)
 
-        hops = []
-        for line in result.stdout.splitlines():
-            parts = line.split()
-            if len(parts) >= 2 and parts[1] != '*':
-                hops.append(parts[1])
+        started = time.perf_counter()
+        filename, rendered = render_trace_map(trace)
+        response["timings"]['render'] = round(time.perf_counter() - started, 4) if rendered else 0.0
+        response["url"] = f"/traceroute_static/{filename}"
+        return jsonify(response)
+    except Exception as e:
+        return jsonify(ip=ip, error=str(e))
+
+
+@app.route('/traceroute_stream')
+def traceroute_stream():
+    # NDJSON：每跳一行 {"type": "hop"}，最後一行 {"type": "done"}；有新鮮緩存時直接回放
+    ip = request.args.get('ip')
+    if not ip:
+        return jsonify(error="Missing IP"), 400
+    refresh = request.args.get('refresh') == '1'
+    cached = None if refresh else enrichment_cache.get_fresh('traceroute', ip)
 
+    def generate():
+        if cached:
+            trace, age = cached
+            for point in trace['hops']:
+                yield json.dumps({"type": "hop", "ip": point['ip'], "hop": point}) + "\n"
+            yield json.dumps({"type": "done", "hops": trace['hops'], "cache": "hit",
+                              "age": round(age, 3), "timings": trace['timings']}) + "\n"
+            return
+
+        started = time.perf_counter()
+        geo_seconds = 0.0
         points = []
-        for hop_ip in hops:
-            try:
-                resp = requests.get(f'http://ip-api.com/json/{hop_ip}', timeout=3)
-                data = resp.json()
-                if data['status'] == 'success':
-                    lat = data.get('lat')
-                    lon = data.get('lon')
-                    if lat is not None and lon is not None:
-                        points.append({
-                            'ip': hop_ip,
-                            'lat': lat,
-                            'lon': lon,
-                            'city': data.get('city', ''),
-                            'region': data.get('regionName', ''),
-                            'country': data.get('country', ''),
-                            'isp': data.get('isp', '')
-                        })
-            except:
-                continue
+        try:
+            for ttl, hop_ip in iter_traceroute_hops(ip):
+                geo_started = time.perf_counter()
+                located = locate_hops([hop_ip])
+                geo_seconds += time.perf_counter() - geo_started
+                point = located[0] if located else None
+                if point:
+                    points.append(point)
+                yield json.dumps({"type": "hop", "ttl": ttl, "ip": hop_ip, "hop": point}) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "ip": ip, "error": str(e)}) + "\n"
+            return
 
-        m = folium.Map(location=[20, 0], zoom_start=2)
-        latlons = [(p['lat'], p['lon']) for p in points]
-        if latlons:
-            PolyLine(latlons, color='red', weight=2, opacity=0.8).add_to(m)
-            for p in points:
-                popup_html = (
-                    f"<b>IP:</b> {p['ip']}<br>"
-                    f"<b>Location:</b> {p['city']}, {p['region']}, {p['country']}<br>"
-                    f"<b>ISP:</b> {p['isp']}"
-                )
-                folium.Marker(
-                    location=(p['lat'], p['lon']),
-                    popup=folium.Popup(popup_html, max_width=300)
-                ).add_to(m)
-
-        filename = f"traceroute_map_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
-        output_path = os.path.join(WATCHDOG_STATIC_PATH, filename)
-        m.save(output_path)
-
-        return jsonify({"hops": points, "url": f"/traceroute_static/{filename}"})
-    except Exception as e:
-        return jsonify(ip=ip, error=str(e))
+        timings = {"trace": round(time.perf_counter() - started - geo_seconds, 4), "geo": round(geo_seconds, 4)}
+        trace = {"ip": ip, "hops": points, "traced_at": time.time(), "timings": timings}
+        enrichment_cache.put('traceroute', ip, trace)
+        yield json.dumps({"type": "done", "hops": points, "cache": "miss", "age": 0.0, "timings": timings}) + "\n"
 
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/traceroute_static/<path:filename>')
@@ -289,12 +2883,51 @@ def traceroute_static(filename):
 
 
 def start_ip_data_update():
-    update_ip_data()
+    if FIVE_TUPLE_TRANSPORT in ("stream", "both"):
+        workers = [(stream_ingest, (f"{STREAM_CONSUMER}-{i}",)) for i in range(STREAM_WORKERS)]
+    else:
+        workers = [(update_ip_data, ())]
+    for target, args in workers:
+        Thread(target=target, args=args, daemon=True).start()
+
+
+def start_background():
+    if GUI_ROLE == "web":
+        Thread(target=shared_replica.run, daemon=True).start()
+    else:
+        # 先訂閱開始消費，快照由 persister 線程後台載入，大緩存也不拖慢就緒
+        start_ip_data_update()
+        if PERSIST_ENABLED:
+            Thread(target=persister.run, daemon=True).start()
+    Thread(target=broadcaster.run, daemon=True).start()
+
+
+def run_ingest_role():
+    # 單一寫入進程，不提供 HTTP：搶到鎖後才開始消費，狀態通過 Redis 發布給 web worker
+    leader = IngestLeader()
+    leader.acquire()
+    Thread(target=leader.hold, daemon=True).start()
+    start_ip_data_update()
+    if PERSIST_ENABLED:
+        # restore() 不進變更日誌，載入完成後重發一次完整快照讓 web worker 看到恢復的數據
+        persister.on_loaded = shared_publisher.request_snapshot
+        Thread(target=persister.run, daemon=True).start()
+    shared_publisher.run()
+
+
+if GUI_ROLE == "web" and __name__ != '__main__':
+    # 被 gunicorn 之類的 WSGI 服務器 import 時，每個 worker 各自同步一份副本；
+    # 不要用 --preload，後台線程不會跟著 fork 到 worker 裡
+    start_background()
 
 
 if __name__ == '__main__':
-    thread = Thread(target=start_ip_data_update)
-    thread.daemon = True
-    thread.start()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    if GUI_ROLE == "ingest":
+        run_ingest_role()
+    else:
+        # debug 模式下 reloader 的父進程只負責監視文件，後台線程只在真正服務請求的子進程裡啟動，
+        # 否則父進程也會消費消息（stream 模式下會分走一半）並寫同一份持久化文件
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            start_background()
+        app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,309 @@
+import argparse, os, sys, time, struct, base64, mmap, queue
+import multiprocessing as mp
+
+try:
+    import redis
+except ImportError:
+    print("Please install: pip install redis", file=sys.stderr)
+    sys.exit(1)
+
+
+LINKTYPE_ETHERNET = 1  # getinfo 只解析以太網幀
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SHB = b"\x0a\x0d\x0d\x0a"
+PCAPNG_BYTE_ORDER = {b"\x4d\x3c\x2b\x1a": "<", b"\x1a\x2b\x3c\x4d": ">"}
+
+
+def iter_pcap(view, skipped):
+    # 經典 pcap：24 字節文件頭 + (16 字節記錄頭 + 幀) * N；幀是 view 的切片，不複製
+    endian, resolution = PCAP_MAGICS[bytes(view[:4])]
+    linktype = struct.unpack_from(endian + "I", view, 20)[0]
+    record = struct.Struct(endian + "IIII")
+    offset = 24
+    end = len(view)
+    while offset + record.size <= end:
+        ts_sec, ts_frac, caplen, _origlen = record.unpack_from(view, offset)
+        offset += record.size
+        if offset + caplen > end:
+            break  # 文件被截斷
+        if linktype == LINKTYPE_ETHERNET:
+            yield ts_sec + ts_frac * resolution, view[offset:offset + caplen]
+        else:
+            skipped["linktype"] += 1
+        offset += caplen
+
+
+def if_tsresol(view, endian, offset, end):
+    # 在 IDB 的選項裡找 if_tsresol（code 9），默認微秒
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", view, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            v = view[offset + 4]
+            return 2.0 ** -(v & 0x7F) if v & 0x80 else 10.0 ** -v
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def iter_pcapng(view, skipped):
+    # pcapng：按塊遍歷；SHB 開始新的 section（可能換字節序），IDB 定義接口的鏈路類型和時間精度，
+    # EPB/SPB 是數據包；其他塊直接跳過
+    endian = "<"
+    interfaces = []  # [(linktype, resolution)]
+    last_ts = 0.0
+    offset = 0
+    end = len(view)
+    while offset + 12 <= end:
+        block_type = bytes(view[offset:offset + 4])
+        if block_type == PCAPNG_SHB:
+            endian = PCAPNG_BYTE_ORDER.get(bytes(view[offset + 8:offset + 12]))
+            if endian is None:
+                raise ValueError(f"bad pcapng byte-order magic at offset {offset}")
+            interfaces = []
+        block_type, block_len = struct.unpack_from(endian + "II", view, offset)
+        if block_len < 12 or offset + block_len > end:
+            break  # 文件被截斷
+        body = offset + 8
+        if block_type == 1:  # Interface Description Block
+            linktype = struct.unpack_from(endian + "H", view, body)[0]
+            interfaces.append((linktype, if_tsresol(view, endian, body + 8, offset + block_len - 4)))
+        elif block_type == 6:  # Enhanced Packet Block
+            iface, ts_high, ts_low, caplen, _origlen = struct.unpack_from(endian + "IIIII", view, body)
+            linktype, resolution = interfaces[iface] if iface < len(interfaces) else (None, 1e-6)
+            if linktype == LINKTYPE_ETHERNET:
+                last_ts = ((ts_high << 32) | ts_low) * resolution
+                yield last_ts, view[body + 20:body + 20 + caplen]
+            else:
+                skipped["linktype"] += 1
+        elif block_type == 3:  # Simple Packet Block：沒有時間戳，沿用上一個包的
+            origlen = struct.unpack_from(endian + "I", view, body)[0]
+            caplen = min(origlen, block_len - 16)
+            if interfaces and interfaces[0][0] == LINKTYPE_ETHERNET:
+                yield last_ts, view[body + 4:body + 4 + caplen]
+            else:
+                skipped["linktype"] += 1
+        offset += block_len
+
+
+def iter_frames(view, skipped):
+    magic = bytes(view[:4])
+    if magic in PCAP_MAGICS:
+        return iter_pcap(view, skipped)
+    if magic == PCAPNG_SHB:
+        return iter_pcapng(view, skipped)
+    raise ValueError(f"not a pcap/pcapng file (magic {magic.hex()})")
+
+
+def scan(view):
+    # 預掃一遍：包數、幀字節數、時間跨度，用來排回放時間表和預估耗時；
+    # 多接口的抓包文件時間戳不一定單調，所以取最小/最大值
+    skipped = {"linktype": 0}
+    count = 0
+    frame_bytes = 0
+    first_ts = last_ts = None
+    for ts, frame in iter_frames(view, skipped):
+        if first_ts is None:
+            first_ts = last_ts = ts
+        first_ts = min(first_ts, ts)
+        last_ts = max(last_ts, ts)
+        count += 1
+        frame_bytes += len(frame)
+    return {
+        "packets": count,
+        "bytes": frame_bytes,
+        "first_ts": first_ts or 0.0,
+        "span": (last_ts - first_ts) if count else 0.0,
+        "skipped_linktype": skipped["linktype"],
+    }
+
+
+def replay_shard(idx, cfg, view, start_at, counters):
+    # 第 idx 個進程只發 n % processes == idx 的包，各進程按同一張時間表排期，合起來保持原始順序和節奏。
+    # 時間表：speed > 0 時按原始時間戳 / speed；max_rate 限制每個進程的最小發送間隔；
+    # 到期的包最多 pipeline 條一起發
+    r = redis.Redis(host=cfg["redis_host"], port=cfg["redis_port"])
+    pipe = r.pipeline(transaction=False)
+    # binary 直接把 mmap 的切片交給 redis-py，不經過中間 bytes
+    encode = base64.b64encode if cfg["raw_encoding"] == "base64" else (lambda frame: frame)
+    shards = cfg["processes"]
+    speed = cfg["speed"]
+    min_gap = shards / cfg["max_rate"] if cfg["max_rate"] > 0 else 0.0
+    span = cfg["span"]
+    loop_gap = span / (cfg["packets"] - 1) if cfg["packets"] > 1 else 0.0
+    stats = {"packets": 0, "bytes": 0, "payload_bytes": 0, "errors": 0, "max_behind": 0.0}
+    skipped = {"linktype": 0}  # scan() 已經統計過，這裡只是給 iter_frames 用
+    pending = []
+
+    def flush():
+        try:
+            pipe.execute()
+            stats["packets"] += len(pending)
+            stats["bytes"] += sum(pending)
+        except redis.RedisError as e:
+            stats["errors"] += len(pending)
+            print(f"[shard {idx}] publish failed: {e}", file=sys.stderr)
+            pipe.reset()
+        pending.clear()
+        counters[idx * 2] = stats["packets"]
+        counters[idx * 2 + 1] = stats["bytes"]
+
+    loop_start = start_at
+    prev = start_at + idx * min_gap / shards - min_gap
+    loop = 0
+    while not cfg["loops"] or loop < cfg["loops"]:
+        for n, (ts, frame) in enumerate(iter_frames(view, skipped)):
+            if n % shards != idx:
+                continue
+            if speed > 0:
+                intended = max(loop_start + (ts - cfg["first_ts"]) / speed, prev + min_gap)
+            else:
+                intended = prev + min_gap
+            prev = intended
+            now = time.time()
+            if intended > now:
+                if pending:
+                    flush()
+                    now = time.time()
+                if intended > now:
+                    time.sleep(intended - now)
+            else:
+                stats["max_behind"] = max(stats["max_behind"], now - intended)
+            payload = encode(frame)
+            pipe.publish(cfg["channel"], payload)
+            pending.append(len(frame))
+            stats["payload_bytes"] += len(payload)
+            if len(pending) >= cfg["pipeline"]:
+                flush()
+        if pending:
+            flush()
+        loop += 1
+        # 下一輪接在本輪最後一個包之後，中間留一個平均包間隔
+        loop_start += (span + loop_gap) / speed if speed > 0 else 0.0
+    return stats
+
+
+def replay_worker(idx, cfg, start_at, counters, results):
+    with open(cfg["path"], "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        started = time.time()
+        stats = replay_shard(idx, cfg, view, max(start_at, started), counters)
+        stats["finished"] = time.time()
+        view.release()
+    stats["idx"] = idx
+    results.put(stats)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay a pcap/pcapng file into raw_packet_channel")
+    ap.add_argument("path", help="pcap or pcapng file (Ethernet link type)")
+    ap.add_argument("--channel", default="raw_packet_channel", help="Redis channel to publish")
+    ap.add_argument("--redis-host", default=os.getenv("REDIS_HOST", "127.0.0.1"))
+    ap.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", "6379")))
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="Timing multiplier: 1 = original timing, 10 = ten times faster, 0 = ignore timestamps")
+    ap.add_argument("--max-rate", type=float, default=0.0, help="Cap on total packets per second (0 = no cap)")
+    ap.add_argument("--loops", type=int, default=1, help="Replay the file this many times (0 = forever)")
+    ap.add_argument("--processes", "-p", type=int, default=1, help="Shard packets round-robin across processes")
+    ap.add_argument("--pipeline", type=int, default=64, help="Max packets per pipelined publish when behind schedule")
+    ap.add_argument("--raw-encoding", choices=["base64", "binary"], default="base64",
+                    help="Frame encoding, must match RAW_PACKET_ENCODING of getinfo (captrue default: base64)")
+    ap.add_argument("--print-every", type=float, default=1.0, help="Progress interval (seconds)")
+    args = ap.parse_args()
+
+    with open(args.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        info = scan(view)
+        view.release()
+    if not info["packets"]:
+        print(f"[FATAL] no Ethernet packets in {args.path} (skipped {info['skipped_linktype']})", file=sys.stderr)
+        sys.exit(2)
+    print(f"{args.path}: packets={info['packets']} bytes={info['bytes']} span={info['span']:.3f}s "
+          f"skipped_linktype={info['skipped_linktype']}")
+
+    try:
+        redis.Redis(host=args.redis_host, port=args.redis_port).ping()
+    except Exception as e:
+        print(f"[FATAL] Cannot connect to Redis at {args.redis_host}:{args.redis_port}: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    cfg = {
+        "path": args.path,
+        "redis_host": args.redis_host,
+        "redis_port": args.redis_port,
+        "channel": args.channel,
+        "speed": args.speed,
+        "max_rate": args.max_rate,
+        "loops": args.loops,
+        "processes": max(1, args.processes),
+        "pipeline": max(1, args.pipeline),
+        "raw_encoding": args.raw_encoding,
+        "packets": info["packets"],
+        "first_ts": info["first_ts"],
+        "span": info["span"],
+    }
+    counters = mp.RawArray("q", cfg["processes"] * 2)  # 每個進程 (已發包數, 已發字節數)
+    results = mp.Queue()
+    start_at = time.time() + 0.5
+    procs = [mp.Process(target=replay_worker, args=(i, cfg, start_at, counters, results), daemon=True)
+             for i in range(cfg["processes"])]
+    for p in procs:
+        p.start()
+
+    outs = []
+    last_report = start_at
+    last_packets = last_bytes = 0
+    try:
+        while len(outs) < len(procs):
+            try:
+                outs.append(results.get(timeout=args.print_every))
+            except queue.Empty:
+                pass
+            now = time.time()
+            if now - last_report >= args.print_every:
+                packets = sum(counters[0::2])
+                sent_bytes = sum(counters[1::2])
+                span = now - last_report
+                print(f"{time.strftime('%H:%M:%S')} pps={(packets - last_packets) / span:.0f} "
+                      f"Bps={(sent_bytes - last_bytes) / span:.0f} total={packets}")
+                last_report, last_packets, last_bytes = now, packets, sent_bytes
+    except KeyboardInterrupt:
+        print("\ninterrupted, partial counts:", file=sys.stderr)
+        outs = []
+    for p in procs:
+        if not outs:
+            p.terminate()
+        p.join()
+
+    if outs:
+        packets = sum(o["packets"] for o in outs)
+        frame_bytes = sum(o["bytes"] for o in outs)
+        payload_bytes = sum(o["payload_bytes"] for o in outs)
+        errors = sum(o["errors"] for o in outs)
+        max_behind = max(o["max_behind"] for o in outs)
+        elapsed = max(o["finished"] for o in outs) - start_at
+    else:
+        packets = sum(counters[0::2])
+        frame_bytes = sum(counters[1::2])
+        payload_bytes = errors = max_behind = 0
+        elapsed = time.time() - start_at
+    elapsed = max(elapsed, 1e-6)
+
+    print("\n=== Replay Summary ===")
+    print(f"channel={args.channel}  processes={cfg['processes']}  speed={args.speed}  "
+          f"max_rate={args.max_rate}/s  loops={args.loops}  encoding={args.raw_encoding}")
+    print(f"packets={packets}  errors={errors}  elapsed={elapsed:.3f}s")
+    print(f"achieved pps={packets / elapsed:.1f}  frame Bps={frame_bytes / elapsed:.0f} "
+          f"({frame_bytes * 8 / elapsed / 1e6:.2f} Mbit/s)  published Bps={payload_bytes / elapsed:.0f}")
+    if args.speed > 0 and info["span"] > 0:
+        print(f"original pps={info['packets'] / info['span']:.1f}  "
+              f"max_behind_schedule_ms={max_behind * 1000:.2f}")
+
+
+if __name__ == "__main__":
+    main()
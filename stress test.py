@@ -1,5 +1,9 @@
 import argparse, os, sys, time, threading, random, string, json, csv
 import statistics
+import base64, socket, struct
+import math
+from collections import deque
+import multiprocessing as mp
 
 try:
     import redis
@@ -31,13 +35,480 @@ def make_payload(size,
     return s
 
 
+# 二進制批量五元組格式，和 gui.py 的 decode_five_tuple_batch、getinfo.go 的 tupleBatch 一致
+FIVE_TUPLE_HEADER = struct.Struct("<2sBBHI")
+FIVE_TUPLE_RECORD = struct.Struct("<4s4sHHiiiiHHHBxd")
+IP_PROTOCOLS = {"TCP": 6, "UDP": 17}
+
+
+def make_five_tuple(n):
+    # gui.py 能直接入庫的五元組，目的 IP 按 n 在 11.0.0.0/8 裡遞增
+    dst = 11 << 24 | (n & 0xFFFFFF)
+    return {
+        "protocol": "TCP",
+        "app": "HTTP",
+        "src_ip": "192.168.1.10",
+        "src_port": 40000 + n % 20000,
+        "src_location": "Private Address",
+        "src_lat": 0.0,
+        "src_lon": 0.0,
+        "dst_ip": socket.inet_ntoa(struct.pack("!I", dst)),
+        "dst_port": 443,
+        "dst_location": "Tokyo, Japan",
+        "dst_lat": 35.69 + random.uniform(-1, 1),
+        "dst_lon": 139.69 + random.uniform(-1, 1),
+        "ts": time.time(),
+    }
+
+
+def make_five_tuple_payload(n):
+    return json.dumps(make_five_tuple(n), separators=(",", ":"))
+
+
+def encode_five_tuple_batch(tuples):
+    # 位置和應用名進字符串表，記錄裡只存下標；坐標存 int32 微度
+    strings = {}
+    intern = lambda s: strings.setdefault(s, len(strings))
+    records = b"".join(
+        FIVE_TUPLE_RECORD.pack(
+            socket.inet_aton(t["src_ip"]), socket.inet_aton(t["dst_ip"]), t["src_port"], t["dst_port"],
+            round(t["src_lat"] * 1e6), round(t["src_lon"] * 1e6), round(t["dst_lat"] * 1e6), round(t["dst_lon"] * 1e6),
+            intern(t["src_location"]), intern(t["dst_location"]), intern(t["app"]),
+            IP_PROTOCOLS.get(t["protocol"], 0), t["ts"])
+        for t in tuples)
+    table = b"".join(struct.pack("<H", len(b)) + b for b in (s.encode() for s in strings))
+    return FIVE_TUPLE_HEADER.pack(b"FT", 1, 0, len(strings), len(tuples)) + table + records
+
+
+def five_tuple_keys(data):
+    # getinfo 的輸出（JSON 或 FIVE_TUPLE_FORMAT=binary 的批量消息）-> [(src_ip, src_port, dst_ip, dst_port)]
+    if data[:2] == b"FT":
+        n_strings, n_records = FIVE_TUPLE_HEADER.unpack_from(data)[3:]
+        offset = FIVE_TUPLE_HEADER.size
+        for _ in range(n_strings):
+            offset += 2 + struct.unpack_from("<H", data, offset)[0]
+        view = memoryview(data)[offset:offset + n_records * FIVE_TUPLE_RECORD.size]
+        return [(socket.inet_ntoa(rec[0]), rec[2], socket.inet_ntoa(rec[1]), rec[3])
+                for rec in FIVE_TUPLE_RECORD.iter_unpack(view)]
+    t = json.loads(data)
+    return [(t["src_ip"], t["src_port"], t["dst_ip"], t["dst_port"])]
+
+
+def send_message(target, cfg, payload):
+    # cfg["stream"] 非空時寫 Redis Stream（MAXLEN ~ 近似裁剪），否則 PUBLISH 到頻道
+    if cfg["stream"]:
+        target.xadd(cfg["stream"], {"data": payload}, maxlen=cfg["stream_maxlen"], approximate=True)
+    else:
+        target.publish(cfg["channel"], payload)
+
+
+def ip_checksum(header):
+    if len(header) % 2:
+        header += b"\x00"
+    total = sum(struct.unpack("!%dH" % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def build_frame(src_ip, dst_ip, sport, dport, proto="TCP", payload=b"", ident=0):
+    # Ethernet + IPv4 + TCP/UDP，和 captrue 抓到的幀格式一致
+    eth = b"\x02\x00\x00\x00\x00\x01" + b"\x02\x00\x00\x00\x00\x02" + struct.pack("!H", 0x0800)
+    if proto == "TCP":
+        l4 = struct.pack("!HHIIBBHHH", sport, dport, ident & 0xFFFFFFFF, 0, 5 << 4, 0x02, 65535, 0, 0) + payload
+        proto_num = 6
+    else:
+        l4 = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+        proto_num = 17
+    src = socket.inet_aton(src_ip)
+    dst = socket.inet_aton(dst_ip)
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4), ident & 0xFFFF, 0, 64, proto_num, 0, src, dst)
+    header = header[:10] + struct.pack("!H", ip_checksum(header)) + header[12:]
+    return eth + header + l4
+
+
+def build_packet_payload(src_ip, dst_ip, sport, dport, proto="TCP", payload=b"", ident=0, encoding="base64"):
+    # encoding 對應 captrue/getinfo 的 RAW_PACKET_ENCODING
+    frame = build_frame(src_ip, dst_ip, sport, dport, proto, payload, ident)
+    if encoding == "binary":
+        return frame
+    return base64.b64encode(frame).decode()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class FiveTupleCollector(threading.Thread):
+    # 訂閱 getinfo 的輸出，用 (src_ip, src_port, dst_ip, dst_port) 和發出去的幀對上號
+    # sport 迴繞後同一個鍵可能同時有多幀在路上，pending[key] 是發送時間的隊列，按先發先到配對
+    def __init__(self, r, channel, pending, lock):
+        super().__init__(daemon=True)
+        self.pubsub = r.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+        self.pending = pending
+        self.lock = lock
+        self.latencies_ms = []
+        self.received = 0
+        self.unmatched = 0
+        self.first_recv = None
+        self.last_recv = None
+        self.per_second = {}
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            message = self.pubsub.get_message(timeout=0.2)
+            if message is None:
+                continue
+            now = time.monotonic()
+            try:
+                keys = five_tuple_keys(message["data"])
+            except (ValueError, KeyError, TypeError, struct.error):
+                self.unmatched += 1
+                continue
+            for key in keys:
+                with self.lock:
+                    queue = self.pending.get(key)
+                    sent_at = queue.popleft() if queue else None
+                    if queue is not None and not queue:
+                        del self.pending[key]
+                if sent_at is None:
+                    self.unmatched += 1
+                    continue
+                self.received += 1
+                latency = (now - sent_at) * 1000.0
+                self.latencies_ms.append(latency)
+                sec = int(now)
+                self.per_second.setdefault(sec, []).append(latency)
+                if self.first_recv is None:
+                    self.first_recv = now
+                self.last_recv = now
+
+
+def run_e2e(args):
+    r = build_redis(args.redis_host, args.redis_port)
+    try:
+        r.ping()
+    except Exception as e:
+        print(f"[FATAL] Cannot connect to Redis at {args.redis_host}:{args.redis_port}: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    src_ips = [ip for ip in args.src_ips.split(",") if ip]
+    dst_ips = [ip for ip in args.dst_ips.split(",") if ip]
+    pending = {}
+    lock = threading.Lock()
+    collector = FiveTupleCollector(build_redis(args.redis_host, args.redis_port), args.out_channel, pending, lock)
+    collector.start()
+    time.sleep(0.2)
+
+    # 開環發送：按預定時間表發，不因為 Redis 變慢而降速
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    start = time.monotonic()
+    sent = 0
+    seq = 0
+    reused = 0
+    while True:
+        now = time.monotonic()
+        if now - start >= args.duration:
+            break
+        intended = start + seq * interval
+        if intended > now:
+            time.sleep(intended - now)
+        src_ip = src_ips[seq % len(src_ips)]
+        dst_ip = dst_ips[(seq // len(src_ips)) % len(dst_ips)]
+        sport = 1024 + (seq // (len(src_ips) * len(dst_ips))) % 64000
+        payload = build_packet_payload(src_ip, dst_ip, sport, args.dst_port, args.proto, ident=seq,
+                                       encoding=args.raw_encoding)
+        key = (src_ip, sport, dst_ip, args.dst_port)
+        with lock:
+            queue = pending.get(key)
+            if queue is None:
+                queue = pending[key] = deque()
+            elif queue:
+                reused += 1
+            queue.append(time.monotonic())
+        try:
+            r.publish(args.channel, payload)
+            sent += 1
+        except Exception as e:
+            print(f"publish failed: {e}", file=sys.stderr)
+        seq += 1
+    send_seconds = time.monotonic() - start
+
+    deadline = time.monotonic() + args.drain
+    while time.monotonic() < deadline:
+        with lock:
+            if not pending:
+                break
+        time.sleep(0.05)
+    collector.stop.set()
+    collector.join()
+
+    lat = sorted(collector.latencies_ms)
+    received = collector.received
+    recv_span = (collector.last_recv - collector.first_recv) if received > 1 else 0.0
+    summary = {
+        "sent": sent,
+        "received": received,
+        "lost": sent - received,
+        "loss_rate": (sent - received) / sent if sent else 0.0,
+        "unmatched": collector.unmatched,
+        "key_reuse": reused,
+        "send_rate": sent / send_seconds if send_seconds else 0.0,
+        "recv_rate": received / recv_span if recv_span else 0.0,
+        "latency_ms": {
+            "p50": percentile(lat, 50),
+            "p95": percentile(lat, 95),
+            "p99": percentile(lat, 99),
+            "max": lat[-1] if lat else 0.0,
+            "mean": statistics.mean(lat) if lat else 0.0,
+        },
+    }
+
+    print("\n=== End-to-end Summary ===")
+    print(f"raw={args.channel} -> five_tuple={args.out_channel}  rate={args.rate}/s  duration={args.duration}s  proto={args.proto}")
+    print(f"sent={sent}  received={received}  loss={summary['loss_rate'] * 100:.2f}%  unmatched={collector.unmatched}")
+    if reused:
+        print(f"[WARN] {reused} frames reused a five-tuple still in flight; their latency assumes in-order delivery "
+              f"(add --src-ips/--dst-ips or lower --rate to avoid)")
+    print(f"send_rate={summary['send_rate']:.1f}/s  sustained_recv_rate={summary['recv_rate']:.1f}/s")
+    l = summary["latency_ms"]
+    print(f"latency_ms p50={l['p50']:.2f} p95={l['p95']:.2f} p99={l['p99']:.2f} max={l['max']:.2f}")
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["second", "received", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            base = min(collector.per_second) if collector.per_second else 0
+            for sec in sorted(collector.per_second):
+                vals = sorted(collector.per_second[sec])
+                w.writerow([sec - base, len(vals), f"{percentile(vals, 50):.3f}", f"{percentile(vals, 95):.3f}",
+                            f"{percentile(vals, 99):.3f}", f"{vals[-1]:.3f}"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+class LatencyHistogram:
+    # 對數-線性分桶（每個 2 的冪區間再分 SUB_BUCKETS 份，相對誤差約 3%），
+    # 稀疏 dict 存儲，可以跨進程合併
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, us):
+        if us < self.SUB_BUCKETS:
+            return int(us)
+        exp = int(math.log2(us))
+        sub = int((us / (1 << exp) - 1.0) * self.SUB_BUCKETS)
+        return (exp - 4) * self.SUB_BUCKETS + sub
+
+    def _upper(self, index):
+        if index < self.SUB_BUCKETS:
+            return float(index + 1)
+        exp, sub = divmod(index, self.SUB_BUCKETS)
+        exp += 4
+        return (1 << exp) * (1.0 + (sub + 1) / self.SUB_BUCKETS)
+
+    def record(self, us):
+        i = self._index(max(us, 0.0))
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def merge(self, other):
+        for i, c in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        target = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= target:
+                return min(self._upper(i), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {"counts": self.counts, "count": self.count, "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls()
+        h.counts = {int(k): v for k, v in d["counts"].items()}
+        h.count = d["count"]
+        h.total = d["total"]
+        h.max = d["max"]
+        return h
+
+
+def build_pool(idx, cfg):
+    # 返回 (預生成的消息池, 每條消息裡的五元組數)
+    if cfg["payload"] == "frame":
+        return [build_packet_payload("93.184.216.34", "203.0.113.10", 1024 + i, 80, ident=i,
+                                     encoding=cfg["raw_encoding"]) for i in range(1024)], 1
+    if cfg["payload"] == "tuple":
+        return [make_five_tuple_payload(idx * 1024 + i) for i in range(1024)], 1
+    if cfg["payload"] == "tuple-bin":
+        n = max(1, cfg["tuples_per_message"])
+        base = idx * 1024 * n
+        return [encode_five_tuple_batch([make_five_tuple(base + i * n + k) for k in range(n)])
+                for i in range(1024)], n
+    return [make_payload(cfg["bytes"]) for _ in range(1024)], 1
+
+
+def process_worker(idx, cfg, start_at, results):
+    # 每個進程一條連接；開環：第 i 條消息的預定發送時間是 start_at + (i + idx / n) * interval，
+    # 延遲從預定時間算到 publish 返回，Redis 變慢時排隊時間也會被計入
+    r = build_redis(cfg["redis_host"], cfg["redis_port"])
+    pool, _ = build_pool(idx, cfg)
+    rate = cfg["rate"] / cfg["processes"]
+    interval = 1.0 / rate if rate > 0 else 0.0
+    offset = idx / cfg["processes"] * interval
+    batch = max(1, cfg["pipeline"])
+    per_second = {}
+    total = LatencyHistogram()
+    sent = 0
+    errors = 0
+    seq = 0
+    end_at = start_at + cfg["duration"]
+
+    now = time.time()
+    if start_at > now:
+        time.sleep(start_at - now)
+
+    while True:
+        now = time.time()
+        if now >= end_at:
+            break
+        first_intended = start_at + offset + seq * interval
+        if first_intended > now:
+            time.sleep(min(first_intended - now, end_at - now))
+            continue
+        # 已經到期的消息（最多 batch 條）一次性發出
+        due = 1 if interval == 0 else min(batch, int((now - first_intended) / interval) + 1)
+        intended = [first_intended + k * interval for k in range(due)]
+        try:
+            if due == 1:
+                send_message(r, cfg, pool[seq % len(pool)])
+            else:
+                pipe = r.pipeline(transaction=False)
+                for k in range(due):
+                    send_message(pipe, cfg, pool[(seq + k) % len(pool)])
+                pipe.execute()
+            done = time.time()
+            for t in intended:
+                us = (done - t) * 1e6
+                sec = int(t - start_at)
+                h = per_second.get(sec)
+                if h is None:
+                    h = per_second[sec] = LatencyHistogram()
+                h.record(us)
+                total.record(us)
+            sent += due
+        except Exception:
+            errors += due
+        seq += due
+
+    results.put({
+        "idx": idx,
+        "sent": sent,
+        "errors": errors,
+        "total": total.to_dict(),
+        "per_second": {sec: h.to_dict() for sec, h in per_second.items()},
+    })
+
+
+def run_processes(args):
+    cfg = {
+        "redis_host": args.redis_host,
+        "redis_port": args.redis_port,
+        "channel": args.channel,
+        "rate": args.rate,
+        "bytes": args.bytes,
+        "duration": args.duration,
+        "processes": args.processes,
+        "pipeline": args.pipeline,
+        "payload": args.payload,
+        "stream": args.stream,
+        "stream_maxlen": args.stream_maxlen,
+        "tuples_per_message": args.tuples_per_message,
+        "raw_encoding": args.raw_encoding,
+    }
+    sample, tuples_per_message = build_pool(0, cfg)
+    avg_bytes = sum(len(p) for p in sample) / len(sample)
+    results = mp.Queue()
+    start_at = time.time() + 1.0
+    procs = [mp.Process(target=process_worker, args=(i, cfg, start_at, results), daemon=True)
+             for i in range(args.processes)]
+    for p in procs:
+        p.start()
+    outs = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    total = LatencyHistogram()
+    per_second = {}
+    sent = 0
+    errors = 0
+    for out in outs:
+        sent += out["sent"]
+        errors += out["errors"]
+        total.merge(LatencyHistogram.from_dict(out["total"]))
+        for sec, d in out["per_second"].items():
+            per_second.setdefault(sec, LatencyHistogram()).merge(LatencyHistogram.from_dict(d))
+
+    print("\n=== Open-loop Summary ===")
+    print(f"{'stream=' + args.stream if args.stream else 'channel=' + args.channel}  "
+          f"processes={args.processes}  pipeline={args.pipeline}  "
+          f"rate_total={args.rate}/s  payload={args.payload}  duration={args.duration}s")
+    print(f"total_sent={sent}  errors={errors}  achieved={sent / args.duration:.1f}/s")
+    if args.payload in ("tuple", "tuple-bin"):
+        # 兩種五元組格式對比時看這一行：每條五元組佔多少字節、實際送出多少條五元組
+        print(f"tuples_per_message={tuples_per_message}  bytes_per_message={avg_bytes:.0f}  "
+              f"bytes_per_tuple={avg_bytes / tuples_per_message:.1f}  "
+              f"tuples_per_sec={sent * tuples_per_message / args.duration:.1f}")
+    else:
+        print(f"bytes_per_message={avg_bytes:.0f}")
+    print(f"latency_ms p50={total.percentile(50) / 1000:.3f} p90={total.percentile(90) / 1000:.3f} "
+          f"p99={total.percentile(99) / 1000:.3f} p99.9={total.percentile(99.9) / 1000:.3f} "
+          f"max={total.max / 1000:.3f} mean={total.mean() / 1000:.3f}")
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["second", "sent", "p50_ms", "p90_ms", "p99_ms", "p999_ms", "max_ms", "mean_ms"])
+            for sec in sorted(per_second):
+                h = per_second[sec]
+                w.writerow([sec, h.count] + [f"{h.percentile(p) / 1000:.3f}" for p in (50, 90, 99, 99.9)]
+                           + [f"{h.max / 1000:.3f}", f"{h.mean() / 1000:.3f}"])
+
+
 class Worker(threading.Thread):
 
-    def __init__(self, idx, r, channel, rate_per_sec, size, duration, stats, lock):
+    def __init__(self, idx, r, cfg, rate_per_sec, size, duration, stats, lock):
         super().__init__(daemon=True)
         self.idx = idx
         self.r = r
-        self.channel = channel
+        self.cfg = cfg
         self.rate = rate_per_sec
         self.size = size
         self.duration = duration
@@ -48,13 +519,14 @@ class Worker(threading.Thread):
     def run(self):
         start = time.monotonic()
         sent = 0
-        lat_sum = 0.0
         lat_cnt = 0
+        lat_mean = 0.0
+        lat_m2 = 0.0
 
         while not self.stop.is_set() and (time.monotonic() - start) < self.duration:
             t0 = time.monotonic()
             try:
-                self.r.publish(self.channel, make_payload(self.size))
+                send_message(self.r, self.cfg, make_payload(self.size))
                 ok = True
             except Exception:
                 ok = False
@@ -62,13 +534,16 @@ class Worker(threading.Thread):
 
             if ok:
                 sent += 1
-                lat_sum += (t1 - t0) * 1000.0
+                lat = (t1 - t0) * 1000.0
                 lat_cnt += 1
+                delta = lat - lat_mean
+                lat_mean += delta / lat_cnt
+                lat_m2 += delta * (lat - lat_mean)
 
                 with self.lock:
                     self.stats["sent"][self.idx] = sent
-                    avg_ms = lat_sum / lat_cnt
-                    self.stats["lat_ms"][self.idx] = (avg_ms, 0.0)
+                    std_ms = math.sqrt(lat_m2 / (lat_cnt - 1)) if lat_cnt > 1 else 0.0
+                    self.stats["lat_ms"][self.idx] = (lat_mean, std_ms)
 
             if self.rate > 0:
                 sleep_time = max(0.0, (1.0 / self.rate) - (time.monotonic() - t0))
@@ -91,8 +566,36 @@ def main():
     ap.add_argument("--duration", "-d", type=int, default=60, help="Test duration (seconds)")
     ap.add_argument("--print-every", type=int, default=1, help="Print interval (seconds)")
     ap.add_argument("--csv", default="", help="Optional CSV path for per-second stats")
+    ap.add_argument("--mode", choices=["publish", "e2e", "procs"], default="publish",
+                    help="publish: measure r.publish only; e2e: send real frames and match getinfo output; "
+                         "procs: open-loop multi-process publisher with latency histograms")
+    ap.add_argument("--processes", "-p", type=int, default=os.cpu_count() or 1, help="procs: number of processes")
+    ap.add_argument("--pipeline", type=int, default=1, help="procs: max messages per pipelined batch")
+    ap.add_argument("--stream", default="", help="publish/procs: XADD to this Redis stream instead of PUBLISH "
+                                                   "(e.g. five_tuple_stream)")
+    ap.add_argument("--stream-maxlen", type=int, default=1000000, help="Approximate MAXLEN for --stream")
+    ap.add_argument("--payload", choices=["json", "frame", "tuple", "tuple-bin"], default="json",
+                    help="procs: JSON blob of --bytes, an Ethernet frame, a gui-ready JSON five-tuple, "
+                         "or a binary batch of --tuples-per-message five-tuples")
+    ap.add_argument("--tuples-per-message", type=int, default=64, help="procs: five-tuples per tuple-bin message")
+    ap.add_argument("--raw-encoding", choices=["base64", "binary"], default="base64",
+                    help="e2e/procs frame payloads: must match RAW_PACKET_ENCODING of getinfo")
+    ap.add_argument("--out-channel", default="five_tuple_channel", help="e2e: channel getinfo publishes to")
+    ap.add_argument("--src-ips", default="93.184.216.34,1.1.1.1,8.8.8.8", help="e2e: comma-separated public source IPs")
+    ap.add_argument("--dst-ips", default="203.0.113.10", help="e2e: comma-separated destination IPs")
+    ap.add_argument("--dst-port", type=int, default=80, help="e2e: destination port")
+    ap.add_argument("--proto", choices=["TCP", "UDP"], default="TCP", help="e2e: transport protocol")
+    ap.add_argument("--drain", type=float, default=5.0, help="e2e: seconds to wait for outstanding replies")
+    ap.add_argument("--json", default="", help="e2e: optional JSON path for the summary")
     args = ap.parse_args()
 
+    if args.mode == "e2e":
+        run_e2e(args)
+        return
+    if args.mode == "procs":
+        run_processes(args)
+        return
+
     r = build_redis(args.redis_host, args.redis_port)
     try:
         r.ping()
@@ -106,10 +609,11 @@ def main():
     }
     lock = threading.Lock()
     per_worker_rate = args.rate / max(1, args.concurrency)
+    send_cfg = {"channel": args.channel, "stream": args.stream, "stream_maxlen": args.stream_maxlen}
 
     workers = []
     for i in range(args.concurrency):
-        w = Worker(i, r, args.channel, per_worker_rate, args.bytes, args.duration, stats, lock)
+        w = Worker(i, r, send_cfg, per_worker_rate, args.bytes, args.duration, stats, lock)
         w.start()
         workers.append(w)
 
@@ -153,13 +657,13 @@ def main():
     lat_avg = (sum(lat_means) / len(lat_means)) if lat_means else 0.0
 
     print("\n=== Summary ===")
-    print(f"channel={args.channel}")
+    print(f"stream={args.stream}" if args.stream else f"channel={args.channel}")
     print(f"concurrency={args.concurrency}  rate_total={args.rate}/s  bytes={args.bytes}  duration={args.duration}s")
     print(f"total_sent={grand_total}  avg_pub_latency_ms={lat_avg:.2f}")
     for i, (m, s) in enumerate(stats["lat_ms"]):
         sent_i = stats["sent"][i]
         if sent_i > 0:
-            print(f"  worker#{i}: sent={sent_i}  pub_ms_avg={m:.2f}")
+            print(f"  worker#{i}: sent={sent_i}  pub_ms_avg={m:.2f}  pub_ms_std={s:.2f}")
 
     if csv_file:
         csv_file.close()
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# gui.py 是單文件腳本，不是包，直接把倉庫根目錄放進 sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GUI_DEPENDENCIES = ("redis", "flask", "scapy", "folium", "requests")
+
+
+@pytest.fixture(scope="session")
+def gui():
+    # 只測純邏輯，不需要 Redis 服務；依賴庫沒裝時跳過
+    for name in GUI_DEPENDENCIES:
+        pytest.importorskip(name)
+    import gui
+    return gui
@@ -0,0 +1,38 @@
+import threading
+
+
+def test_waiter_gives_up_after_wait_timeout(gui):
+    cache = gui.EnrichmentCache({"banner": 300.0}, wait_timeout=0.05)
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return {"ip": "1.1.1.1", "banner": "ok"}
+
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_compute("banner", "1.1.1.1", slow)))
+    leader.start()
+    started.wait(5)
+    result, status, _ = cache.get_or_compute("banner", "1.1.1.1", slow)
+    assert status == "timeout" and "error" in result
+    release.set()
+    leader.join(5)
+    assert results[0][:2] == ({"ip": "1.1.1.1", "banner": "ok"}, "miss")
+    assert cache.get_or_compute("banner", "1.1.1.1", slow)[1] == "hit"
+    assert cache.stats()["wait_timeouts"] == 1
+
+
+def test_interrupted_leader_releases_the_key(gui):
+    cache = gui.EnrichmentCache({"banner": 300.0}, error_ttl=0.0)
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    try:
+        cache.get_or_compute("banner", "1.1.1.1", interrupted)
+    except KeyboardInterrupt:
+        pass
+    assert cache.stats()["inflight"] == 0
+    result, status, _ = cache.get_or_compute("banner", "1.1.1.1", lambda: {"ip": "1.1.1.1"})
+    assert (result, status) == ({"ip": "1.1.1.1"}, "miss")
@@ -0,0 +1,141 @@
+import json
+import random
+import socket
+import struct
+
+import pytest
+
+PROTOCOLS = {"TCP": 6, "UDP": 17}
+
+
+def five_tuple(n, **overrides):
+    t = {
+        "protocol": "TCP",
+        "app": "HTTP",
+        "src_ip": "192.168.1.10",
+        "src_port": 40000 + n,
+        "src_location": "Private Address",
+        "src_lat": 0.0,
+        "src_lon": 0.0,
+        "dst_ip": socket.inet_ntoa(struct.pack("!I", 11 << 24 | n)),
+        "dst_port": 443,
+        "dst_location": "Tokyo, Japan",
+        "dst_lat": 35.689487,
+        "dst_lon": 139.691706,
+        "ts": 1700000000.25 + n,
+    }
+    t.update(overrides)
+    return t
+
+
+def encode(gui, tuples):
+    # 和 getinfo.go / stress test.py 的 FIVE_TUPLE_FORMAT=binary 編碼一致
+    strings = {}
+    intern = lambda s: strings.setdefault(s, len(strings))
+    records = b"".join(
+        gui.FIVE_TUPLE_RECORD.pack(
+            socket.inet_aton(t["src_ip"]), socket.inet_aton(t["dst_ip"]), t["src_port"], t["dst_port"],
+            round(t["src_lat"] * 1e6), round(t["src_lon"] * 1e6), round(t["dst_lat"] * 1e6), round(t["dst_lon"] * 1e6),
+            intern(t["src_location"]), intern(t["dst_location"]), intern(t["app"]),
+            PROTOCOLS.get(t["protocol"], 0), t["ts"])
+        for t in tuples)
+    table = b"".join(struct.pack("<H", len(b)) + b for b in (s.encode() for s in strings))
+    return gui.FIVE_TUPLE_HEADER.pack(b"FT", 1, 0, len(strings), len(tuples)) + table + records
+
+
+def as_row(t):
+    return (t["protocol"], t["app"], t["src_ip"], t["src_location"], t["src_lat"], t["src_lon"],
+            t["dst_ip"], t["dst_location"], t["dst_lat"], t["dst_lon"], t["ts"])
+
+
+def test_header_and_record_sizes(gui):
+    assert gui.FIVE_TUPLE_HEADER.size == 10
+    assert gui.FIVE_TUPLE_RECORD.size == 44
+
+
+def test_batch_round_trip(gui):
+    tuples = [five_tuple(1), five_tuple(2, protocol="UDP", app="DNS", dst_location="São Paulo, Brazil",
+                                         dst_lat=-23.55052, dst_lon=-46.633308),
+              five_tuple(3, protocol="ICMP", src_ip="8.8.8.8", src_location="Mountain View",
+                         src_lat=37.386, src_lon=-122.0838)]
+    decoded = gui.decode_five_tuple_batch(encode(gui, tuples))
+    expected = [as_row(t) for t in tuples]
+    expected[2] = ("UNKNOWN",) + expected[2][1:]
+    assert len(decoded) == 3
+    for got, want in zip(decoded, expected):
+        assert got[:4] == want[:4] and got[6:8] == want[6:8] and got[10] == want[10]
+        assert got[4:6] == pytest.approx(want[4:6], abs=1e-6)
+        assert got[8:10] == pytest.approx(want[8:10], abs=1e-6)
+
+
+def test_empty_batch(gui):
+    assert gui.decode_five_tuple_batch(encode(gui, [])) == []
+
+
+def test_accepts_memoryview_and_bytearray(gui):
+    raw = encode(gui, [five_tuple(1)])
+    assert gui.decode_five_tuple_batch(bytearray(raw)) == gui.decode_five_tuple_batch(memoryview(raw))
+
+
+def test_every_truncation_is_rejected(gui):
+    raw = encode(gui, [five_tuple(i) for i in range(3)])
+    for cut in range(len(raw)):
+        with pytest.raises(ValueError):
+            gui.decode_five_tuple_batch(raw[:cut])
+
+
+def test_trailing_bytes_are_rejected(gui):
+    raw = encode(gui, [five_tuple(1)])
+    with pytest.raises(ValueError):
+        gui.decode_five_tuple_batch(raw + b"\x00")
+
+
+def test_bad_version_string_index_and_utf8(gui):
+    raw = bytearray(encode(gui, [five_tuple(1)]))
+    bad_version = bytearray(raw)
+    bad_version[2] = 2
+    with pytest.raises(ValueError):
+        gui.decode_five_tuple_batch(bad_version)
+
+    bad_index = bytearray(raw)
+    record = len(raw) - gui.FIVE_TUPLE_RECORD.size
+    struct.pack_into("<H", bad_index, record + 32, 99)  # src_loc 下標越界
+    with pytest.raises(ValueError):
+        gui.decode_five_tuple_batch(bad_index)
+
+    bad_utf8 = bytearray(raw)
+    bad_utf8[gui.FIVE_TUPLE_HEADER.size + 2] = 0xFF
+    with pytest.raises(ValueError):
+        gui.decode_five_tuple_batch(bad_utf8)
+
+
+def test_random_garbage_never_raises_anything_but_value_error(gui):
+    rng = random.Random(1234)
+    raw = encode(gui, [five_tuple(i) for i in range(4)])
+    for _ in range(2000):
+        if rng.random() < 0.5:
+            data = b"FT\x01" + bytes(rng.randrange(256) for _ in range(rng.randrange(64)))
+        else:
+            data = bytearray(raw)
+            for _ in range(rng.randrange(1, 6)):
+                data[rng.randrange(len(data))] = rng.randrange(256)
+        try:
+            rows = gui.decode_five_tuple_batch(bytes(data))
+        except ValueError:
+            continue
+        assert all(len(row) == 11 for row in rows)
+
+
+def test_five_tuple_rows_mixes_formats_and_counts_errors(gui):
+    payloads = [
+        json.dumps(five_tuple(1)).encode(),
+        encode(gui, [five_tuple(2), five_tuple(3)]),
+        b"not json",
+        b"[1, 2]",
+        encode(gui, [five_tuple(4)])[:-1],
+        json.dumps({"src_ip": "1.1.1.1"}).encode(),
+    ]
+    rows, errors = gui.five_tuple_rows(payloads)
+    assert errors == 3
+    assert [row[6] for row in rows[:3]] == ["11.0.0.1", "11.0.0.2", "11.0.0.3"]
+    assert rows[3] == ("UNKNOWN", "UNKNOWN", "1.1.1.1", "Unknown", 0.0, 0.0, None, "Unknown", 0.0, 0.0, None)
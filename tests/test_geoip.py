@@ -0,0 +1,46 @@
+class FakeReader:
+    def __init__(self):
+        self.lookups = 0
+
+    def get(self, ip):
+        self.lookups += 1
+        return {"location": {"latitude": 35.69, "longitude": 139.69},
+                "city": {"names": {"en": "Tokyo"}}, "country": {"names": {"en": "Japan"}}}
+
+
+class FakeMaxmind:
+    MODE_MMAP = 1
+
+    def __init__(self):
+        self.opens = 0
+        self.reader = None
+
+    def open_database(self, path, mode):
+        self.opens += 1
+        if self.reader is None:
+            raise OSError("no such file")
+        return self.reader
+
+
+def test_reader_is_retried_and_misses_are_not_memoized(gui, monkeypatch):
+    fake = FakeMaxmind()
+    clock = [1000.0]
+    monkeypatch.setattr(gui, "maxminddb", fake)
+    monkeypatch.setattr(gui, "_geoip_reader", None)
+    monkeypatch.setattr(gui, "_geoip_retry_at", 0.0)
+    monkeypatch.setattr(gui, "GEOIP_RETRY_INTERVAL", 60.0)
+    monkeypatch.setattr(gui.time, "monotonic", lambda: clock[0])
+    gui._geo_lookup_open.cache_clear()
+
+    assert gui.geo_lookup_local("8.8.8.8") is None
+    assert gui.geo_lookup_local("8.8.8.8") is None
+    assert fake.opens == 1  # 重試間隔內不重複打開
+
+    fake.reader = FakeReader()
+    clock[0] += 61
+    point = gui.geo_lookup_local("8.8.8.8")
+    assert fake.opens == 2
+    assert (point["lat"], point["city"], point["country"]) == (35.69, "Tokyo", "Japan")
+    gui.geo_lookup_local("8.8.8.8")
+    assert fake.reader.lookups == 1
+    gui._geo_lookup_open.cache_clear()
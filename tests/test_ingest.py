@@ -0,0 +1,114 @@
+import json
+
+
+def five_tuple(dst_ip, **overrides):
+    t = {
+        "protocol": "TCP",
+        "app": "HTTP",
+        "src_ip": "192.168.1.10",
+        "src_location": "Private Address",
+        "src_lat": 0.0,
+        "src_lon": 0.0,
+        "dst_ip": dst_ip,
+        "dst_location": "Tokyo, Japan",
+        "dst_lat": 35.69,
+        "dst_lon": 139.69,
+        "ts": 1700000000.0,
+    }
+    t.update(overrides)
+    return json.dumps(t).encode()
+
+
+def fresh_state(gui, monkeypatch):
+    store = gui.IPStore(cache_max_entries=1000)
+    monkeypatch.setattr(gui, "ip_store", store)
+    monkeypatch.setattr(gui, "traffic_stats", gui.TrafficStats())
+    monkeypatch.setattr(gui, "ingest_stats", gui.IngestStats())
+    return store
+
+
+def test_ingest_batch_keeps_last_update_per_ip(gui, monkeypatch):
+    store = fresh_state(gui, monkeypatch)
+    payloads = [
+        five_tuple("11.0.0.1"),
+        five_tuple("11.0.0.1", dst_location="Osaka, Japan", app="DNS"),
+        five_tuple("11.0.0.2"),
+        b"\x00garbage",
+    ]
+    assert gui.ingest_batch(payloads) == 2
+    items = dict(store.live_items())
+    # 私有地址不入庫；同一批裡同一IP只保留最後一條
+    assert sorted(items) == ["11.0.0.1", "11.0.0.2"]
+    assert items["11.0.0.1"]["location"] == "Osaka, Japan"
+    assert items["11.0.0.1"]["app"] == "DNS"
+    stats = gui.ingest_stats.snapshot()
+    assert stats["decode_errors"] == 1
+    assert stats["tuples"] == 3
+
+
+def test_ingest_batch_counts_rows_the_store_rejects(gui, monkeypatch):
+    store = fresh_state(gui, monkeypatch)
+    payloads = [five_tuple("11.0.0.1", dst_lat="north"), five_tuple("11.0.0.2")]
+    assert gui.ingest_batch(payloads) == 1
+    assert [ip for ip, _ in store.live_items()] == ["11.0.0.2"]
+    stats = gui.ingest_stats.snapshot()
+    assert stats["decode_errors"] == 1
+    assert stats["records"] == 1
+
+
+def test_non_numeric_ts_is_ignored_for_lag(gui, monkeypatch):
+    fresh_state(gui, monkeypatch)
+    rows, errors = gui.five_tuple_rows([five_tuple("11.0.0.1", ts="yesterday"), five_tuple("11.0.0.2", ts=True)])
+    assert errors == 0
+    assert [row[10] for row in rows] == [None, None]
+    assert gui.ingest_batch([five_tuple("11.0.0.1", ts="yesterday")], now=1700000001.0) == 1
+    assert gui.ingest_stats.snapshot()["decode_errors"] == 0
+
+
+def test_ingest_batch_safely_counts_unexpected_failures(gui, monkeypatch):
+    fresh_state(gui, monkeypatch)
+
+    def boom(payloads, now=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(gui, "ingest_batch", boom)
+    assert gui.ingest_batch_safely([b"{}", b"{}"]) is False
+    stats = gui.ingest_stats.snapshot()
+    assert stats["decode_errors"] == 2
+    assert stats["failed_batches"] == 1
+
+
+class FakeStreamRedis:
+    def __init__(self):
+        self.acked = []
+        self.added = []
+
+    def xack(self, key, group, *ids):
+        self.acked.extend(ids)
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def xadd(self, key, fields, maxlen=None, approximate=False):
+        self.added.append((key, fields))
+
+    def execute(self):
+        pass
+
+
+def test_failed_stream_batch_is_dead_lettered_and_acked(gui, monkeypatch):
+    fresh_state(gui, monkeypatch)
+    monkeypatch.setattr(gui, "stream_stats", dict.fromkeys(gui.stream_stats, 0))
+
+    def boom(payloads, now=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(gui, "ingest_batch", boom)
+    r = FakeStreamRedis()
+    entries = [(b"1-0", {b"data": five_tuple("11.0.0.1")}), (b"2-0", {}), (b"3-0", {b"data": b"{}"})]
+    assert gui.ingest_stream_entries(r, entries) == 3
+    assert r.acked == [b"1-0", b"2-0", b"3-0"]
+    assert [(key, fields["id"]) for key, fields in r.added] == \
+        [(gui.STREAM_DEAD_KEY, b"1-0"), (gui.STREAM_DEAD_KEY, b"3-0")]
+    assert gui.stream_stats["dead_lettered"] == 2
+    assert gui.ingest_stats.snapshot()["failed_batches"] == 1
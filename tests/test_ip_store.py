@@ -0,0 +1,221 @@
+import time
+
+
+def make_store(gui, **kwargs):
+    kwargs.setdefault("live_ttl", 1.0)
+    kwargs.setdefault("cache_max_entries", 1000)
+    # cache_items / cache_query 用真實時間做按年齡淘汰，測試裡的小時間戳不能被當成過期
+    kwargs.setdefault("cache_max_age", 10 ** 12)
+    return gui.IPStore(**kwargs)
+
+
+def test_string_table_round_trip(gui):
+    table = gui.StringTable()
+    words = ["Tokyo, Japan", "Sydney", "", "São Paulo", "東京", "Tokyo, Japan"]
+    ids = [table.intern(w) for w in words]
+    assert ids[0] == ids[-1]
+    assert len(table) == len(set(words))
+    assert [table.strings[i] for i in ids] == words
+    assert table.intern("Sydney") == ids[1]
+
+
+def test_ip_int_round_trip(gui):
+    for ip in ("0.0.0.0", "1.2.3.4", "203.0.113.10", "255.255.255.255"):
+        assert gui.int_to_ip(gui.ip_to_int(ip)) == ip
+
+
+def test_lru_evicts_oldest_cached_entry_first(gui):
+    store = make_store(gui, cache_max_entries=3)
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=1)
+    store.upsert("1.0.0.2", "A", 1.0, 1.0, "HTTP", now=2)
+    store.upsert("1.0.0.3", "A", 1.0, 1.0, "HTTP", now=3)
+    store.expire(now=10)
+    # 重新出現的IP移到鏈表尾部
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=11)
+    store.upsert("1.0.0.4", "A", 1.0, 1.0, "HTTP", now=12)
+    assert [ip for ip, _ in store.cache_query(sort="last_seen", descending=False)[1]] == \
+        ["1.0.0.3", "1.0.0.1", "1.0.0.4"]
+    assert store.stats()["evicted_size"] == 1
+
+
+def test_live_entries_are_not_evicted(gui):
+    store = make_store(gui, cache_max_entries=2)
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=1)
+    store.upsert("1.0.0.2", "A", 1.0, 1.0, "HTTP", now=1.5)
+    store.upsert("1.0.0.3", "A", 1.0, 1.0, "HTTP", now=1.8)
+    # 三個都還活躍：允許暫時超過上限
+    assert store.stats()["cache_size"] == 3
+    assert store.expire(now=5) == ["1.0.0.1", "1.0.0.2", "1.0.0.3"]
+    store.upsert("1.0.0.4", "A", 1.0, 1.0, "HTTP", now=6)
+    assert sorted(ip for ip, _ in store.cache_query()[1]) == ["1.0.0.3", "1.0.0.4"]
+
+
+def test_age_eviction(gui):
+    store = make_store(gui, cache_max_age=100)
+    base = time.time() - 120
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=base + 1)
+    store.upsert("1.0.0.2", "A", 1.0, 1.0, "HTTP", now=base + 50)
+    store.expire(now=base + 60)
+    store.upsert("1.0.0.3", "A", 1.0, 1.0, "HTTP", now=base + 120)
+    assert sorted(ip for ip, _ in store.cache_query()[1]) == ["1.0.0.2", "1.0.0.3"]
+    assert store.stats()["evicted_age"] == 1
+
+
+def test_expire_walks_live_region_in_order(gui):
+    store = make_store(gui, live_ttl=10)
+    for i in range(5):
+        store.upsert(f"1.0.0.{i}", "A", 1.0, 1.0, "HTTP", now=i)
+    store.upsert("1.0.0.0", "A", 1.0, 1.0, "HTTP", now=20)
+    assert store.expire(now=12.5) == ["1.0.0.1", "1.0.0.2"]
+    assert sorted(ip for ip, _ in store.live_items()) == ["1.0.0.0", "1.0.0.3", "1.0.0.4"]
+    assert store.stats()["live_size"] == 3
+    assert store.stats()["cache_size"] == 5
+
+
+def test_slots_are_reused_after_eviction(gui):
+    store = make_store(gui, cache_max_entries=2, live_ttl=0.5)
+    for i in range(10):
+        store.upsert(f"1.0.0.{i}", "A", 1.0, 1.0, "HTTP", now=i)
+        store.expire(now=i + 1)
+    stats = store.stats()
+    assert stats["cache_size"] == 2
+    assert stats["slots_allocated"] <= 3
+
+
+def test_changes_since_incremental_and_removed(gui):
+    store = make_store(gui, live_ttl=5)
+    updated, removed, cursor, reset = store.changes_since(None)
+    assert reset and updated == [] and removed == []
+
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=1)
+    store.upsert("1.0.0.2", "B", 2.0, 2.0, "DNS", now=2)
+    updated, removed, cursor2, reset = store.changes_since(cursor)
+    assert not reset
+    assert sorted(ip for ip, _ in updated) == ["1.0.0.1", "1.0.0.2"]
+    assert removed == []
+
+    store.expire(now=6.5)
+    updated, removed, cursor3, reset = store.changes_since(cursor2)
+    assert not reset and updated == [] and removed == ["1.0.0.1"]
+    assert store.changes_since(cursor3)[:2] == ([], [])
+
+
+def test_cursor_invalid_after_log_overflow(gui):
+    store = make_store(gui, change_log_max=5)
+    cursor = store.cursor()
+    for i in range(10):
+        store.upsert(f"1.0.0.{i}", "A", 1.0, 1.0, "HTTP", now=i)
+    updated, removed, new_cursor, reset = store.changes_since(cursor)
+    assert reset
+    assert len(updated) == 10
+    entries, cache_cursor = store.cache_changes_since(cursor)
+    assert entries is None and cache_cursor == new_cursor
+    # 日誌內的 cursor 仍然可以增量
+    assert store.cache_changes_since(new_cursor)[0] == []
+
+
+def test_cursor_from_another_epoch_or_future_is_reset(gui):
+    store = make_store(gui)
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=1)
+    epoch, _, version = store.cursor().partition("-")
+    for cursor in ("", "garbage", f"{epoch}x-{version}", f"{epoch}-{int(version) + 1}", f"{epoch}-abc"):
+        assert store.changes_since(cursor)[3], cursor
+        assert store.cache_changes_since(cursor)[0] is None, cursor
+    time.sleep(0.002)
+    restarted = make_store(gui)
+    assert restarted.epoch != store.epoch
+    assert restarted.changes_since(store.cursor())[3]
+
+
+def test_cache_changes_since_returns_rows_oldest_first(gui):
+    store = make_store(gui)
+    cursor = store.cursor()
+    store.upsert("1.0.0.1", "A", 1.5, 2.5, "HTTP", now=1)
+    store.upsert("1.0.0.2", "B", 3.0, 4.0, "DNS", now=2)
+    store.upsert("1.0.0.1", "C", 5.0, 6.0, "SMTP", now=3)
+    rows, _ = store.cache_changes_since(cursor)
+    assert rows == [("1.0.0.2", "B", 3.0, 4.0, "DNS", 2), ("1.0.0.1", "C", 5.0, 6.0, "SMTP", 3)]
+
+
+def test_restore_round_trip_and_keeps_newer_data(gui):
+    store = make_store(gui, live_ttl=100)
+    for i in range(20):
+        store.upsert(f"1.0.{i % 3}.{i}", f"L{i % 4}", i / 2, -i / 2, "HTTP", now=i)
+    rows = list(store.snapshot().rows())
+
+    copy = make_store(gui, live_ttl=100)
+    copy.upsert("1.0.1.1", "Fresh", 0.0, 0.0, "DNS", now=50)
+    # 打亂順序恢復也要保持鏈表按 last_seen 有序
+    copy.restore(rows[10:] + rows[:10], now=60)
+    restored = list(copy.snapshot().rows())
+    assert [r[5] for r in restored] == sorted(r[5] for r in restored)
+    by_ip = {r[0]: r for r in restored}
+    assert by_ip["1.0.1.1"][1] == "Fresh"
+    assert {ip: r for ip, r in by_ip.items() if ip != "1.0.1.1"} == \
+        {r[0]: r for r in rows if r[0] != "1.0.1.1"}
+    assert copy.stats()["live_size"] == sum(1 for r in restored if r[5] + 100 >= 60)
+
+
+def test_cache_query_filters(gui):
+    store = make_store(gui)
+    store.upsert("8.8.8.8", "Mountain View, California, United States", 37.4, -122.1, "DNS", now=1)
+    store.upsert("8.8.4.4", "Mountain View, California, United States", 37.4, -122.1, "DNS", now=2)
+    store.upsert("1.1.1.1", "Sydney, Australia", -33.9, 151.2, "HTTP", now=3)
+    assert store.cache_query(q="8.8.")[0] == 2
+    assert store.cache_query(q="8.8.8.8")[0] == 1
+    assert store.cache_query(q="8.8.0.0/16")[0] == 2
+    assert store.cache_query(q="sydney")[1][0][0] == "1.1.1.1"
+    assert store.cache_query(app_name="dns")[0] == 2
+    assert [ip for ip, _ in store.cache_query(sort="ip", descending=False)[1]] == \
+        ["1.1.1.1", "8.8.4.4", "8.8.8.8"]
+
+
+def test_location_and_app_filters_follow_updates_and_eviction(gui):
+    store = make_store(gui, cache_max_entries=2, live_ttl=0.5)
+    store.upsert("1.0.0.1", "Tokyo, Japan", 35.7, 139.7, "HTTP", now=1)
+    store.upsert("1.0.0.2", "Tokyo, Japan", 35.7, 139.7, "DNS", now=2)
+    store.upsert("1.0.0.1", "Osaka, Japan", 34.7, 135.5, "DNS", now=3)
+    assert [ip for ip, _ in store.cache_query(location="tokyo")[1]] == ["1.0.0.2"]
+    assert store.cache_query(location="japan")[0] == 2
+    assert store.cache_query(app_name="http")[0] == 0
+    assert store.cache_query(q="osaka", app_name="dns")[0] == 1
+    assert store.cache_query(ip="1.0.0.2", location="osaka")[0] == 0
+    store.expire(now=10)
+    store.upsert("2.0.0.1", "Sydney, Australia", -33.9, 151.2, "SMTP", now=11)
+    # 1.0.0.2 被淘汰後 Tokyo 沒有引用了，分詞也要清掉
+    assert store.cache_query(q="tokyo")[0] == 0
+    assert "tokyo" not in store.index.tokens
+    assert sorted(store.index.location_refs.values()) == [1, 1]
+
+
+def test_malformed_rows_are_skipped_without_touching_the_store(gui):
+    store = make_store(gui, live_ttl=100)
+    store.upsert("1.0.0.1", "A", 1.0, 1.0, "HTTP", now=1)
+    before = list(store.snapshot().rows())
+    rejected = store.upsert_many([
+        ("1.0.0.1", ("A", "north", 1.0, "HTTP")),
+        ("1.0.0.2", ("B", None, 1.0, "HTTP")),
+        ("1.0.0.3", ("C", float("nan"), 1.0, "HTTP")),
+        ("1.0.0.4", ("D", 1.0, 500.0, "HTTP")),
+        ("1.0.0.5", (None, 1.0, 1.0, "HTTP")),
+        ("not-an-ip", ("E", 1.0, 1.0, "HTTP")),
+        ("1.0.0.6", ("F", "2.5", 3, "DNS")),
+    ], now=2)
+    assert rejected == 6
+    rows = list(store.snapshot().rows())
+    assert rows[0] == before[0]
+    assert rows[1] == ("1.0.0.6", "F", 2.5, 3.0, "DNS", 2)
+    assert store.stats()["cache_size"] == 2
+    assert sorted(ip for ip, _ in store.live_items()) == ["1.0.0.1", "1.0.0.6"]
+    assert store.restore([("1.0.0.7", "G", "x", 0.0, "HTTP", 3), ("1.0.0.8", "H", 0.0, 0.0, "HTTP", "y")]) == 2
+    assert store.stats()["cache_size"] == 2
+
+
+def test_viewport_keeps_equator_and_prime_meridian(gui):
+    store = make_store(gui, live_ttl=100)
+    store.upsert("1.0.0.1", "Equator", 0.0, 10.0, "HTTP", now=1)
+    store.upsert("1.0.0.2", "Greenwich", 51.5, 0.0, "HTTP", now=1)
+    store.upsert("1.0.0.3", "Unknown", 0.0, 0.0, "HTTP", now=1)
+    kind, points = store.viewport(store.geo.point_zoom, (-90, -180, 90, 180))
+    assert kind == "points"
+    assert sorted(ip for ip, _ in points) == ["1.0.0.1", "1.0.0.2"]
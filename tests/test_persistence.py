@@ -0,0 +1,168 @@
+import time
+
+
+def fill(gui, store, count, base, location="Tokyo, Japan"):
+    for i in range(count):
+        store.upsert(gui.int_to_ip(0x01000000 + i), location, 35.0 + i / 1000, 139.0, "HTTP", now=base + i)
+
+
+def rows(store):
+    return sorted(store.snapshot().rows())
+
+
+def reload(gui, path, **kwargs):
+    store = gui.IPStore(cache_max_entries=10 ** 6, **kwargs)
+    persister = gui.CachePersister(store, path=str(path))
+    persister.load()
+    return store, persister
+
+
+def test_snapshot_and_delta_round_trip(gui, tmp_path):
+    store = gui.IPStore(cache_max_entries=10 ** 6)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    base = time.time() - 100
+    fill(gui, store, 50, base)
+    persister.write_snapshot()
+    store.upsert("1.0.0.3", "Moved", 1.0, 2.0, "DNS", now=base + 60)
+    store.upsert("9.9.9.9", "New", 3.0, 4.0, "DNS", now=base + 61)
+    persister.flush()
+    assert persister.delta_bytes > 0
+
+    restored, loaded = reload(gui, tmp_path)
+    assert rows(restored) == rows(store)
+    assert loaded.loaded == 52
+
+
+def test_compaction_resets_delta_and_cursor(gui, tmp_path):
+    store = gui.IPStore(cache_max_entries=10 ** 6)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    base = time.time() - 100
+    fill(gui, store, 20, base)
+    persister.flush()
+    assert persister.delta_bytes > 0
+    persister.write_snapshot()
+    assert persister.delta_bytes == 0
+    assert persister.cursor == store.cursor()
+    assert (tmp_path / "ip_cache.delta").stat().st_size == 0
+    # 快照之後的 flush 只寫新變更
+    persister.flush()
+    assert persister.delta_bytes == 0
+    store.upsert("9.9.9.9", "New", 3.0, 4.0, "DNS", now=base + 50)
+    persister.flush()
+    assert (tmp_path / "ip_cache.delta").read_bytes().count(b"\n") == 1
+    assert rows(reload(gui, tmp_path)[0]) == rows(store)
+
+
+def test_overflowed_log_writes_recent_suffix(gui, tmp_path):
+    store = gui.IPStore(cache_max_entries=10 ** 6, change_log_max=10)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    base = time.time() - 1000
+    fill(gui, store, 30, base)
+    persister.write_snapshot()
+    persister.last_flush = time.time()
+    for i in range(25):
+        store.upsert(gui.int_to_ip(0x02000000 + i), "Later", 1.0, 1.0, "DNS")
+    assert store.cache_changes_since(persister.cursor)[0] is None
+    persister.flush()
+    assert persister.overflow_flushes == 1
+    assert persister.snapshots_written == 1
+    assert rows(reload(gui, tmp_path)[0]) == rows(store)
+
+
+def test_truncated_last_delta_line_is_ignored(gui, tmp_path):
+    store = gui.IPStore(cache_max_entries=10 ** 6)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    fill(gui, store, 5, time.time() - 100)
+    persister.flush()
+    with open(tmp_path / "ip_cache.delta", "ab") as f:
+        f.write(b'["c","9.9.9.9","Cut')
+    assert rows(reload(gui, tmp_path)[0]) == rows(store)
+
+
+def test_malformed_lines_are_skipped(gui, tmp_path):
+    store = gui.IPStore(cache_max_entries=10 ** 6)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    fill(gui, store, 3, time.time() - 100)
+    persister.write_snapshot()
+    with open(tmp_path / "ip_cache.delta", "wb") as f:
+        f.write(b'[]\n{}\n5\n"c"\n["c","9.9.9.1"]\n["c","9.9.9.2","A","north",0,"HTTP",1]\n'
+                b'["s",1,2]\n["x",1]\n')
+    restored, loaded = reload(gui, tmp_path)
+    assert rows(restored) == rows(store)
+    assert loaded.loaded == 3
+    assert loaded.skipped == 8
+
+
+class StopLoop(BaseException):
+    pass
+
+
+def test_run_keeps_flushing_after_a_failed_load(gui, tmp_path, monkeypatch):
+    store = gui.IPStore(cache_max_entries=10 ** 6)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    fill(gui, store, 3, time.time() - 100)
+    persister.write_snapshot()
+
+    fresh = gui.IPStore(cache_max_entries=10 ** 6)
+    loader = gui.CachePersister(fresh, path=str(tmp_path))
+
+    def broken_load():
+        raise MemoryError
+
+    sleeps = []
+
+    def sleep(seconds):
+        if sleeps:
+            raise StopLoop
+        sleeps.append(seconds)
+        fresh.upsert("9.9.9.9", "New", 3.0, 4.0, "DNS")
+
+    monkeypatch.setattr(loader, "load", broken_load)
+    monkeypatch.setattr(gui.time, "sleep", sleep)
+    try:
+        loader.run()
+    except StopLoop:
+        pass
+    # 原文件改名保留，新變更照常寫 delta
+    assert (tmp_path / "ip_cache.snapshot.failed").exists()
+    assert b"9.9.9.9" in (tmp_path / "ip_cache.delta").read_bytes()
+
+
+def test_snapshot_is_isolated_from_later_writes(gui):
+    store = gui.IPStore(cache_max_entries=1000)
+    for i in range(5):
+        store.upsert(f"1.0.0.{i}", f"L{i % 2}", float(i), float(i), "HTTP", now=i)
+    snapshot = store.snapshot()
+    store.upsert("1.0.0.0", "Moved", 9.0, 9.0, "DNS", now=10)
+    store.upsert("1.0.0.9", "New", 9.0, 9.0, "DNS", now=11)
+    rows = list(snapshot.rows())
+    assert len(snapshot) == 5
+    assert [r[0] for r in rows] == [f"1.0.0.{i}" for i in range(5)]
+    assert rows[0] == ("1.0.0.0", "L0", 0.0, 0.0, "HTTP", 0)
+    assert [r[0] for r in snapshot.rows(since=3)] == ["1.0.0.3", "1.0.0.4"]
+    assert snapshot.cursor != store.cursor()
+
+
+def test_load_does_not_overwrite_newer_entries(gui, tmp_path):
+    store = gui.IPStore(cache_max_entries=10 ** 6)
+    persister = gui.CachePersister(store, path=str(tmp_path))
+    base = time.time() - 100
+    fill(gui, store, 10, base, location="Old")
+    persister.write_snapshot()
+
+    fresh = gui.IPStore(cache_max_entries=10 ** 6)
+    loader = gui.CachePersister(fresh, path=str(tmp_path))
+    load_files = loader._load_files
+
+    def load_while_ingesting():
+        # 模擬後台載入期間消費線程寫入了更新的數據
+        fresh.upsert("1.0.0.2", "Fresh", 1.0, 1.0, "DNS")
+        load_files()
+
+    loader._load_files = load_while_ingesting
+    loader.load()
+    by_ip = {r[0]: r for r in fresh.snapshot().rows()}
+    assert len(by_ip) == 10
+    assert by_ip["1.0.0.2"][1] == "Fresh"
+    # 載入期間的變更會在第一次 flush 寫出
+    assert [r[0] for r in fresh.cache_changes_since(loader.cursor)[0]] == ["1.0.0.2"]
@@ -3,6 +3,491 @@ import time
 import redis
 import sys
 import psutil
+import urllib.request
+import heapq
+import queue
+import random
+import json
+import os
+from collections import deque
+from functools import partial
+from threading import Thread, Lock, Event
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PROCESS_COMPONENTS = ('captrue', 'getinfo', 'gui')
+# 每個頻道的發布者/消費者，按 CLIENT SETNAME 設的名字在 CLIENT LIST 裡識別
+PUBSUB_CHANNELS = {
+    'raw_packet_channel': {'publisher': 'captrue', 'consumer': 'getinfo'},
+    'five_tuple_channel': {'publisher': 'getinfo', 'consumer': 'gui'},
+}
+# 與 getinfo/gui 共用：stream / both 時 gui 從 Redis Stream 消費，不再訂閱 five_tuple_channel
+FIVE_TUPLE_TRANSPORT = os.getenv('FIVE_TUPLE_TRANSPORT', 'pubsub')
+FIVE_TUPLE_STREAM = os.getenv('FIVE_TUPLE_STREAM', 'five_tuple_stream')
+GUI_STREAM_GROUP = os.getenv('GUI_STREAM_GROUP', 'gui')
+if FIVE_TUPLE_TRANSPORT != 'pubsub':
+    del PUBSUB_CHANNELS['five_tuple_channel']
+SAMPLE_RATE_KEY = 'capture:sample_rate'
+PUBSUB_EVENT_LOG = '/FinalProject/tmp/watchdog/pubsub_events.jsonl'
+REDIS_INFO_FIELDS = (
+    'used_memory', 'used_memory_rss', 'used_memory_peak', 'mem_fragmentation_ratio',
+    'connected_clients', 'blocked_clients', 'instantaneous_ops_per_sec',
+    'total_commands_processed', 'pubsub_channels', 'evicted_keys', 'expired_keys',
+    'client_recent_max_output_buffer',
+)
+
+
+def prometheus_metric(lines, name, help_text, kind, values):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in values:
+        if value is None:
+            continue
+        label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+
+class ResourceSampler(Thread):
+    # 後台採樣：psutil 取各子進程 CPU/RSS/線程/FD，Redis 取 INFO；
+    # docker stats / du 很慢（fork + 1~2s），只按 docker_interval 低頻跑或按需刷新
+    def __init__(self, controller, interval=2.0, history=900, docker_interval=300.0):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.interval = interval
+        self.docker_interval = docker_interval
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.docker_refresh = Event()
+        self.history = {name: deque(maxlen=history) for name in PROCESS_COMPONENTS + ('redis',)}
+        self.latest = {}
+        self.docker = {'memory_mb': None, 'disk_usage': None, 'sampled_at': None}
+        self.sample_seconds = 0.0
+        self._procs = {}
+
+    def process_sample(self, name):
+        process = getattr(self.controller, f"{name}_process")
+        if process is None or process.poll() is not None:
+            self._procs.pop(name, None)
+            return {'up': 0}
+        try:
+            proc = self._procs.get(name)
+            if proc is None or proc.pid != process.pid:
+                # cpu_percent 需要同一個 Process 對象的兩次調用才有值，按 pid 緩存
+                proc = psutil.Process(process.pid)
+                proc.cpu_percent(None)
+                self._procs[name] = proc
+            with proc.oneshot():
+                return {
+                    'up': 1,
+                    'pid': proc.pid,
+                    'cpu_percent': proc.cpu_percent(None),
+                    'rss_bytes': proc.memory_info().rss,
+                    'threads': proc.num_threads(),
+                    'fds': proc.num_fds(),
+                }
+        except psutil.Error:
+            self._procs.pop(name, None)
+            return {'up': 0}
+
+    def redis_sample(self):
+        try:
+            info = self.controller.redis_client().info()
+        except redis.RedisError:
+            return {'up': 0}
+        sample = {'up': 1}
+        for field in REDIS_INFO_FIELDS:
+            if field in info:
+                sample[field] = info[field]
+        sample['keyspace'] = {db: stats.get('keys', 0) for db, stats in info.items()
+                              if db.startswith('db') and isinstance(stats, dict)}
+        return sample
+
+    def sample_docker(self):
+        memory = self.controller.get_redis_container_memory_mb()
+        disk = self.controller.get_redis_container_disk_usage()
+        with self.lock:
+            self.docker = {'memory_mb': memory, 'disk_usage': disk, 'sampled_at': time.time()}
+
+    def sample_once(self):
+        started = time.perf_counter()
+        now = time.time()
+        samples = {name: self.process_sample(name) for name in PROCESS_COMPONENTS}
+        samples['redis'] = self.redis_sample()
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            for name, sample in samples.items():
+                sample['ts'] = now
+                self.history[name].append(sample)
+            self.latest = samples
+            self.sample_seconds = elapsed
+
+    def run(self):
+        next_docker = time.monotonic()
+        while not self.stop_event.is_set():
+            # 任何異常都不能讓採樣線程退出，否則 /metrics 會一直返回舊數據
+            try:
+                self.sample_once()
+                if self.docker_refresh.is_set() or (self.docker_interval and time.monotonic() >= next_docker):
+                    self.docker_refresh.clear()
+                    self.sample_docker()
+                    next_docker = time.monotonic() + self.docker_interval
+            except Exception as e:
+                print(f"Resource sample failed: {e!r}")
+            self.stop_event.wait(self.interval)
+
+    def snapshot(self, history=0):
+        with self.lock:
+            data = {
+                'latest': dict(self.latest),
+                'docker': dict(self.docker),
+                'sample_seconds': self.sample_seconds,
+            }
+            if history:
+                data['history'] = {name: list(buf)[-history:] for name, buf in self.history.items()}
+        return data
+
+    def prometheus(self):
+        controller = self.controller
+        snap = self.snapshot()
+        now = time.monotonic()
+        lines = []
+        metric = partial(prometheus_metric, lines)
+
+        latest = snap['latest']
+        procs = [(name, latest.get(name, {})) for name in PROCESS_COMPONENTS]
+        metric('watchdog_component_up', 'Whether the component process is alive', 'gauge',
+               [({'component': n}, s.get('up', 0)) for n, s in procs])
+        metric('watchdog_component_degraded', 'Whether the component is in a crash loop', 'gauge',
+               [({'component': n}, int(controller.health[n]['degraded'])) for n, _ in procs])
+        metric('watchdog_component_restarts_total', 'Restarts performed by the watchdog', 'counter',
+               [({'component': n}, controller.health[n]['restarts']) for n, _ in procs])
+        metric('watchdog_component_downtime_seconds', 'Accumulated downtime', 'counter',
+               [({'component': n}, round(controller.component_downtime(n, now), 3)) for n, _ in procs])
+        metric('watchdog_process_cpu_percent', 'Process CPU usage', 'gauge',
+               [({'component': n}, s.get('cpu_percent')) for n, s in procs])
+        metric('watchdog_process_rss_bytes', 'Process resident set size', 'gauge',
+               [({'component': n}, s.get('rss_bytes')) for n, s in procs])
+        metric('watchdog_process_threads', 'Process thread count', 'gauge',
+               [({'component': n}, s.get('threads')) for n, s in procs])
+        metric('watchdog_process_open_fds', 'Process open file descriptors', 'gauge',
+               [({'component': n}, s.get('fds')) for n, s in procs])
+
+        info = latest.get('redis', {})
+        metric('redis_up', 'Whether Redis answered INFO', 'gauge', [({}, info.get('up', 0))])
+        for field in REDIS_INFO_FIELDS:
+            kind = 'counter' if field.startswith(('total_', 'evicted_', 'expired_')) else 'gauge'
+            metric(f'redis_{field}', f'Redis INFO {field}', kind, [({}, info.get(field))])
+        metric('redis_keyspace_keys', 'Keys per database', 'gauge',
+               [({'db': db}, keys) for db, keys in info.get('keyspace', {}).items()])
+
+        docker = snap['docker']
+        if isinstance(docker['memory_mb'], (int, float)):
+            metric('redis_container_memory_bytes', 'Redis container memory from docker stats', 'gauge',
+                   [({}, int(docker['memory_mb'] * 1024 * 1024))])
+        metric('watchdog_sample_duration_seconds', 'Time spent in the last sampling pass', 'gauge',
+               [({}, round(snap['sample_seconds'], 6))])
+        return '\n'.join(lines) + '\n'
+
+
+class BackpressureMonitor(Thread):
+    # pub/sub 沒有背壓：消費者跟不上時 Redis 把消息堆在它的輸出緩衝裡，
+    # 超過 client-output-buffer-limit pubsub 就直接斷開。這裡每秒看 CLIENT LIST 的
+    # omem/oll 和 tot-net-out，在斷開之前告警、打開 captrue 的採樣、必要時重啟消費者
+    def __init__(self, controller, interval=1.0, event_log=PUBSUB_EVENT_LOG):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.interval = interval
+        self.event_log = event_log
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.actions = ('sample', 'restart')
+        self.warn_fraction = 0.25        # omem 達到 soft limit 的比例即告警
+        self.critical_fraction = 0.75
+        self.growth_samples = 5          # omem 連續增長這麼多次且超過 growth_min_bytes 也告警
+        self.growth_min_bytes = 1024 * 1024
+        self.restart_after = 3           # 連續 critical 這麼多次才重啟消費者
+        self.restart_cooldown = 120.0
+        self.min_sample_rate = 0.05
+        self.sample_step_seconds = 5.0
+        self.recover_seconds = 30.0      # 全部 ok 這麼久後採樣率翻倍恢復
+        self.rate_log_interval = 60.0
+        self.limits_refresh = 60.0
+        self.sample_rate = 1.0
+        self.limits = {'hard': 32 * 1024 * 1024, 'soft': 8 * 1024 * 1024, 'seconds': 60}
+        self.channels = {channel: {
+            'publisher': roles['publisher'],
+            'consumer': roles['consumer'],
+            'level': 'ok',
+            'publish_rate': None,
+            'consume_rate': None,
+            'consume_bytes_rate': None,
+            'omem': 0,
+            'oll': 0,
+            'consumers': 0,
+            'growth': 0,
+            'critical_count': 0,
+        } for channel, roles in PUBSUB_CHANNELS.items()}
+        self.prev_clients = {}
+        self.prev_time = None
+        self.prev_publish_calls = None
+        self.publish_total_rate = None
+        self.prev_disconnections = None
+        self.stream = None
+        self.last_sample_change = 0.0
+        self.last_restart = {}
+        self.ok_since = time.monotonic()
+        self.next_limits = 0.0
+        self.next_rate_log = time.monotonic() + self.rate_log_interval
+
+    def record(self, kind, **fields):
+        fields = dict(ts=time.time(), event=kind, **fields)
+        try:
+            os.makedirs(os.path.dirname(self.event_log), exist_ok=True)
+            with open(self.event_log, 'a') as f:
+                f.write(json.dumps(fields) + '\n')
+        except OSError as e:
+            self.controller.log(f"event log write failed: {e}")
+
+    def refresh_limits(self, r):
+        # "normal 0 0 0 slave ... pubsub 33554432 8388608 60"
+        value = r.config_get('client-output-buffer-limit').get('client-output-buffer-limit', '')
+        parts = value.split()
+        for i, part in enumerate(parts):
+            if part == 'pubsub' and i + 3 < len(parts):
+                self.limits = {'hard': int(parts[i + 1]), 'soft': int(parts[i + 2]), 'seconds': int(parts[i + 3])}
+
+    def thresholds(self):
+        base = self.limits['soft'] or self.limits['hard'] or 32 * 1024 * 1024
+        return base * self.warn_fraction, base * self.critical_fraction
+
+    def set_sample_rate(self, r, rate, reason):
+        rate = round(max(self.min_sample_rate, min(1.0, rate)), 3)
+        if rate == self.sample_rate:
+            return
+        if rate >= 1.0:
+            r.delete(SAMPLE_RATE_KEY)
+        else:
+            r.set(SAMPLE_RATE_KEY, rate)
+        print(f"Capture sample rate {self.sample_rate} -> {rate} ({reason})")
+        self.record('sample_rate', previous=self.sample_rate, rate=rate, reason=reason)
+        self.sample_rate = rate
+        self.last_sample_change = time.monotonic()
+
+    def request_restart(self, name, reason, now):
+        if now - self.last_restart.get(name, -self.restart_cooldown) < self.restart_cooldown:
+            return
+        self.last_restart[name] = now
+        self.record('restart', component=name, reason=reason)
+        self.controller.events.put(('restart', name, reason, now))
+
+    def stream_sample(self, r):
+        # Stream 模式下消息不會丟，積壓體現在消費組的 lag（未投遞）和 pending（未確認）
+        try:
+            length = r.xlen(FIVE_TUPLE_STREAM)
+            groups = {g['name']: g for g in r.xinfo_groups(FIVE_TUPLE_STREAM)}
+        except redis.ResponseError:
+            return None
+        group = groups.get(GUI_STREAM_GROUP.encode()) or groups.get(GUI_STREAM_GROUP) or {}
+        return {'key': FIVE_TUPLE_STREAM, 'length': length, 'group': GUI_STREAM_GROUP,
+                'consumers': group.get('consumers'), 'pending': group.get('pending'), 'lag': group.get('lag')}
+
+    def sample_once(self):
+        controller = self.controller
+        r = controller.redis_client()
+        now = time.monotonic()
+        if now >= self.next_limits:
+            self.refresh_limits(r)
+            self.next_limits = now + self.limits_refresh
+        clients = {c['id']: c for c in r.client_list()}
+        stats = r.info('stats')
+        publish_calls = r.info('commandstats').get('cmdstat_publish', {}).get('calls', 0)
+        dt = now - self.prev_time if self.prev_time is not None else None
+
+        def rate(client, field):
+            prev = self.prev_clients.get(client['id'])
+            if dt is None or prev is None or field not in client:
+                return None
+            return (int(client[field]) - int(prev[field])) / dt
+
+        if dt is not None:
+            self.publish_total_rate = (publish_calls - self.prev_publish_calls) / dt
+
+        disconnections = stats.get('client_output_buffer_limit_disconnections')
+        if self.prev_disconnections is not None and disconnections and disconnections > self.prev_disconnections:
+            print(f"Redis dropped {disconnections - self.prev_disconnections} client(s) for output buffer limit")
+            self.record('buffer_limit_disconnect', count=disconnections - self.prev_disconnections)
+        self.prev_disconnections = disconnections
+
+        if FIVE_TUPLE_TRANSPORT != 'pubsub':
+            self.stream = self.stream_sample(r)
+
+        warn_at, critical_at = self.thresholds()
+        alerts = []
+        for channel, state in self.channels.items():
+            publishers = [c for c in clients.values()
+                          if c.get('name') == state['publisher'] and c.get('sub') == '0']
+            consumers = [c for c in clients.values()
+                         if c.get('name') == state['consumer'] and (c.get('sub') != '0' or c.get('psub') != '0')]
+            # tot-cmds 需要 Redis 7.2+，沒有時只能給出全局 PUBLISH 速率
+            pub_rates = [rate(c, 'tot-cmds') for c in publishers]
+            publish_rate = sum(pub_rates) if pub_rates and None not in pub_rates else None
+            omem = max((int(c['omem']) for c in consumers), default=0)
+            oll = max((int(c['oll']) for c in consumers), default=0)
+            byte_rates = [rate(c, 'tot-net-out') for c in consumers]
+            consume_bytes_rate = sum(byte_rates) if byte_rates and None not in byte_rates else None
+            consume_rate = None
+            if publish_rate is not None and dt:
+                consume_rate = max(0.0, publish_rate - (oll - state['oll']) / dt)
+            state['growth'] = state['growth'] + 1 if omem > state['omem'] else 0
+            state.update(publish_rate=publish_rate, consume_rate=consume_rate,
+                         consume_bytes_rate=consume_bytes_rate, omem=omem, oll=oll, consumers=len(consumers))
+
+            consumer_alive = controller.check_process_health(getattr(controller, f"{state['consumer']}_process"))
+            if consumer_alive and not consumers and controller.component_status[state['consumer']] == 'running':
+                level, reason = 'critical', 'consumer not subscribed'
+            elif omem >= critical_at:
+                level, reason = 'critical', f"omem {omem} >= {int(critical_at)}"
+            elif omem >= warn_at:
+                level, reason = 'warn', f"omem {omem} >= {int(warn_at)}"
+            elif state['growth'] >= self.growth_samples and omem >= self.growth_min_bytes:
+                level, reason = 'warn', f"omem growing for {state['growth']} samples"
+            else:
+                level, reason = 'ok', ''
+            state['critical_count'] = state['critical_count'] + 1 if level == 'critical' else 0
+
+            if level != state['level']:
+                print(f"[{level.upper()}] {channel}: {reason or 'recovered'}")
+                self.record('level', channel=channel, previous=state['level'], level=level, reason=reason,
+                            omem=omem, oll=oll, publish_rate=publish_rate, consume_rate=consume_rate,
+                            sample_rate=self.sample_rate)
+                state['level'] = level
+            if level != 'ok':
+                alerts.append((channel, state, level, reason))
+
+        with self.lock:
+            self.prev_clients = clients
+            self.prev_time = now
+            self.prev_publish_calls = publish_calls
+
+        if alerts:
+            self.ok_since = now
+            if 'sample' in self.actions and now - self.last_sample_change >= self.sample_step_seconds:
+                channel, _, level, reason = alerts[0]
+                self.set_sample_rate(r, self.sample_rate / 2, f"{channel} {level}: {reason}")
+            if 'restart' in self.actions:
+                for channel, state, level, reason in alerts:
+                    if state['critical_count'] >= self.restart_after:
+                        self.request_restart(state['consumer'], f"{channel}: {reason}", now)
+        elif self.sample_rate < 1.0 and now - self.ok_since >= self.recover_seconds \
+                and now - self.last_sample_change >= self.recover_seconds:
+            self.set_sample_rate(r, self.sample_rate * 2, 'all channels ok')
+
+        if now >= self.next_rate_log:
+            self.next_rate_log = now + self.rate_log_interval
+            self.record('rates', publish_total_rate=self.publish_total_rate, sample_rate=self.sample_rate,
+                        channels={ch: {k: st[k] for k in ('publish_rate', 'consume_rate', 'consume_bytes_rate',
+                                                          'omem', 'oll', 'consumers')}
+                                  for ch, st in self.channels.items()})
+
+    def run(self):
+        # 接上 watchdog 重啟前留下的採樣率，之後照常逐步恢復
+        try:
+            value = self.controller.redis_client().get(SAMPLE_RATE_KEY)
+            if value is not None:
+                self.sample_rate = float(value)
+        except (redis.RedisError, ValueError):
+            pass
+        while not self.stop_event.is_set():
+            try:
+                self.sample_once()
+            except redis.RedisError as e:
+                self.controller.log(f"backpressure sample failed: {e}")
+                self.prev_time = None
+            except Exception as e:
+                # 非 Redis 異常也不能結束背壓控制
+                print(f"Backpressure sample failed: {e!r}")
+                self.prev_time = None
+            self.stop_event.wait(self.interval)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'limits': dict(self.limits),
+                'sample_rate': self.sample_rate,
+                'publish_total_rate': self.publish_total_rate,
+                'stream': self.stream,
+                'channels': {ch: {k: v for k, v in st.items() if k not in ('growth', 'critical_count')}
+                             for ch, st in self.channels.items()},
+            }
+
+    def prometheus(self):
+        snap = self.snapshot()
+        lines = []
+        metric = partial(prometheus_metric, lines)
+        channels = list(snap['channels'].items())
+        metric('pubsub_publish_rate', 'Messages published per second', 'gauge',
+               [({'channel': ch}, st['publish_rate']) for ch, st in channels])
+        metric('pubsub_consume_rate', 'Messages delivered to the consumer per second', 'gauge',
+               [({'channel': ch}, st['consume_rate']) for ch, st in channels])
+        metric('pubsub_consume_bytes_rate', 'Bytes written to the consumer per second', 'gauge',
+               [({'channel': ch}, st['consume_bytes_rate']) for ch, st in channels])
+        metric('pubsub_consumer_output_buffer_bytes', 'Consumer output buffer (omem)', 'gauge',
+               [({'channel': ch}, st['omem']) for ch, st in channels])
+        metric('pubsub_consumer_output_list_length', 'Replies queued for the consumer (oll)', 'gauge',
+               [({'channel': ch}, st['oll']) for ch, st in channels])
+        metric('pubsub_backpressure_level', 'Backpressure level: 0 ok, 1 warn, 2 critical', 'gauge',
+               [({'channel': ch}, ('ok', 'warn', 'critical').index(st['level'])) for ch, st in channels])
+        metric('pubsub_publish_total_rate', 'PUBLISH calls per second across all channels', 'gauge',
+               [({}, snap['publish_total_rate'])])
+        metric('capture_sample_rate', 'Fraction of captured packets captrue publishes', 'gauge',
+               [({}, snap['sample_rate'])])
+        stream = snap['stream'] or {}
+        labels = {'stream': stream.get('key'), 'group': stream.get('group')}
+        metric('stream_length', 'Entries in the five-tuple stream', 'gauge', [(labels, stream.get('length'))])
+        metric('stream_group_pending', 'Entries delivered but not acknowledged', 'gauge',
+               [(labels, stream.get('pending'))])
+        metric('stream_group_lag', 'Entries not yet delivered to the group', 'gauge', [(labels, stream.get('lag'))])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # /metrics: Prometheus 文本；/metrics.json?history=N: JSON；/docker?refresh=1: 觸發一次 docker 採樣
+    sampler = None
+    backpressure = None
+
+    def send_body(self, body, content_type, status=200):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/metrics':
+            self.send_body(self.sampler.prometheus() + self.backpressure.prometheus(), 'text/plain; version=0.0.4')
+        elif url.path == '/metrics.json':
+            try:
+                history = int(params.get('history', ['0'])[0])
+            except ValueError:
+                return self.send_body(json.dumps({'error': 'history must be an integer'}), 'application/json', 400)
+            data = self.sampler.snapshot(history)
+            data['status'] = dict(self.sampler.controller.component_status)
+            data['pubsub'] = self.backpressure.snapshot()
+            self.send_body(json.dumps(data), 'application/json')
+        elif url.path == '/docker':
+            if params.get('refresh', ['0'])[0] == '1':
+                self.sampler.sample_docker()
+            self.send_body(json.dumps(self.sampler.snapshot()['docker']), 'application/json')
+        else:
+            self.send_body('not found\n', 'text/plain', 404)
+
+    def log_message(self, format, *args):
+        pass
+
 
 class ComponentController:
     def __init__(self):
@@ -13,8 +498,59 @@ class ComponentController:
         self.redis_host = "localhost"
         self.redis_port = 6379
         self.redis_container_name = "redis1"
-        self.max_retry = 5
+        self.gui_port = 5000
         self.check_interval = 10
+        # 單個組件從啟動到就緒的最長等待，可用 WATCHDOG_<NAME>_READY_TIMEOUT 覆蓋；
+        # gui 給得長一些：啟動時要起 Flask、訂閱、建索引，慢盤上也留出餘量
+        self.ready_timeouts = {
+            name: float(os.getenv(f"WATCHDOG_{name.upper()}_READY_TIMEOUT", default))
+            for name, default in (('redis', 30), ('captrue', 30), ('getinfo', 30), ('gui', 120))
+        }
+        self.probe_interval = 0.05    # 就緒探測的初始間隔，之後指數增長到 probe_interval_max
+        self.probe_interval_max = 0.25
+        self.stop_timeout = 5
+        # 啟動依賴：captrue 等 getinfo 訂閱上 raw_packet_channel 後再啟動，避免開頭的包沒人收
+        self.dependencies = {
+            'redis': [],
+            'getinfo': ['redis'],
+            'gui': ['redis'],
+            'captrue': ['redis', 'getinfo'],
+        }
+        self.subscriber_channels = {
+            'getinfo': 'raw_packet_channel',
+            'gui': 'five_tuple_channel',
+        }
+        if FIVE_TUPLE_TRANSPORT != 'pubsub':
+            del self.subscriber_channels['gui']
+        self.subscriber_baseline = {}
+        self.startup_timings = {}
+        self._redis = None
+        # 監督：子進程退出由等待線程推入 events，重啟按指數退避 + 抖動排進 restart_queue
+        self.backoff_base = 0.5
+        self.backoff_max = 60.0
+        self.crash_loop_threshold = 5   # crash_loop_window 秒內崩潰這麼多次標記為 degraded
+        self.crash_loop_window = 120.0
+        self.stable_seconds = 60.0      # 連續運行這麼久後清零失敗計數、解除 degraded
+        self.events = queue.Queue()
+        self.restart_queue = []
+        self.health = {name: {
+            'restarts': 0,
+            'crashes': 0,
+            'consecutive_failures': 0,
+            'last_exit_code': None,
+            'down_since': None,
+            'downtime': 0.0,
+            'ready_since': None,
+            'degraded': False,
+            'crash_times': deque(),
+        } for name in ('captrue', 'getinfo', 'gui')}
+        self.sample_interval = 2.0
+        self.docker_sample_interval = 300.0  # 0 表示只在 /docker?refresh=1 時採樣
+        self.metrics_host = "127.0.0.1"
+        self.metrics_port = 9101
+        self.sampler = ResourceSampler(self, self.sample_interval, docker_interval=self.docker_sample_interval)
+        self.metrics_server = None
+        self.backpressure = BackpressureMonitor(self)
         self.debug = False  # 设置为 True 开启调试信息
         self.component_status = {
             'redis': 'stopped',
@@ -27,95 +563,148 @@ class ComponentController:
         if self.debug:
             print(f"[DEBUG] {msg}")
 
-    def start_redis(self):
-        print("Starting Redis using docker-compose...")
+    def redis_client(self):
+        if self._redis is None:
+            self._redis = redis.Redis(host=self.redis_host, port=self.redis_port,
+                                      socket_connect_timeout=1, socket_timeout=1)
+        return self._redis
+
+    def subscriber_count(self, channel):
         try:
-            subprocess.run(
-                ['docker-compose', '-f', '/FinalProject/tmp/redis/docker-compose.yml', 'up', '-d'],
-                check=True
-            )
-            time.sleep(5)
-            if not self.check_redis_health():
-                raise Exception("Redis health check failed.")
-            self.component_status['redis'] = 'running'
-            print("Redis started successfully.")
-        except Exception as e:
-            self.component_status['redis'] = 'failed'
-            print(f"Error starting Redis: {e}")
-            sys.exit(1)
+            return dict(self.redis_client().pubsub_numsub(channel)).get(channel.encode(), 0)
+        except redis.RedisError:
+            return 0
 
-    def check_redis_health(self):
-        for _ in range(self.max_retry):
-            try:
-                r = redis.Redis(host=self.redis_host, port=self.redis_port)
-                r.ping()
-                return True
-            except redis.ConnectionError:
-                print("Redis not available, retrying...")
-                time.sleep(2)
-        return False
+    def probe_redis(self):
+        try:
+            return self.redis_client().ping()
+        except redis.RedisError:
+            return False
 
-    def start_captrue(self):
+    def probe_captrue(self):
+        # captrue 只發布不訂閱，外部看不到就緒信號，進程活著即視為就緒
+        return self.check_process_health(self.captrue_process)
+
+    def probe_getinfo(self):
+        return (self.check_process_health(self.getinfo_process) and
+                self.subscriber_count('raw_packet_channel') > self.subscriber_baseline.get('getinfo', 0))
+
+    def probe_gui(self):
+        if not self.check_process_health(self.gui_process):
+            return False
+        if 'gui' in self.subscriber_channels and \
+                self.subscriber_count('five_tuple_channel') <= self.subscriber_baseline.get('gui', 0):
+            return False
         try:
-            self.captrue_process = subprocess.Popen(
-                ['/FinalProject/tmp/captrue/captrue'],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-            time.sleep(5)
-            if not self.check_process_health(self.captrue_process):
-                raise Exception("Captrue health check failed.")
-            self.component_status['captrue'] = 'running'
-            print("Captrue started.")
-        except Exception as e:
-            self.component_status['captrue'] = 'failed'
-            print(f"Error starting captrue: {e}")
-            sys.exit(1)
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.gui_port}/ingest_stats", timeout=1) as resp:
+                return resp.status == 200
+        except OSError:
+            return False
+
+    def wait_ready(self, name, process=None):
+        # 探測間隔從 probe_interval 指數增長，進程提前退出立即失敗
+        probe = getattr(self, f"probe_{name}")
+        timeout = self.ready_timeouts[name]
+        deadline = time.monotonic() + timeout
+        delay = self.probe_interval
+        while not probe():
+            if process is not None and process.poll() is not None:
+                raise Exception(f"{name} exited with code {process.returncode} before becoming ready")
+            if time.monotonic() >= deadline:
+                raise Exception(f"{name} not ready after {timeout}s")
+            time.sleep(delay)
+            delay = min(delay * 2, self.probe_interval_max)
+        self.component_status[name] = 'running'
+
+    def spawn(self, name, args, **kwargs):
+        # 記下啟動前的訂閱者數量，新進程訂閱後數量才會超過它
+        channel = self.subscriber_channels.get(name)
+        if channel:
+            self.subscriber_baseline[name] = self.subscriber_count(channel)
+        self.component_status[name] = 'starting'
+        process = subprocess.Popen(args, **kwargs)
+        setattr(self, f"{name}_process", process)
+        Thread(target=self.watch_process, args=(name, process), daemon=True).start()
+        self.wait_ready(name, process)
+        return process
+
+    def watch_process(self, name, process):
+        # 每個子進程一個等待線程，退出後立刻通知監督循環，不再輪詢
+        returncode = process.wait()
+        self.events.put(('exit', name, process, returncode, time.monotonic()))
+
+    def start_redis(self):
+        print("Starting Redis using docker-compose...")
+        self.component_status['redis'] = 'starting'
+        subprocess.run(
+            ['docker-compose', '-f', '/FinalProject/tmp/redis/docker-compose.yml', 'up', '-d'],
+            check=True
+        )
+        self.wait_ready('redis')
+        print("Redis started successfully.")
+
+    def start_captrue(self):
+        self.spawn('captrue', ['/FinalProject/tmp/captrue/captrue'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print("Captrue started.")
 
     def start_getinfo(self):
-        try:
-            self.getinfo_process = subprocess.Popen(
-                ['/FinalProject/tmp/info/getinfo'],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-            time.sleep(5)
-            if not self.check_process_health(self.getinfo_process):
-                raise Exception("Getinfo health check failed.")
-            self.component_status['getinfo'] = 'running'
-            print("Getinfo started.")
-        except Exception as e:
-            self.component_status['getinfo'] = 'failed'
-            print(f"Error starting getinfo: {e}")
-            sys.exit(1)
+        self.spawn('getinfo', ['/FinalProject/tmp/info/getinfo'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print("Getinfo started.")
 
     def start_gui(self):
+        self.spawn('gui', ['/FinalProject/py_env/bin/python3', '/FinalProject/tmp/gui/gui.py'])
+        print("GUI started.")
+
+    def timed_start(self, name, t0):
+        begin = time.monotonic()
         try:
-            self.gui_process = subprocess.Popen(
-                ['/FinalProject/py_env/bin/python3', '/FinalProject/tmp/gui/gui.py']
-            )
-            time.sleep(5)
-            if not self.check_process_health(self.gui_process):
-                raise Exception("GUI health check failed.")
-            self.component_status['gui'] = 'running'
-            print("GUI started.")
-        except Exception as e:
-            self.component_status['gui'] = 'failed'
-            print(f"Error starting GUI: {e}")
-            sys.exit(1)
+            getattr(self, f"start_{name}")()
+        except Exception:
+            self.component_status[name] = 'failed'
+            raise
+        end = time.monotonic()
+        if name in self.health:
+            self.health[name]['ready_since'] = end
+        self.startup_timings[name] = {
+            'start_at': round(begin - t0, 3),
+            'ready_at': round(end - t0, 3),
+            'duration': round(end - begin, 3),
+        }
+
+    def start_all(self):
+        # 按依賴圖並行啟動：某個組件的依賴全部就緒後立即提交
+        t0 = time.monotonic()
+        pending = dict(self.dependencies)
+        done = set()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+            while pending or futures:
+                for name, deps in list(pending.items()):
+                    if all(d in done for d in deps):
+                        del pending[name]
+                        futures[pool.submit(self.timed_start, name, t0)] = name
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = futures.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        raise Exception(f"Error starting {name}: {e}") from e
+                    done.add(name)
+        self.display_startup_timings(time.monotonic() - t0)
+
+    def display_startup_timings(self, total):
+        print(f"\n===== Startup finished in {total:.2f}s =====")
+        for name, t in sorted(self.startup_timings.items(), key=lambda kv: kv[1]['start_at']):
+            deps = ', '.join(self.dependencies[name]) or '-'
+            print(f"{name:<10} | after: {deps:<14} | start +{t['start_at']:.2f}s | "
+                  f"ready +{t['ready_at']:.2f}s | took {t['duration']:.2f}s")
 
     def check_process_health(self, process):
         return process and process.poll() is None
 
-    def get_memory_usage_mb(self, process):
-        if process and process.poll() is None:
-            try:
-                proc = psutil.Process(process.pid)
-                return round(proc.memory_info().rss / (1024 * 1024), 2)
-            except Exception:
-                return "N/A"
-        return "N/A"
-
     def parse_docker_memory(self, mem_str):
         try:
             # e.g., "14.72MiB / 1.94GiB"
@@ -157,23 +746,33 @@ class ComponentController:
             self.log(f"Redis disk usage failed: {e}")
             return "Unknown"
 
+    def terminate_process(self, process):
+        # 等舊進程真正退出，保證它的 Redis 訂閱已斷開，新進程的就緒探測不會誤判
+        process.stopped_by_watchdog = True
+        process.terminate()
+        try:
+            process.wait(timeout=self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
     def stop_captrue(self):
         if self.captrue_process:
-            self.captrue_process.terminate()
+            self.terminate_process(self.captrue_process)
             self.captrue_process = None
             self.component_status['captrue'] = 'stopped'
             print("Captrue stopped.")
 
     def stop_getinfo(self):
         if self.getinfo_process:
-            self.getinfo_process.terminate()
+            self.terminate_process(self.getinfo_process)
             self.getinfo_process = None
             self.component_status['getinfo'] = 'stopped'
             print("Getinfo stopped.")
 
     def stop_gui(self):
         if self.gui_process:
-            self.gui_process.terminate()
+            self.terminate_process(self.gui_process)
             self.gui_process = None
             self.component_status['gui'] = 'stopped'
             print("GUI stopped.")
@@ -190,40 +789,177 @@ class ComponentController:
             print("Error stopping Redis.")
 
     def restart_component(self, name):
+        # 在獨立線程裡跑，啟動結果同樣通過 events 交回監督循環
         print(f"Restarting {name}...")
-        getattr(self, f"stop_{name}")()
-        getattr(self, f"start_{name}")()
+        process = getattr(self, f"{name}_process")
+        if process is not None and process.poll() is None:
+            self.terminate_process(process)
+        try:
+            getattr(self, f"start_{name}")()
+            error = None
+        except Exception as e:
+            error = e
+            process = getattr(self, f"{name}_process")
+            if process is not None and process.poll() is None:
+                self.terminate_process(process)
+        self.events.put(('started', name, error, time.monotonic()))
+
+    def schedule_restart(self, name, now, reason):
+        health = self.health[name]
+        health['consecutive_failures'] += 1
+        health['crash_times'].append(now)
+        while health['crash_times'] and now - health['crash_times'][0] > self.crash_loop_window:
+            health['crash_times'].popleft()
+        if not health['degraded'] and len(health['crash_times']) >= self.crash_loop_threshold:
+            health['degraded'] = True
+            print(f"{name} crashed {len(health['crash_times'])} times in {self.crash_loop_window:.0f}s, marking degraded")
+        self.component_status[name] = 'degraded' if health['degraded'] else 'failed'
+
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (health['consecutive_failures'] - 1))
+        delay = random.uniform(delay / 2, delay)
+        heapq.heappush(self.restart_queue, (now + delay, name))
+        print(f"{name} {reason}; restart #{health['consecutive_failures']} in {delay:.1f}s")
+
+    def handle_exit(self, name, process, returncode, now):
+        # 主動停止的、已被替換的、以及啟動過程中退出的（由 started 事件處理）都忽略
+        if getattr(process, 'stopped_by_watchdog', False):
+            return
+        if getattr(self, f"{name}_process") is not process or self.component_status[name] == 'starting':
+            return
+        health = self.health[name]
+        health['crashes'] += 1
+        health['last_exit_code'] = returncode
+        health['ready_since'] = None
+        if health['down_since'] is None:
+            health['down_since'] = now
+        setattr(self, f"{name}_process", None)
+        self.schedule_restart(name, now, f"exited with code {returncode}")
+
+    def handle_started(self, name, error, now):
+        health = self.health[name]
+        if error is not None:
+            self.schedule_restart(name, now, f"failed to start: {error}")
+            return
+        if not self.check_process_health(getattr(self, f"{name}_process")):
+            return
+        health['restarts'] += 1
+        if health['down_since'] is not None:
+            health['downtime'] += now - health['down_since']
+            health['down_since'] = None
+        health['ready_since'] = now
+        if health['degraded']:
+            self.component_status[name] = 'degraded'
+        print(f"{name} back up after restart #{health['restarts']}")
+
+    def handle_restart_request(self, name, reason, now):
+        # 背壓監控要求重啟卡住的消費者；正在啟動或已排隊重啟的不重複處理
+        if self.component_status[name] not in ('running', 'degraded'):
+            return
+        if any(queued == name for _, queued in self.restart_queue):
+            return
+        print(f"{name} restart requested: {reason}")
+        self.component_status[name] = 'starting'
+        Thread(target=self.restart_component, args=(name,), daemon=True).start()
+
+    def refresh_health(self, now):
+        for name, health in self.health.items():
+            ready_since = health['ready_since']
+            if ready_since is not None and now - ready_since >= self.stable_seconds and health['consecutive_failures']:
+                health['consecutive_failures'] = 0
+                if health['degraded']:
+                    health['degraded'] = False
+                    self.component_status[name] = 'running'
+                    print(f"{name} stable for {self.stable_seconds:.0f}s, no longer degraded")
+
+    def component_downtime(self, name, now):
+        health = self.health[name]
+        down = health['downtime']
+        if health['down_since'] is not None:
+            down += now - health['down_since']
+        return down
 
     def display_component_status(self):
+        # 只讀採樣線程的緩存，不在這裡 fork docker
+        snap = self.sampler.snapshot()
+        latest = snap['latest']
+        docker = snap['docker']
         print(f"\n===== Status @ {time.strftime('%Y-%m-%d %H:%M:%S')} =====")
         print("-" * 60)
 
-        redis_mem = self.get_redis_container_memory_mb()
-        print(f"Redis      | Status: {self.component_status['redis']:<8} | Memory: {redis_mem} MB")
+        info = latest.get('redis', {})
+        used = info.get('used_memory')
+        used_mb = round(used / (1024 * 1024), 2) if used is not None else "N/A"
+        keys = sum(info.get('keyspace', {}).values())
+        print(f"Redis      | Status: {self.component_status['redis']:<8} | Memory: {used_mb} MB | "
+              f"Clients: {info.get('connected_clients', 'N/A')} | Keys: {keys}")
+
+        now = time.monotonic()
+        for name, label in (('captrue', 'Captrue'), ('getinfo', 'Getinfo'), ('gui', 'GUI')):
+            health = self.health[name]
+            sample = latest.get(name, {})
+            rss = round(sample['rss_bytes'] / (1024 * 1024), 2) if sample.get('up') else "N/A"
+            print(f"{label:<10} | Status: {self.component_status[name]:<8} | "
+                  f"Memory: {rss} MB | CPU: {sample.get('cpu_percent', 'N/A')}% | "
+                  f"Threads: {sample.get('threads', 'N/A')} | FDs: {sample.get('fds', 'N/A')} | "
+                  f"Restarts: {health['restarts']} | Downtime: {self.component_downtime(name, now):.1f}s")
 
-        print(f"Captrue    | Status: {self.component_status['captrue']:<8} | Memory: {self.get_memory_usage_mb(self.captrue_process)} MB")
-        print(f"Getinfo    | Status: {self.component_status['getinfo']:<8} | Memory: {self.get_memory_usage_mb(self.getinfo_process)} MB")
-        print(f"GUI        | Status: {self.component_status['gui']:<8} | Memory: {self.get_memory_usage_mb(self.gui_process)} MB")
+        pubsub = self.backpressure.snapshot()
+        for channel, st in pubsub['channels'].items():
+            pub = f"{st['publish_rate']:.0f}/s" if st['publish_rate'] is not None else "N/A"
+            con = f"{st['consume_rate']:.0f}/s" if st['consume_rate'] is not None else "N/A"
+            print(f"{channel:<19}| {st['level']:<8} | pub: {pub} | consume: {con} | "
+                  f"omem: {st['omem']} | oll: {st['oll']} | subscribers: {st['consumers']}")
+        if pubsub['stream']:
+            st = pubsub['stream']
+            print(f"{st['key']:<19}| length: {st['length']} | lag: {st['lag']} | pending: {st['pending']}")
+        if pubsub['sample_rate'] < 1.0:
+            print(f"Capture sampling enabled: {pubsub['sample_rate']}")
 
-        print(f"Redis Disk Usage: {self.get_redis_container_disk_usage()}")
+        if docker['sampled_at'] is not None:
+            age = time.time() - docker['sampled_at']
+            print(f"Redis Container Memory: {docker['memory_mb']} MB | Disk Usage: {docker['disk_usage']} "
+                  f"(sampled {age:.0f}s ago)")
         print("-" * 60)
 
+    def start_metrics(self):
+        self.sampler.start()
+        self.backpressure.start()
+        MetricsHandler.sampler = self.sampler
+        MetricsHandler.backpressure = self.backpressure
+        self.metrics_server = ThreadingHTTPServer((self.metrics_host, self.metrics_port), MetricsHandler)
+        self.metrics_server.daemon_threads = True
+        Thread(target=self.metrics_server.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{self.metrics_host}:{self.metrics_port}/metrics")
+
     def monitor_components(self):
+        next_status = time.monotonic()
         while True:
-            time.sleep(self.check_interval)
-            self.display_component_status()
+            now = time.monotonic()
+            wake = min([next_status] + [at for at, _ in self.restart_queue[:1]])
+            try:
+                event = self.events.get(timeout=max(0.0, wake - now))
+            except queue.Empty:
+                event = None
+            now = time.monotonic()
 
-            if not self.check_process_health(self.captrue_process):
-                self.component_status['captrue'] = 'failed'
-                self.restart_component('captrue')
+            if event is not None:
+                kind, name, *rest = event
+                if kind == 'exit':
+                    self.handle_exit(name, *rest)
+                elif kind == 'started':
+                    self.handle_started(name, *rest)
+                elif kind == 'restart':
+                    self.handle_restart_request(name, *rest)
 
-            if not self.check_process_health(self.getinfo_process):
-                self.component_status['getinfo'] = 'failed'
-                self.restart_component('getinfo')
+            while self.restart_queue and self.restart_queue[0][0] <= now:
+                _, name = heapq.heappop(self.restart_queue)
+                self.component_status[name] = 'starting'
+                Thread(target=self.restart_component, args=(name,), daemon=True).start()
 
-            if not self.check_process_health(self.gui_process):
-                self.component_status['gui'] = 'failed'
-                self.restart_component('gui')
+            if now >= next_status:
+                self.refresh_health(now)
+                self.display_component_status()
+                next_status = time.monotonic() + self.check_interval
 
     def stop_all(self):
         self.stop_captrue()
@@ -232,10 +968,13 @@ class ComponentController:
         self.stop_redis()
 
     def run(self):
-        self.start_redis()
-        self.start_captrue()
-        self.start_getinfo()
-        self.start_gui()
+        try:
+            self.start_all()
+        except Exception as e:
+            print(e)
+            self.stop_all()
+            sys.exit(1)
+        self.start_metrics()
         self.monitor_components()
 
 if __name__ == '__main__':